@@ -0,0 +1 @@
+"""Offline benchmarks for bot.py (see benchmarks/README.md)."""
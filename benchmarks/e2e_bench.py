@@ -0,0 +1,295 @@
+"""End-to-end benchmark: drive bot.py against local fakes and report throughput and latency.
+
+    python -m benchmarks.e2e_bench --messages 200 --mix youtube=1,instagram=1,terabox=1
+
+Bot tuning knobs (JOB_WORKERS, DOWNLOAD_SEGMENTS, ...) are read from the environment as usual.
+Nothing leaves the machine: resolver/CDN/Bot API URLs point at benchmarks/fakes.py and any
+other outbound HTTP request from the bot is answered 404 locally and counted.
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+import requests
+
+from benchmarks.fakes import start_fakes
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+
+# bot.py constant -> path on the fake resolver server
+ENDPOINTS = {
+    'YOUTUBE_LEGACY_API': '/yt-legacy/',
+    'YOUTUBE_MULTI_API': '/yt-multi/',
+    'TIKTOK_API': '/tiktok/',
+    'INSTA_API': '/insta/',
+    'INSTA_API_ALT': '/insta-alt/',
+    'INSTA_API_NODE': '/insta-node/',
+    'SOCIAL_DL_API': '/social/',
+    'TERA_API': '/tera/api?url=',
+}
+
+# Link shapes per scenario; {n} keeps every link unique so caches do not hide work
+LINKS = {
+    'youtube': 'https://www.youtube.com/watch?v=bench{n:06d}',
+    'tiktok': 'https://www.tiktok.com/@bench/video/{n}',
+    'instagram': 'https://www.instagram.com/reel/BENCH{n}/',
+    'terabox': 'https://terabox.com/s/bench{n}',
+    'generic': 'https://x.com/bench/status/{n}',
+}
+
+SEND_METHODS = {'sendVideo', 'sendPhoto', 'sendDocument', 'sendAudio', 'sendMediaGroup'}
+TUNING_ENV = ('FAST_WORKERS', 'JOB_WORKERS', 'JOB_QUEUE_SIZE', 'DOWNLOAD_SEGMENTS', 'SEGMENT_MIN_SIZE_MB',
+              'HTTP_POOL_SIZE', 'RESOLVER_WORKERS', 'INSTA_RESOLVE_MODE', 'ALBUM_PREFETCH_WORKERS', 'MAX_UPLOAD_MB')
+
+
+class OfflineAdapter(requests.adapters.BaseAdapter):
+    """Answers every request it receives with 404 so the benchmark never reaches the internet."""
+
+    def __init__(self):
+        super().__init__()
+        self.blocked = 0
+
+    def send(self, request, **kwargs):
+        self.blocked += 1
+        response = requests.Response()
+        response.status_code = 404
+        response.url = request.url
+        response.request = request
+        response.raw = __import__('io').BytesIO(b'')
+        return response
+
+    def close(self):
+        pass
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in LINKS:
+            raise SystemExit(f'unknown scenario {name!r}; choose from {", ".join(LINKS)}')
+        mix.extend([name] * int(weight or 1))
+    return mix
+
+
+def load_bot(ports):
+    """Import bot.py and point it at the fakes."""
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456:BENCHMARK')
+    os.environ.setdefault('FILE_ID_CACHE_PATH', '')
+    os.environ.setdefault('JOB_JOURNAL_PATH', '')
+    os.environ['METRICS_PORT'] = '0'
+    sys.path.insert(0, str(ROOT))
+    import telebot
+    import bot
+    telebot.apihelper.API_URL = f"http://127.0.0.1:{ports['telegram']}/bot{{0}}/{{1}}"
+    resolver_base = f"http://127.0.0.1:{ports['resolvers']}"
+    for name, path in ENDPOINTS.items():
+        setattr(bot, name, resolver_base + path)
+    # yt-dlp would go to the real sites; the bench measures the API paths
+    bot.get_instagram_with_ytdlp_fallback = lambda url: (None, [])
+    bot.get_terabox_with_ytdlp_fallback = lambda url: None
+    bot.run_ytdl = lambda *args, **kwargs: None  # yt-dlp now runs in worker processes the adapter cannot reach
+    offline = OfflineAdapter()
+    bot.get_http_session().mount('https://', offline)
+    return bot, offline
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def fake_stats(port):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/__stats', timeout=30) as r:
+        return json.loads(r.read())
+
+
+def inject(port, messages, rate):
+    """Make user messages available on the fake getUpdates, at `rate` per second (0 = at once)."""
+    url = f'http://127.0.0.1:{port}/__enqueue'
+    batch = messages if not rate else None
+    if batch:
+        requests.post(url, json={'messages': batch}, timeout=30)
+        return
+    interval = 1.0 / rate
+    start = time.monotonic()
+    for i, m in enumerate(messages):
+        delay = start + i * interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        requests.post(url, json={'messages': [m]}, timeout=30)
+
+
+def wait_idle(bot, port, expected_chats, settle, timeout):
+    """Wait until every update is consumed, the job pool is idle and the fake API has been quiet."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = fake_stats(port)
+        jobs = bot.JOBS.stats()
+        chats = {c[1] for c in stats['calls']}
+        last_call = max((c[0] for c in stats['calls']), default=0)
+        if (stats['pending_updates'] == 0 and jobs['active'] == 0 and jobs['queued'] == 0
+                and len(chats & expected_chats) == len(expected_chats) and time.time() - last_call > settle):
+            return stats, False
+        time.sleep(0.1)
+    return fake_stats(port), True
+
+
+def summarize(stats, scenario_of, started, finished):
+    per_chat = {}
+    for t, chat, method, ok, _ in stats['calls']:
+        if chat not in scenario_of:
+            continue
+        entry = per_chat.setdefault(chat, {'last': 0.0, 'delivered': False, 'calls': 0})
+        entry['last'] = max(entry['last'], t)
+        entry['calls'] += 1
+        if ok and method in SEND_METHODS:
+            entry['delivered'] = True
+    latencies, by_scenario = [], {}
+    for chat, entry in per_chat.items():
+        latency = entry['last'] - stats['enqueued'][chat]
+        latencies.append(latency)
+        s = by_scenario.setdefault(scenario_of[chat], {'requests': 0, 'delivered': 0, 'latencies': []})
+        s['requests'] += 1
+        s['delivered'] += entry['delivered']
+        s['latencies'].append(latency)
+    wall = finished - started
+    result = {
+        'requests': len(scenario_of),
+        'answered': len(per_chat),
+        'delivered': sum(e['delivered'] for e in per_chat.values()),
+        'wall_seconds': round(wall, 3),
+        'requests_per_second': round(len(per_chat) / wall, 3) if wall else None,
+        'latency_seconds': {f'p{p}': round(percentile(latencies, p), 3) for p in (50, 95, 99)} if latencies else {},
+        'latency_mean_seconds': round(statistics.mean(latencies), 3) if latencies else None,
+        'api_calls': len(stats['calls']),
+        'scenarios': {},
+    }
+    for name, s in by_scenario.items():
+        result['scenarios'][name] = {
+            'requests': s['requests'], 'delivered': s['delivered'],
+            'p50': round(percentile(s['latencies'], 50), 3), 'p95': round(percentile(s['latencies'], 95), 3),
+        }
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--messages', type=int, default=100, help='user messages to send')
+    p.add_argument('--rate', type=float, default=0, help='messages per second (0 = all at once)')
+    p.add_argument('--unique-links', type=int, default=0,
+                   help='distinct links per scenario, repeated across chats (0 = every message unique)')
+    p.add_argument('--mix', default='youtube=1,tiktok=1,instagram=1,terabox=1,generic=1',
+                   help='scenario weights, e.g. youtube=3,instagram=1')
+    p.add_argument('--media-kb', type=int, default=2048, help='size of each media file on the fake CDN')
+    p.add_argument('--cdn-kbps', type=float, default=0, help='per-connection CDN speed in KB/s (0 = unlimited)')
+    p.add_argument('--album-items', type=int, default=1, help='items per Instagram post (>1 = album)')
+    p.add_argument('--api-latency-ms', type=float, default=30, help='added latency per Bot API call')
+    p.add_argument('--api-429-rate', type=float, default=0.0, help='fraction of send* calls answered 429')
+    p.add_argument('--url-fail-rate', type=float, default=0.0, help='fraction of remote-URL sends Telegram fails to fetch')
+    p.add_argument('--resolver-latency-ms', type=float, default=150, help='latency of every resolver API call')
+    p.add_argument('--resolver-fail-rate', type=float, default=0.0, help='fraction of resolver calls answered 500')
+    p.add_argument('--no-press-buttons', action='store_true', help='do not tap YouTube quality buttons')
+    p.add_argument('--webhook', action='store_true', help='receive updates on the bot\'s webhook server instead of polling')
+    p.add_argument('--settle', type=float, default=1.0, help='quiet seconds that mark the end of the run')
+    p.add_argument('--timeout', type=float, default=600, help='give up after this many seconds')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--label', default='', help='free text stored with the results')
+    p.add_argument('--out', help='result JSON path (default benchmarks/results/e2e-<time>.json)')
+    args = p.parse_args(argv)
+
+    config = {
+        'media_bytes': args.media_kb * 1024, 'cdn_kbps': args.cdn_kbps, 'album_items': args.album_items,
+        'api_latency_ms': args.api_latency_ms, 'api_429_rate': args.api_429_rate, 'url_fail_rate': args.url_fail_rate,
+        'resolver_latency_ms': args.resolver_latency_ms, 'resolver_fail_rate': args.resolver_fail_rate,
+        'press_buttons': not args.no_press_buttons, 'seed': args.seed,
+    }
+    proc, ports, stop = start_fakes(config)
+    bot, offline = load_bot(ports)
+    if args.webhook:
+        bot.WEBHOOK_URL = 'http://127.0.0.1/bench-hook'
+        server = bot.webhook_server('127.0.0.1', 0)
+        bot.WEBHOOK_URL = f'http://127.0.0.1:{server.server_address[1]}/bench-hook'
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        bot.register_webhook()
+    else:
+        threading.Thread(target=bot.bot.polling, kwargs={'non_stop': True, 'interval': 0, 'timeout': 20,
+                                                         'long_polling_timeout': 1}, daemon=True).start()
+
+    mix = parse_mix(args.mix)
+    messages, scenario_of = [], {}
+    for n in range(args.messages):
+        scenario = mix[n % len(mix)]
+        chat_id = 100000 + n
+        link_n = n % args.unique_links if args.unique_links else n
+        messages.append({'chat_id': chat_id, 'text': LINKS[scenario].format(n=link_n)})
+        scenario_of[str(chat_id)] = scenario
+
+    started = time.time()
+    inject(ports['telegram'], messages, args.rate)
+    stats, timed_out = wait_idle(bot, ports['telegram'], set(scenario_of), args.settle, args.timeout)
+    finished = max((c[0] for c in stats['calls']), default=time.time())
+
+    results = summarize(stats, scenario_of, started, finished)
+    results.update({
+        'timed_out': timed_out,
+        'bytes': {
+            'cdn_served': fake_stats(ports['cdn'])['bytes_served'],
+            'uploaded_to_telegram': stats['upload_bytes'],
+            'fetched_by_telegram': stats['fetched_bytes'],
+        },
+        'resolver_requests': fake_stats(ports['resolvers']),
+        'external_requests_blocked': offline.blocked,
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    })
+    report = {
+        'benchmark': 'e2e',
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': git_commit(),
+        'python': sys.version.split()[0],
+        'config': vars(args),
+        'env': {k: os.environ[k] for k in TUNING_ENV if k in os.environ},
+        'results': results,
+        'bot': {'jobs': bot.JOBS.stats(), 'resolve_cache': bot.RESOLVE_CACHE.stats(),
+                'downloads': bot.download_stats(), 'coalesced': bot.FLIGHTS.stats()},
+    }
+    out = Path(args.out) if args.out else RESULTS_DIR / f"e2e-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2))
+
+    lat = results['latency_seconds']
+    print(f"{results['answered']}/{results['requests']} answered, {results['delivered']} delivered media"
+          f"{' (TIMED OUT)' if timed_out else ''}")
+    print(f"{results['requests_per_second']} req/s  p50={lat.get('p50')}s p95={lat.get('p95')}s p99={lat.get('p99')}s")
+    print(f"CDN {results['bytes']['cdn_served'] / 1e6:.1f} MB, uploads {results['bytes']['uploaded_to_telegram'] / 1e6:.1f} MB, "
+          f"peak RSS {results['peak_rss_bytes'] / 1e6:.0f} MB")
+    print(f'Results: {out}')
+    stop.close()
+    proc.join(timeout=5)
+    return report
+
+
+if __name__ == '__main__':
+    main()
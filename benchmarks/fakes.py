@@ -0,0 +1,431 @@
+"""Local stand-ins for the Telegram Bot API, the resolver APIs and a media CDN.
+
+All three servers run in one child process (start_fakes) so the bot under test is
+measured on its own. Each keeps counters readable at GET /__stats.
+"""
+import email
+import itertools
+import json
+import multiprocessing
+import random
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+CHUNK = 64 * 1024
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real services
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+
+# --- CDN -------------------------------------------------------------------------------
+
+class CdnHandler(QuietHandler):
+    """GET/HEAD /media/<name>?size=<bytes>&kbps=<KB/s>: deterministic bytes, Range supported."""
+
+    def do_HEAD(self):
+        self.serve(head=True)
+
+    def do_GET(self):
+        if self.path == '/__stats':
+            with self.server.lock:
+                self.send_json(dict(self.server.stats))
+            return
+        self.serve(head=False)
+
+    def serve(self, head):
+        parsed = urlparse(self.path)
+        q = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        size = int(q.get('size', 1024 * 1024))
+        kbps = float(q.get('kbps', 0))
+        start, end, status = 0, size - 1, 200
+        rng = self.headers.get('Range', '')
+        if rng.startswith('bytes='):
+            first, _, last = rng[6:].partition('-')
+            start = int(first or 0)
+            end = min(int(last), size - 1) if last else size - 1
+            status = 206
+        self.send_response(status)
+        ctype = 'image/jpeg' if parsed.path.endswith('.jpg') else 'video/mp4'
+        self.send_header('Content-Type', ctype)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', f'"{parsed.path}-{size}"')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+        if head:
+            return
+        pattern = bytes(range(256)) * (CHUNK // 256)
+        remaining = end - start + 1
+        began = time.monotonic()
+        sent = 0
+        try:
+            while remaining > 0:
+                n = min(CHUNK, remaining)
+                self.wfile.write(pattern[:n])
+                remaining -= n
+                sent += n
+                if kbps:
+                    ahead = sent / (kbps * 1024) - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        with self.server.lock:
+            self.server.stats['bytes_served'] += sent
+
+
+# --- Resolver APIs -----------------------------------------------------------------------
+
+class ResolverHandler(QuietHandler):
+    """Answers like the hazex / workers.dev resolvers, pointing at the fake CDN."""
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == '/__stats':
+            with self.server.lock:
+                self.send_json(dict(self.server.stats))
+            return
+        cfg = self.server.config
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+        time.sleep(cfg['resolver_latency_ms'] / 1000.0)
+        if random.random() < cfg['resolver_fail_rate'] or parsed.path.startswith('/yt-multi'):
+            with self.server.lock:
+                self.server.stats['failures'] += 1
+            self.send_json({'error': 'upstream failure'}, status=500)
+            return
+        link = parse_qs(parsed.query).get('url', [''])[0]
+        key = quote(link.rstrip('/').rsplit('/', 1)[-1] or 'media', safe='')
+        self.send_json(self.payload(parsed.path, key))
+
+    def media(self, key, ext='mp4', size=None):
+        cfg = self.server.config
+        size = cfg['media_bytes'] if size is None else size
+        return f"{cfg['cdn_base']}/media/{key}.{ext}?size={size}&kbps={cfg['cdn_kbps']}"
+
+    def payload(self, path, key):
+        size = self.server.config['media_bytes']
+        if path.startswith('/yt-legacy'):
+            return {
+                'title': f'Bench video {key}',
+                'video_with_audio': [
+                    {'url': self.media(key + '-360'), 'height': 360, 'extension': 'mp4', 'size_bytes': size, 'label': 'mp4 (360p)'},
+                    {'url': self.media(key + '-720'), 'height': 720, 'extension': 'mp4', 'size_bytes': size * 2, 'label': 'mp4 (720p)'},
+                ],
+                'audio': [{'url': self.media(key + '-a', 'm4a', size // 8), 'extension': 'm4a', 'size_bytes': size // 8, 'label': 'm4a'}],
+            }
+        if path.startswith('/tiktok'):
+            return {'result': {'title': f'Bench tiktok {key}', 'download_url': {'without_watermark': self.media(key)}}}
+        if path.startswith('/insta'):
+            count = self.server.config['album_items']
+            if count > 1:
+                return {'status': True, 'data': [{'url': self.media(f'{key}-{i}', 'jpg' if i % 2 else 'mp4')} for i in range(count)]}
+            return {'status': True, 'data': [{'url': self.media(key)}]}
+        if path.startswith('/tera'):
+            return {'download_link': self.media(key), 'file_name': f'{key}.mp4', 'size': size}
+        return {'url': self.media(key), 'file_name': f'{key}.mp4', 'size_bytes': size}
+
+
+# --- Telegram Bot API ----------------------------------------------------------------------
+
+MEDIA_METHODS = {'sendVideo': 'video', 'sendPhoto': 'photo', 'sendDocument': 'document',
+                 'sendAudio': 'audio', 'sendAnimation': 'animation'}
+
+
+class TelegramState:
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.enqueued = {}  # chat_id -> time the user's message became available
+        self.calls = []  # [time, chat_id, method, ok, upload_bytes]
+        self.upload_bytes = 0
+        self.fetched_bytes = 0
+        self.webhook = None  # {'url', 'secret', 'max_connections'} after setWebhook
+        self.delivering = 0  # updates handed to the webhook but not yet acknowledged
+        self.pusher = None
+
+    def push(self, update):
+        with self.cond:
+            update['update_id'] = next(self.update_ids)
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def pending(self):
+        return len(self.updates) + self.delivering
+
+    def set_webhook(self, params):
+        with self.cond:
+            if str(params.get('drop_pending_updates', '')).lower() == 'true':
+                self.updates = []
+            url = params.get('url')
+            self.webhook = {'url': url, 'secret': params.get('secret_token', ''),
+                            'max_connections': int(params.get('max_connections') or 40)} if url else None
+            if self.webhook and self.pusher is None:
+                self.pusher = threading.Thread(target=self.push_webhook, daemon=True)
+                self.pusher.start()
+            self.cond.notify_all()
+
+    def push_webhook(self):
+        """POST queued updates to the webhook like Telegram does, up to max_connections at once."""
+        pool = None
+        while True:
+            with self.cond:
+                while not (self.webhook and self.updates):
+                    self.cond.wait()
+                hook, batch, self.updates = self.webhook, self.updates, []
+                self.delivering += len(batch)
+            pool = pool or ThreadPoolExecutor(hook['max_connections'])
+            for update in batch:
+                pool.submit(self.post_update, hook, update)
+
+    def post_update(self, hook, update, attempts=5):
+        req = urllib.request.Request(hook['url'], data=json.dumps(update).encode(), method='POST', headers={
+            'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': hook['secret']})
+        for attempt in range(attempts):
+            try:
+                with urllib.request.urlopen(req, timeout=30) as r:
+                    r.read()
+                break
+            except Exception:
+                time.sleep(0.2 * (attempt + 1))
+        with self.cond:
+            self.delivering -= 1
+
+
+class TelegramHandler(QuietHandler):
+    """/bot<token>/<method> with configurable latency, 429s and URL-fetch failures."""
+
+    def do_GET(self):
+        self.handle_call()
+
+    def do_POST(self):
+        self.handle_call()
+
+    def params(self):
+        parsed = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        body = self.read_body()
+        ctype = self.headers.get('Content-Type', '')
+        uploaded = 0
+        if ctype.startswith('multipart/'):
+            msg = email.message_from_bytes(b'Content-Type: ' + ctype.encode() + b'\r\n\r\n' + body)
+            for part in msg.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                data = part.get_payload(decode=True) or b''
+                if part.get_filename():
+                    uploaded += len(data)
+                    params.setdefault(name, 'attach://' + name)
+                else:
+                    params[name] = data.decode()
+        elif ctype.startswith('application/x-www-form-urlencoded'):
+            params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        elif body and ctype.startswith('application/json'):
+            params.update(json.loads(body))
+        return params, uploaded
+
+    def handle_call(self):
+        state = self.server.state
+        parsed = urlparse(self.path)
+        if parsed.path == '/__stats':
+            with state.lock:
+                self.send_json({'calls': state.calls, 'enqueued': state.enqueued,
+                                'pending_updates': state.pending(), 'upload_bytes': state.upload_bytes,
+                                'fetched_bytes': state.fetched_bytes})
+            return
+        if parsed.path == '/__enqueue':
+            self.enqueue(json.loads(self.read_body()))
+            return
+        method = parsed.path.rsplit('/', 1)[-1]
+        params, uploaded = self.params()
+        if method == 'getUpdates':
+            self.get_updates(params)
+            return
+        if method in ('setWebhook', 'deleteWebhook'):
+            state.set_webhook(params if method == 'setWebhook' else dict(params, url=None))
+        cfg = state.config
+        time.sleep(cfg['api_latency_ms'] / 1000.0)
+        chat_id = params.get('chat_id')
+        status, payload = self.answer(method, params)
+        with state.lock:
+            state.calls.append([time.time(), chat_id, method, payload.get('ok', False), uploaded])
+            state.upload_bytes += uploaded
+        self.send_json(payload, status=status)
+
+    def enqueue(self, request):
+        """POST {"messages": [{"chat_id": int, "text": str}]}: make user messages available."""
+        state = self.server.state
+        now = time.time()
+        for m in request['messages']:
+            user = {'id': m['chat_id'], 'is_bot': False, 'first_name': 'Bench', 'username': f"user{m['chat_id']}"}
+            with state.lock:
+                state.enqueued[str(m['chat_id'])] = now
+                message_id = next(state.message_ids)
+            state.push({'message': {'message_id': message_id, 'date': int(now), 'from': user,
+                                    'chat': {'id': m['chat_id'], 'type': 'private'}, 'text': m['text']}})
+        self.send_json({'ok': True})
+
+    def get_updates(self, params):
+        state = self.server.state
+        offset = int(params.get('offset', 0) or 0)
+        timeout = min(float(params.get('timeout', 0) or 0), 1.0)
+        deadline = time.monotonic() + timeout
+        with state.cond:
+            state.updates = [u for u in state.updates if u['update_id'] >= offset]
+            while not state.updates and time.monotonic() < deadline:
+                state.cond.wait(deadline - time.monotonic())
+            batch = state.updates[:int(params.get('limit', 100) or 100)]
+        self.send_json({'ok': True, 'result': batch})
+
+    def message(self, chat_id, **fields):
+        state = self.server.state
+        with state.lock:
+            message_id = next(state.message_ids)
+        msg = {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+               'chat': {'id': int(chat_id or 0), 'type': 'private'}}
+        msg.update(fields)
+        return msg
+
+    def file(self, kind):
+        state = self.server.state
+        with state.lock:
+            n = next(state.file_ids)
+        base = {'file_id': f'{kind}-{n}', 'file_unique_id': f'u{n}'}
+        if kind == 'photo':
+            return [dict(base, width=640, height=640)]
+        if kind in ('video', 'animation'):
+            return dict(base, width=640, height=360, duration=10)
+        if kind == 'audio':
+            return dict(base, duration=10)
+        return base
+
+    def fetch_remote(self, url):
+        """Telegram downloads remote URLs itself; do the same so the CDN sees the traffic."""
+        state = self.server.state
+        if random.random() < state.config['url_fail_rate']:
+            return False
+        try:
+            with urllib.request.urlopen(url, timeout=30) as r:
+                n = 0
+                while True:
+                    chunk = r.read(CHUNK)
+                    if not chunk:
+                        break
+                    n += len(chunk)
+            with state.lock:
+                state.fetched_bytes += n
+            return True
+        except Exception:
+            return False
+
+    def answer(self, method, params):
+        cfg = self.server.state.config
+        chat_id = params.get('chat_id')
+        if method in ('getMe',):
+            return 200, {'ok': True, 'result': BOT_USER}
+        if method in ('deleteWebhook', 'setWebhook', 'deleteMessage', 'answerCallbackQuery'):
+            return 200, {'ok': True, 'result': True}
+        if method.startswith('send') and random.random() < cfg['api_429_rate']:
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                         'parameters': {'retry_after': 1}}
+        if method in MEDIA_METHODS:
+            kind = MEDIA_METHODS[method]
+            media = params.get(kind, '')
+            if media.startswith('http') and not self.fetch_remote(media):
+                return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: failed to get HTTP URL content'}
+            msg = self.message(chat_id, **{kind: self.file(kind)}, caption=params.get('caption'))
+            if params.get('reply_markup'):
+                msg['reply_markup'] = json.loads(params['reply_markup'])  # echoed like the real Bot API
+            self.maybe_press_button(msg, params)
+            return 200, {'ok': True, 'result': msg}
+        if method == 'sendMediaGroup':
+            items = json.loads(params.get('media', '[]'))
+            for item in items:
+                if item['media'].startswith('http') and not self.fetch_remote(item['media']):
+                    return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: failed to get HTTP URL content'}
+            return 200, {'ok': True, 'result': [self.message(chat_id, media_group_id='g', **{item['type']: self.file(item['type'])})
+                                                  for item in items]}
+        if method in ('sendMessage', 'editMessageText'):
+            msg = self.message(chat_id, text=params.get('text', ''))
+            self.maybe_press_button(msg, params)
+            return 200, {'ok': True, 'result': msg}
+        return 200, {'ok': True, 'result': True}
+
+    def maybe_press_button(self, msg, params):
+        """Tap the first YouTube quality button the bot offers, like a user would."""
+        if not self.server.state.config['press_buttons'] or not params.get('reply_markup'):
+            return
+        markup = json.loads(params['reply_markup'])
+        for row in markup.get('inline_keyboard', []):
+            for button in row:
+                data = button.get('callback_data') or ''
+                if data.startswith('ytupload:'):
+                    user = {'id': msg['chat']['id'], 'is_bot': False, 'first_name': 'Bench'}
+                    self.server.state.push({'callback_query': {'id': str(msg['message_id']), 'from': user,
+                                                               'message': msg, 'chat_instance': 'bench', 'data': data}})
+                    return
+
+
+# --- Process wrapper -----------------------------------------------------------------------
+
+def make_server(handler, **attrs):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    for k, v in attrs.items():
+        setattr(server, k, v)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve(config, conn):
+    """Child process entry point: start every fake and report their ports."""
+    random.seed(config.get('seed', 0))
+    cdn = make_server(CdnHandler, stats={'requests': 0, 'bytes_served': 0})
+    config = dict(config, cdn_base=f'http://127.0.0.1:{cdn.server_address[1]}')
+    resolvers = make_server(ResolverHandler, config=config, stats={'requests': 0, 'failures': 0})
+    telegram = make_server(TelegramHandler, state=TelegramState(config))
+    conn.send({'cdn': cdn.server_address[1], 'resolvers': resolvers.server_address[1],
+               'telegram': telegram.server_address[1]})
+    try:
+        conn.recv()  # blocks until the parent closes its end or exits
+    except EOFError:
+        pass
+
+
+def start_fakes(config):
+    """Start the fakes in a child process; returns (process, ports, stop_conn)."""
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe()
+    proc = ctx.Process(target=serve, args=(config, child), daemon=True)
+    proc.start()
+    ports = parent.recv()
+    return proc, ports, parent
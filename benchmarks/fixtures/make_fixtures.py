@@ -0,0 +1,170 @@
+"""Regenerate the synthetic fixture corpus in this directory.
+
+The files mimic the shape and size of real upstream responses (field names, nesting,
+signed-URL lengths, page bloat) but contain no captured user data. A real capture can
+replace any file as long as it keeps the name. Run: python -m benchmarks.fixtures.make_fixtures
+"""
+import json
+import random
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+rng = random.Random(1234)
+
+
+def token(n):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-') for _ in range(n))
+
+
+def googlevideo(itag, clen):
+    return (f'https://rr3---sn-{token(8)}.googlevideo.com/videoplayback?expire=1893456000&ei={token(20)}'
+            f'&ip=203.0.113.7&id=o-{token(40)}&itag={itag}&source=youtube&requiressl=yes&mime=video%2Fmp4'
+            f'&clen={clen}&dur=212.400&lmt=1700000000000000&sig={token(90)}&lsig={token(70)}')
+
+
+def cdninstagram(name, ext):
+    return (f'https://scontent-ams2-1.cdninstagram.com/v/t51.2885-15/{name}.{ext}?stp=dst-jpg_e35&_nc_ht=scontent.cdninstagram.com'
+            f'&_nc_cat=1&_nc_ohc={token(16)}&edm={token(8)}&ccb=7-5&oh=00_{token(40)}&oe=6F000000&_nc_sid={token(6)}')
+
+
+CAPTION = ('Golden hour at the harbour 🌅 Shot on a windy evening, no filters.\n.\n.\n'
+           'Follow @someone for more!\n#sunset #harbour #photography #travel #nofilter #goldenhour')
+
+
+def youtube_legacy():
+    heights = [144, 240, 360, 480, 720, 1080, 1440, 2160]
+    return {
+        'title': 'Synthetic benchmark video — a long title with unicode ✓ and punctuation!',
+        'thumbnail': 'https://i.ytimg.com/vi/abcdefghijk/maxresdefault.jpg',
+        'duration': 212,
+        'video_with_audio': [{'url': googlevideo(18 + i, 1_000_000 * (i + 1)), 'label': f'mp4 ({h}p)', 'height': h,
+                              'width': h * 16 // 9, 'extension': 'mp4'} for i, h in enumerate(heights[:4])],
+        'video_only': [{'url': googlevideo(133 + i, 3_000_000 * (i + 1)), 'label': f'mp4 ({h}p)', 'height': h,
+                        'width': h * 16 // 9, 'extension': 'mp4', 'fps': 30} for i, h in enumerate(heights)]
+                      + [{'url': googlevideo(278 + i, 2_500_000 * (i + 1)), 'label': f'webm ({h}p)', 'height': h,
+                          'extension': 'webm', 'fps': 30} for i, h in enumerate(heights)],
+        'audio': [{'url': googlevideo(139 + i, 400_000 * (i + 1)), 'label': f'{ext} ({br}kbps)', 'bitrate': br,
+                   'extension': ext} for i, (ext, br) in enumerate([('m4a', 48), ('m4a', 128), ('webm', 70), ('webm', 160)])],
+    }
+
+
+def youtube_task():
+    formats = []
+    for i, h in enumerate([144, 240, 360, 480, 720, 1080] * 3):
+        formats.append({'url': googlevideo(100 + i, 1_500_000 * (i + 1)), 'quality': f'{h}p', 'ext': 'mp4' if i % 3 else 'webm',
+                        'filesize': 1_500_000 * (i + 1), 'vcodec': 'avc1.4d401f', 'acodec': 'none' if i % 2 else 'mp4a.40.2',
+                        'height': h})
+    return {'status': 'finished', 'task_id': token(24), 'progress': 100,
+            'data': {'title': 'Synthetic multi-step task', 'duration': 212, 'formats': formats,
+                     'thumbnails': [{'url': f'https://i.ytimg.com/vi/x/{n}.jpg', 'width': n * 10} for n in range(12)]}}
+
+
+def ytdlp_info():
+    formats = []
+    for i in range(48):
+        h = [144, 240, 360, 480, 720, 1080, 1440, 2160][i % 8]
+        kind = i % 3  # 0 video-only, 1 audio-only, 2 muxed
+        formats.append({
+            'format_id': str(100 + i), 'url': googlevideo(100 + i, 2_000_000 + i * 750_000), 'ext': ['mp4', 'm4a', 'mp4'][kind],
+            'height': None if kind == 1 else h, 'width': None if kind == 1 else h * 16 // 9,
+            'vcodec': 'none' if kind == 1 else 'avc1.64001F', 'acodec': 'none' if kind == 0 else 'mp4a.40.2',
+            'filesize': 2_000_000 + i * 750_000, 'tbr': 300.0 + i, 'format_note': f'{h}p',
+            'http_headers': {'User-Agent': 'Mozilla/5.0', 'Accept': 'text/html', 'Accept-Language': 'en-us,en;q=0.5'},
+            'fragments': [{'url': f'sq/{n}', 'duration': 5.0} for n in range(40)] if i % 5 == 0 else None,
+            'downloader_options': {'http_chunk_size': 10485760}, 'protocol': 'https',
+        })
+    return {
+        'id': 'abcdefghijk', 'title': 'Synthetic yt-dlp info dict', 'description': CAPTION * 4,
+        'formats': formats, 'duration': 212, 'uploader': 'bench',
+        'thumbnails': [{'url': f'https://i.ytimg.com/vi/abcdefghijk/{n}.jpg', 'preference': -n, 'id': str(n)} for n in range(40)],
+        'subtitles': {lang: [{'ext': 'vtt', 'url': f'https://www.youtube.com/api/timedtext?lang={lang}&{token(60)}'}]
+                      for lang in ('en', 'de', 'fr', 'es', 'it', 'pt', 'ru', 'ja', 'ko', 'zh')},
+        'tags': [f'tag{n}' for n in range(30)], 'categories': ['Entertainment'],
+    }
+
+
+def sidecar_nodes(count):
+    nodes = []
+    for i in range(count):
+        video = i % 3 == 0
+        node = {'__typename': 'GraphVideo' if video else 'GraphImage', 'id': str(10_000 + i), 'shortcode': token(11),
+                'display_url': cdninstagram(f'img{i}', 'jpg'),
+                'display_resources': [{'src': cdninstagram(f'img{i}_{w}', 'jpg'), 'config_width': w} for w in (640, 750, 1080)],
+                'dimensions': {'height': 1350, 'width': 1080}, 'accessibility_caption': 'Photo by bench.',
+                'edge_media_to_tagged_user': {'edges': []}}
+        if video:
+            node['video_url'] = cdninstagram(f'vid{i}', 'mp4')
+            node['video_view_count'] = 1000 + i
+        nodes.append({'node': node})
+    return nodes
+
+
+def instagram_media(count):
+    return {'__typename': 'GraphSidecar', 'id': '3100000000000000000', 'shortcode': 'C0BENCH0001',
+            'edge_media_to_caption': {'edges': [{'node': {'text': CAPTION}}]},
+            'edge_sidecar_to_children': {'edges': sidecar_nodes(count)},
+            'edge_media_to_comment': {'count': 40, 'edges': [{'node': {'text': f'nice shot {n} 🔥', 'id': str(n),
+                                                                       'owner': {'username': f'user{n}'}}} for n in range(40)]},
+            'owner': {'username': 'bench', 'full_name': 'Bench Mark', 'is_verified': False}}
+
+
+def instagram_api():
+    media = sidecar_nodes(10)
+    return {'status': True, 'creator': 'api', 'data': [
+        {'url': n['node'].get('video_url') or n['node']['display_url'], 'thumbnail': n['node']['display_url'],
+         'type': 'video' if 'video_url' in n['node'] else 'image', 'extension': 'mp4' if 'video_url' in n['node'] else 'jpg'}
+        for n in media], 'result': {'caption': CAPTION, 'graphql': {'shortcode_media': instagram_media(10)}}}
+
+
+def instagram_html():
+    filler_css = ''.join(f'.x{token(6)}{{margin:{n}px;padding:{n % 7}px;color:#{n % 999:03d}}}' for n in range(4000))
+    filler_js = ''.join(f'<script src="https://static.cdninstagram.com/rsrc.php/v3/{token(10)}.js" async></script>' for _ in range(200))
+    next_data = {'props': {'pageProps': {'post': {'graphql': {'shortcode_media': instagram_media(10)}},
+                                         'relay': {f'k{n}': {'v': token(40)} for n in range(300)}}},
+                 'page': '/p/[shortcode]', 'buildId': token(20)}
+    trailing = ''.join(f'<div class="x{token(6)}"><span>{token(30)}</span></div>' for _ in range(3000))
+    return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>Instagram</title><style>{filler_css}</style>{filler_js}</head>'
+            f'<body><div id="root"></div><script type="application/json" id="__NEXT_DATA__">{json.dumps(next_data)}</script>'
+            f'{trailing}</body></html>')
+
+
+def tiktok():
+    return {'status': 'success', 'result': {
+        'title': 'Synthetic TikTok #fyp #bench', 'profile_name': 'bench', 'duration': 31,
+        'download_url': {'without_watermark': f'https://v16m.tiktokcdn.com/{token(32)}/video.mp4?{token(120)}',
+                         'with_watermark': f'https://v16m.tiktokcdn.com/{token(32)}/wm.mp4?{token(120)}'},
+        'audio': f'https://sf16.tiktokcdn.com/{token(32)}/music.mp3',
+        'stats': {'plays': 123456, 'likes': 7890, 'comments': 12, 'shares': 3},
+        'author': {'id': '1', 'nickname': 'bench', 'avatar': f'https://p16.tiktokcdn.com/{token(40)}.jpeg'}}}
+
+
+def terabox():
+    return {'status': 'success', 'file_name': 'Synthetic Terabox File.mp4', 'size': '73400320',
+            'download_link': f'https://d.1024tera.com/file/{token(32)}?fid={token(40)}&dstime=1700000000&sign={token(60)}',
+            'proxy_url': f'https://proxy.example.workers.dev/?url={token(200)}',
+            'thumbs': {f'url{n}': f'https://thumb.1024tera.com/{token(40)}' for n in range(1, 4)}}
+
+
+def social_dl():
+    return {'success': True, 'data': {'title': 'Synthetic generic post', 'medias': [
+        {'url': f'https://video.twimg.com/ext_tw_video/{token(19)}/pu/vid/{w}x{h}/{token(16)}.mp4?tag=12',
+         'quality': f'{h}p', 'extension': 'mp4', 'size': w * h * 7} for w, h in ((480, 270), (640, 360), (1280, 720))]}}
+
+
+FIXTURES = {
+    'youtube_legacy.json': youtube_legacy, 'youtube_task.json': youtube_task, 'ytdlp_info.json': ytdlp_info,
+    'instagram_api.json': instagram_api, 'tiktok.json': tiktok, 'terabox.json': terabox, 'social_dl.json': social_dl,
+}
+
+
+def main():
+    for name, make in FIXTURES.items():
+        (HERE / name).write_text(json.dumps(make(), ensure_ascii=False, indent=1))
+    (HERE / 'instagram_post.html').write_text(instagram_html())
+    for path in sorted(HERE.iterdir()):
+        if path.suffix in ('.json', '.html'):
+            print(f'{path.name:24} {path.stat().st_size / 1024:8.1f} KB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""Fixture-replay micro-benchmarks for the response parsers in bot.py.
+
+Each case feeds a recorded-shape payload from benchmarks/fixtures/ to one parser, times it
+over many calls and measures allocations for a single call with tracemalloc. Results are
+compared with benchmarks/parser_budgets.json; the run exits with status 1 when a case is
+slower (median per call) or allocates more (peak) than its budget.
+
+    python -m benchmarks.parser_bench
+    python -m benchmarks.parser_bench --only instagram --min-time 1
+    python -m benchmarks.parser_bench --write-budgets 3   # budgets = 3x this machine's numbers
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+BUDGETS = Path(__file__).resolve().parent / 'parser_budgets.json'
+
+
+def load_bot():
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456:BENCHMARK')
+    os.environ.setdefault('FILE_ID_CACHE_PATH', '')
+    sys.path.insert(0, str(ROOT))
+    import bot
+    # Parsers log at INFO; keep handler I/O out of the numbers
+    logging.getLogger().setLevel(logging.WARNING)
+    return bot
+
+
+def fixture(name):
+    text = (FIXTURES / name).read_text(encoding='utf-8')
+    return json.loads(text) if name.endswith('.json') else text
+
+
+def build_cases(bot):
+    """(name, callable) pairs. Inputs are loaded up front so only the parser is measured."""
+    legacy = fixture('youtube_legacy.json')
+    task = fixture('youtube_task.json')
+    info = fixture('ytdlp_info.json')
+    insta_api = fixture('instagram_api.json')
+    insta_html = fixture('instagram_post.html')
+    tiktok = fixture('tiktok.json')
+    terabox = fixture('terabox.json')
+    social = fixture('social_dl.json')
+    insta_bytes = insta_html.encode('utf-8')
+    insta_chunks = [insta_bytes[i:i + 16384] for i in range(0, len(insta_bytes), 16384)]  # as iter_content yields them
+    caption_media = insta_api['result']['graphql']['shortcode_media']
+    raw_caption = ('  ' + insta_api['result']['caption'] + '\n\n') * 20
+    cases = [
+        ('scan_payload/instagram_api', lambda: bot.scan_payload(insta_api)),
+        ('scan_payload/ytdlp_info', lambda: bot.scan_payload(info)),
+        ('find_download_entries/instagram_api', lambda: bot.find_download_entries(insta_api)),
+        ('find_download_entries/ytdlp_info', lambda: bot.find_download_entries(info)),
+        ('find_download_entries/youtube_task', lambda: bot.find_download_entries(task)),
+        ('find_download_entries/tiktok', lambda: bot.find_download_entries(tiktok)),
+        ('find_download_entries/social_dl', lambda: bot.find_download_entries(social)),
+        ('choose_entry/instagram_api', lambda: bot.choose_entry(bot.find_download_entries(insta_api))),
+        ('choose_entry/social_dl', lambda: bot.choose_entry(bot.find_download_entries(social))),
+        ('extract_instagram_caption/api', lambda: bot.extract_instagram_caption(insta_api)),
+        ('extract_instagram_caption/media', lambda: bot.extract_instagram_caption(caption_media)),
+        ('clean_caption/long', lambda: bot.clean_caption(raw_caption)),
+        ('parse_instagram_html/next_data', lambda: bot.parse_instagram_html(insta_html)),
+        ('parse_instagram_chunks/next_data', lambda: bot.parse_instagram_chunks(iter(insta_chunks))),
+        ('normalize_legacy_youtube', lambda: bot.normalize_legacy_youtube(legacy)),
+        ('normalize_youtube_task', lambda: bot.normalize_youtube_task(task, 'title', {})),
+        ('normalize_ytdlp_formats', lambda: bot.normalize_ytdlp_formats(info)),
+        ('parse_terabox_response', lambda: bot.parse_terabox_response(terabox)),
+    ]
+    return cases
+
+
+def time_case(fn, min_time, repeats):
+    """Median/min seconds per call over `repeats` rounds of roughly `min_time / repeats` each."""
+    fn()  # warm caches (regex compile, lazy imports)
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time / repeats or number >= 1 << 20:
+            break
+        number *= 2
+    rounds = [elapsed / number]
+    for _ in range(repeats - 1):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - t0) / number)
+    return statistics.median(rounds), min(rounds), number
+
+
+def alloc_case(fn):
+    """(peak bytes, bytes still held by the result) for one call."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        result = fn()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak - base, current - base
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--only', help='run cases whose name contains this text')
+    ap.add_argument('--min-time', type=float, default=0.5, help='seconds of timing per case')
+    ap.add_argument('--repeats', type=int, default=5)
+    ap.add_argument('--budgets', default=str(BUDGETS))
+    ap.add_argument('--write-budgets', type=float, metavar='FACTOR',
+                    help='write FACTOR x the measured numbers as the new budgets and exit 0')
+    ap.add_argument('--out', help='JSON results path (default benchmarks/results/parsers-<time>.json)')
+    args = ap.parse_args(argv)
+
+    bot = load_bot()
+    budgets = {}
+    if os.path.exists(args.budgets) and not args.write_budgets:
+        with open(args.budgets, encoding='utf-8') as f:
+            budgets = json.load(f)
+
+    results, failures = [], []
+    print(f"{'case':40} {'median':>10} {'best':>10} {'peak KB':>9} {'kept KB':>9}  budget")
+    for name, fn in build_cases(bot):
+        if args.only and args.only not in name:
+            continue
+        median, best, number = time_case(fn, args.min_time, args.repeats)
+        peak, kept = alloc_case(fn)
+        row = {'case': name, 'median_us': round(median * 1e6, 2), 'best_us': round(best * 1e6, 2),
+               'calls_per_round': number, 'peak_kb': round(peak / 1024, 1), 'kept_kb': round(kept / 1024, 1)}
+        verdict = ''
+        budget = budgets.get(name)
+        if budget:
+            over = []
+            if budget.get('max_us') is not None and row['median_us'] > budget['max_us']:
+                over.append(f"time {row['median_us']}us > {budget['max_us']}us")
+            if budget.get('max_peak_kb') is not None and row['peak_kb'] > budget['max_peak_kb']:
+                over.append(f"peak {row['peak_kb']}KB > {budget['max_peak_kb']}KB")
+            row['budget'] = budget
+            row['over_budget'] = over
+            verdict = 'OVER: ' + '; '.join(over) if over else 'ok'
+            if over:
+                failures.append(name)
+        results.append(row)
+        print(f"{name:40} {row['median_us']:>8.1f}us {row['best_us']:>8.1f}us {row['peak_kb']:>9.1f} "
+              f"{row['kept_kb']:>9.1f}  {verdict}")
+
+    if args.write_budgets:
+        # Floors keep the tiny cases from failing on interpreter noise
+        new = {r['case']: {'max_us': max(50.0, round(r['median_us'] * args.write_budgets, -1)),
+                           'max_peak_kb': max(16.0, round(r['peak_kb'] * args.write_budgets))} for r in results}
+        with open(args.budgets, 'w', encoding='utf-8') as f:
+            json.dump(new, f, indent=2)
+            f.write('\n')
+        print(f'wrote {len(new)} budgets to {args.budgets}')
+        return 0
+
+    out = args.out or str(ROOT / 'benchmarks' / 'results' / f"parsers-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump({'commit': git_commit(), 'python': platform.python_version(), 'machine': platform.machine(),
+                   'min_time': args.min_time, 'repeats': args.repeats, 'results': results,
+                   'over_budget': failures}, f, indent=2)
+    print(f'results: {out}')
+    if failures:
+        print(f'{len(failures)} case(s) over budget: {", ".join(failures)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
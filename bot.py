@@ -1,21 +1,43 @@
 import os
-print("🚀 Process started! Initializing imports...", flush=True)
+import multiprocessing
+# yt-dlp worker processes (see YtdlProcessPool) re-import this file only to reach ytdl_extract;
+# they skip the start-up banner and telebot's update threads
+YTDL_WORKER_PROCESS = multiprocessing.current_process().name.startswith('ytdl-')
+if not YTDL_WORKER_PROCESS:
+    print("🚀 Process started! Initializing imports...", flush=True)
 import re
+import json
 import requests
 import logging
 import tempfile
 import shutil
 import time
-import itertools
 import subprocess
 import zipfile
+import queue
+import sqlite3
+import threading
+import atexit
+import uuid
+import hmac
+import hashlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from html import escape
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from http.cookiejar import DefaultCookiePolicy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
-from urllib.parse import quote_plus
+from urllib.parse import quote_plus, urlparse, parse_qsl, urlencode
 from pathlib import Path
 
 try:
     import telebot
-    from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+    from telebot import apihelper
+    from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo, Update, CallbackQuery
 except Exception:
     raise SystemExit('Missing dependency: install from requirements.txt')
 
@@ -42,7 +64,26 @@ if not TOKEN:
         '   Or set environment variable: $env:TELEGRAM_TOKEN="your_token"'
     )
 
-bot = telebot.TeleBot(TOKEN, parse_mode='HTML')
+# Worker pools: quick handlers (commands, button presses) run on telebot's own threads,
+# slow jobs (resolve, download, ffmpeg, upload) on a separate bounded job pool
+FAST_WORKERS = int(os.getenv('FAST_WORKERS', '4'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '100'))  # jobs allowed to wait for a free worker
+
+# Update ingestion: long polling (default) or a webhook served by the bot itself
+BOT_MODE = os.getenv('BOT_MODE', 'polling').strip().lower()  # 'polling' or 'webhook'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # public https URL Telegram posts updates to
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT') or os.getenv('PORT') or '8443')
+# Sent back by Telegram in X-Telegram-Bot-Api-Secret-Token; derived from the token when unset
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f'webhook:{TOKEN}'.encode()).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # parallel update deliveries
+DROP_PENDING_UPDATES = os.getenv('DROP_PENDING_UPDATES', '1').lower() not in ('0', 'false', 'no')
+# >0: this process only receives updates and routes them by chat to that many worker processes
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+bot = telebot.TeleBot(TOKEN, parse_mode='HTML', num_threads=FAST_WORKERS, threaded=not YTDL_WORKER_PROCESS)
 
 # Bot brand username for consistent signature
 BOT_BRAND = 'Pocket Downloader Bot'
@@ -67,11 +108,480 @@ URL_RE = re.compile(r'(https?://[^\s]+)')
 # Configurable limits
 MAX_UPLOAD = int(os.getenv('MAX_UPLOAD_MB', '50')) * 1024 * 1024  # default 50MB
 LOCAL_DOWNLOAD_LIMIT = MAX_UPLOAD  # do not locally download more than upload limit
+MEDIA_GROUP_LIMIT = 10  # Telegram sends 2-10 items per media group
+ALBUM_PREFETCH_WORKERS = int(os.getenv('ALBUM_PREFETCH_WORKERS', '4'))  # parallel local downloads per album
 DOWNLOAD_TIMEOUT = 120  # seconds
+DOWNLOAD_SEGMENTS = int(os.getenv('DOWNLOAD_SEGMENTS', '4'))  # parallel Range connections per file; 1 disables
+SEGMENT_MIN_SIZE = int(os.getenv('SEGMENT_MIN_SIZE_MB', '4')) * 1024 * 1024  # smaller files use a single stream
+MUX_TIMEOUT = int(os.getenv('MUX_TIMEOUT', '300'))  # seconds per ffmpeg run (streaming mux includes the download)
+# Codecs the MP4 container holds as-is; anything else is transcoded during the mux
+MP4_VIDEO_CODECS = {'h264', 'hevc', 'av1', 'vp9', 'mpeg4'}
+MP4_AUDIO_CODECS = {'aac', 'mp3', 'alac', 'ac3', 'eac3'}
+DOWNLOAD_RESUME_ATTEMPTS = int(os.getenv('DOWNLOAD_RESUME_ATTEMPTS', '3'))  # per stream / segment after a dropped connection
+RESUME_FLUSH_BYTES = 1024 * 1024  # segmented downloads in a job spool record progress at this granularity
 
 # Progress tracking for downloads
 DOWNLOAD_PROGRESS = {}  # {chat_id: {'msg_id': int, 'percent': float}}
 
+# Shared HTTP client: keep-alive pools so resolver hops reuse TCP/TLS connections
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', str(max(16, JOB_WORKERS * 4))))  # max connections kept per host
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))  # seconds
+DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+BROWSER_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+# Extra headers per host (matched on the host or any subdomain of it)
+HOST_HEADERS = {
+    'instagram.com': {'User-Agent': BROWSER_USER_AGENT, 'Accept-Language': 'en-US,en;q=0.9'},
+}
+
+# Resolution cache (normalized URL -> handle_api_for_url result)
+RESOLVE_CACHE_SIZE = int(os.getenv('RESOLVE_CACHE_SIZE', '512'))  # entries; 0 disables
+RESOLVE_CACHE_TTL = int(os.getenv('RESOLVE_CACHE_TTL', '1800'))  # seconds, upper bound per entry
+RESOLVE_CACHE_EXPIRY_MARGIN = 60  # drop entries this many seconds before signed media URLs expire
+# Query parameters that never change what a link resolves to: utm_* and these on every host...
+TRACKING_PARAMS = {'fbclid', 'gclid'}
+# ...and share/tracking params only on the platform that adds them (matched on the host or any
+# subdomain of it); elsewhere names like 'ref' or 'pp' may select different content
+HOST_TRACKING_PARAMS = {
+    'instagram.com': {'igsh', 'igshid', 'img_index'},
+    'youtube.com': {'si', 'feature', 'pp'},
+    'youtu.be': {'si', 'feature', 'pp'},
+    'tiktok.com': {'is_from_webapp', 'sender_device', 'share_app_id'},
+    'twitter.com': {'ref_src', 'ref_url'},
+    'x.com': {'ref_src', 'ref_url'},
+}
+
+# Concurrent resolver races
+RESOLVER_WORKERS = int(os.getenv('RESOLVER_WORKERS', '16'))  # threads shared by all resolver races
+INSTA_RESOLVE_MODE = os.getenv('INSTA_RESOLVE_MODE', 'race').lower()  # 'race' or 'sequential'
+INSTA_HEDGE_DELAY = float(os.getenv('INSTA_HEDGE_DELAY', '0'))  # seconds between launching each Instagram API
+INSTA_YTDLP_GRACE = float(os.getenv('INSTA_YTDLP_GRACE', '1'))  # race mode: seconds yt-dlp may lag a usable API answer
+TERABOX_DEADLINE = float(os.getenv('TERABOX_DEADLINE', '60'))  # seconds for the whole Terabox race
+INSTA_DEADLINE = float(os.getenv('INSTA_DEADLINE', '30'))  # seconds for the whole Instagram API race
+INSTA_SCRAPE_MAX_PAGE_BYTES = int(os.getenv('INSTA_SCRAPE_MAX_PAGE_BYTES', str(8 * 1024 * 1024)))  # stop reading a post page after this
+INSTA_SCRAPE_MAX_JSON_BYTES = int(os.getenv('INSTA_SCRAPE_MAX_JSON_BYTES', str(2 * 1024 * 1024)))  # largest embedded JSON block kept
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))  # consecutive failures that open a breaker
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '60'))  # first cooldown before a half-open probe
+CIRCUIT_MAX_OPEN_SECONDS = float(os.getenv('CIRCUIT_MAX_OPEN_SECONDS', '900'))  # cooldown doubles up to this
+HEALTH_EWMA_ALPHA = float(os.getenv('HEALTH_EWMA_ALPHA', '0.2'))  # weight of the newest sample in rolling stats
+
+# yt-dlp: reusable YoutubeDL instances per option profile
+YTDLP_POOL_SIZE = int(os.getenv('YTDLP_POOL_SIZE', '4'))  # idle instances kept per profile
+YTDLP_CACHE_DIR = os.getenv('YTDLP_CACHE_DIR', '')  # on-disk extractor/signature cache; empty = yt-dlp's default
+YTDLP_PREWARM = [p.strip() for p in os.getenv('YTDLP_PREWARM', 'instagram').split(',') if p.strip()]  # built at startup
+YTDLP_PROCESSES = int(os.getenv('YTDLP_PROCESSES', '2'))  # worker processes for yt-dlp calls; 0 runs them in-thread
+YTDLP_TASKS_PER_CHILD = int(os.getenv('YTDLP_TASKS_PER_CHILD', '50'))  # a worker is replaced after this many calls
+YTDLP_TIMEOUT = float(os.getenv('YTDLP_TIMEOUT', '90'))  # seconds per extraction call
+YTDLP_DOWNLOAD_TIMEOUT = float(os.getenv('YTDLP_DOWNLOAD_TIMEOUT', '600'))  # seconds per download call
+
+# Telegram file_id reuse: repeat media is re-sent by reference instead of re-uploaded
+FILE_ID_CACHE_PATH = os.getenv('FILE_ID_CACHE_PATH', str(Path(__file__).parent / 'file_ids.db'))  # empty disables
+
+# Prometheus-format metrics, served only when METRICS_PORT is set
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 disables the /metrics endpoint
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2)
+
+
+class Metrics:
+    """In-process counters, gauges and histograms rendered in Prometheus text format."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help, buckets)
+        self._values = {}  # name -> {labels: value | [bucket counts..., sum, count]}
+        self._gauges = {}  # name -> fn returning the current value
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+        self._values[name] = {}
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help_text, tuple(buckets))
+        self._values[name] = {}
+
+    def gauge(self, name, help_text, fn):
+        self._meta[name] = ('gauge', help_text, None)
+        self._gauges[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self._meta[name][2]
+        with self._lock:
+            series = self._values[name]
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            snapshot = {name: dict(series) for name, series in self._values.items()}
+        for name, (kind, help_text, buckets) in self._meta.items():
+            full = self.prefix + name
+            lines.append(f'# HELP {full} {help_text}')
+            lines.append(f'# TYPE {full} {kind}')
+            if kind == 'gauge':
+                try:
+                    lines.append(f'{full} {self._gauges[name]()}')
+                except Exception:
+                    LOG.exception('Gauge %s failed', name)
+                continue
+            for key, value in snapshot[name].items():
+                if kind == 'counter':
+                    lines.append(f'{full}{self._labels(key)} {value}')
+                    continue
+                for bound, count in zip(buckets + ('+Inf',), value[:-2] + [value[-1]]):
+                    lines.append(f'{full}_bucket{self._labels(key + (("le", bound),))} {count}')
+                lines.append(f'{full}_sum{self._labels(key)} {value[-2]}')
+                lines.append(f'{full}_count{self._labels(key)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics('mediabot_')
+METRICS.histogram('resolve_seconds', 'Time to resolve a link to media URLs, per platform.')
+METRICS.histogram('resolver_endpoint_seconds', 'Latency of single resolver API / yt-dlp calls, per endpoint.')
+METRICS.histogram('download_bytes_per_second', 'Throughput of local downloads.', THROUGHPUT_BUCKETS)
+METRICS.counter('download_bytes_total', 'Bytes downloaded locally.')
+METRICS.histogram('mux_seconds', 'ffmpeg video+audio merge time.')
+METRICS.histogram('telegram_api_seconds', 'Telegram Bot API call time (uploads included), per method and media source.')
+METRICS.counter('telegram_sends_total', 'Telegram send* calls by media source (url, upload, file_id) and outcome.')
+METRICS.counter('link_fallbacks_total', 'Media delivered as a download button instead of a file.')
+METRICS.counter('coalesced_requests_total', 'Requests that waited on an identical in-flight job, per kind and outcome.')
+METRICS.histogram('first_response_seconds', 'Time from the user message to the bot\'s first reply.')
+METRICS.histogram('job_wait_seconds', 'Time jobs spend queued before a worker picks them up.')
+METRICS.histogram('job_run_seconds', 'Time jobs spend running on a worker.')
+METRICS.counter('webhook_updates_total', 'Webhook requests by outcome (ok, forbidden, bad_request).')
+
+
+def telegram_media_source(params, files):
+    """'upload' for local files, 'url' for remote URLs, 'file_id' for re-sends, 'none' otherwise."""
+    if files:
+        return 'upload'
+    for field in ('video', 'photo', 'audio', 'document', 'animation', 'media'):
+        value = (params or {}).get(field)
+        if isinstance(value, str):
+            return 'url' if value.startswith('http') or '"media": "http' in value else 'file_id'
+    return 'none'
+
+
+def instrument_telegram_api():
+    """Time every Bot API call (metrics and trace spans) by wrapping telebot's request function."""
+    original = apihelper._make_request
+    if getattr(original, 'instrumented', False):
+        return
+
+    def timed_request(token, method_name, method='get', params=None, files=None):
+        if method_name == 'getUpdates':
+            return original(token, method_name, method=method, params=params, files=files)
+        source = telegram_media_source(params, files)
+        if method_name.startswith('send') and source != 'none':
+            journal_state('uploading')
+        start = time.monotonic()
+        outcome = 'error'
+        try:
+            with span(method_name, media=source if source != 'none' else None):
+                result = original(token, method_name, method=method, params=params, files=files)
+            outcome = 'ok'
+            return result
+        finally:
+            METRICS.observe('telegram_api_seconds', time.monotonic() - start, method=method_name, media=source)
+            if method_name.startswith('send') and source != 'none':
+                METRICS.inc('telegram_sends_total', method=method_name, media=source, outcome=outcome)
+
+    timed_request.instrumented = True
+    apihelper._make_request = timed_request
+
+
+def start_metrics_server(port, host=METRICS_HOST):
+    """Serve METRICS at http://host:port/metrics from a daemon thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = METRICS.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    instrument_telegram_api()
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    LOG.info('Metrics at http://%s:%s/metrics', host, port)
+    return server
+
+
+WEBHOOK_MAX_BODY = 1 << 20  # updates are a few KB; anything larger is not from Telegram
+
+
+def webhook_server(host=WEBHOOK_LISTEN, port=WEBHOOK_PORT):
+    """Bind the webhook HTTP server; updates are handled once serve_forever() runs.
+    Each request is acknowledged before it is dispatched, so Telegram never waits on handlers.
+    """
+    path = urlparse(WEBHOOK_URL).path or '/'
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.split('?')[0] != path:
+                self.send_error(404)
+                return
+            secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+                METRICS.inc('webhook_updates_total', outcome='forbidden')
+                LOG.warning('Webhook request with a wrong secret token from %s', self.client_address[0])
+                self.send_error(403)
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            if not 0 < length <= WEBHOOK_MAX_BODY:
+                METRICS.inc('webhook_updates_total', outcome='bad_request')
+                self.send_error(413 if length else 400)
+                return
+            body = self.rfile.read(length)
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            try:
+                raw = json.loads(body)
+                raw['update_id']
+            except (ValueError, KeyError, TypeError):
+                METRICS.inc('webhook_updates_total', outcome='bad_request')
+                LOG.warning('Ignoring malformed webhook update')
+                return
+            METRICS.inc('webhook_updates_total', outcome='ok')
+            dispatch_raw_update(raw)
+
+        def do_GET(self):
+            self.send_error(405)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    LOG.info('Webhook listening on %s:%s%s', host, server.server_address[1], path)
+    return server
+
+
+def register_webhook():
+    """Point Telegram at WEBHOOK_URL with our secret token."""
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                    allowed_updates=ALLOWED_UPDATES, drop_pending_updates=DROP_PENDING_UPDATES)
+
+
+# Per-request timelines, kept in memory for the admin /trace command
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', '200'))  # finished traces kept
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if x.lstrip('-').isdigit()}
+
+
+class Trace:
+    """Timeline of one user request: spans recorded by every thread working on it.
+    Holders (the handler, a queued job) acquire/release it; the last release files it in TRACES.
+    """
+
+    def __init__(self, label, **attrs):
+        self.id = uuid.uuid4().hex[:8]
+        self.label = label
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._start = time.monotonic()
+        self.duration = None
+        self.spans = []
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    def offset(self):
+        return time.monotonic() - self._start
+
+    def add_span(self, name, start, duration, depth=0, error=None, attrs=None):
+        with self._lock:
+            self.spans.append({'name': name, 'start': start, 'duration': duration, 'depth': depth,
+                               'thread': threading.current_thread().name, 'error': error, 'attrs': attrs or {}})
+
+    def acquire(self):
+        with self._lock:
+            self._refs += 1
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0 or self.duration is not None:
+                return
+            self.duration = self.offset()
+        with _TRACES_LOCK:
+            TRACES.append(self)
+
+
+TRACES = deque(maxlen=TRACE_BUFFER_SIZE)
+_TRACES_LOCK = threading.Lock()
+_TRACE_LOCAL = threading.local()
+
+
+def current_trace():
+    return getattr(_TRACE_LOCAL, 'trace', None)
+
+
+def begin_trace(label, **attrs):
+    """Start a trace for the request handled by this thread and make it current."""
+    trace = Trace(label, **attrs)
+    _TRACE_LOCAL.trace = trace
+    _TRACE_LOCAL.depth = 0
+    return trace
+
+
+def end_trace(trace):
+    """Detach trace from this thread and drop this thread's hold on it."""
+    if current_trace() is trace:
+        _TRACE_LOCAL.trace = None
+    trace.release()
+
+
+@contextmanager
+def bind_trace(trace, depth=0):
+    """Make trace current on this thread (pool workers picking up traced work)."""
+    previous = (current_trace(), getattr(_TRACE_LOCAL, 'depth', 0))
+    _TRACE_LOCAL.trace, _TRACE_LOCAL.depth = trace, depth
+    try:
+        yield
+    finally:
+        _TRACE_LOCAL.trace, _TRACE_LOCAL.depth = previous
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time the enclosed block as a span of the current trace (no-op outside a trace).
+    Yields a dict; keys added to it are stored on the span."""
+    trace = current_trace()
+    extra = {}
+    if trace is None:
+        yield extra
+        return
+    depth = getattr(_TRACE_LOCAL, 'depth', 0)
+    _TRACE_LOCAL.depth = depth + 1
+    start = trace.offset()
+    error = None
+    try:
+        yield extra
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _TRACE_LOCAL.depth = depth
+        trace.add_span(name, start, trace.offset() - start, depth, error, {**attrs, **extra})
+
+
+def traced(fn):
+    """Wrap fn so it runs inside the caller's trace on whichever thread executes it."""
+    trace = current_trace()
+    if trace is None:
+        return fn
+    depth = getattr(_TRACE_LOCAL, 'depth', 0)
+
+    def run(*args, **kwargs):
+        with bind_trace(trace, depth):
+            return fn(*args, **kwargs)
+    return run
+
+
+class TracedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor whose tasks inherit the submitting thread's trace."""
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(traced(fn), *args, **kwargs)
+
+
+def recent_traces():
+    with _TRACES_LOCK:
+        return list(TRACES)
+
+
+def find_trace(trace_id):
+    for trace in recent_traces():
+        if trace.id == trace_id:
+            return trace
+    return None
+
+
+def format_trace(trace):
+    """Timeline of a finished trace as preformatted HTML."""
+    head = f"<b>Trace {trace.id}</b> · {escape(trace.label)} · {trace.duration:.2f}s\n"
+    head += ''.join(f"{escape(k)}: {escape(str(v))[:120]}\n" for k, v in trace.attrs.items())
+    rows = []
+    for sp in sorted(trace.spans, key=lambda sp: sp['start']):
+        attrs = ' '.join(f"{k}={v}" for k, v in sp['attrs'].items() if v is not None)
+        flag = f" !{sp['error']}" if sp['error'] else ''
+        rows.append(f"{sp['start']:7.2f}s {sp['duration']:7.2f}s {'  ' * sp['depth']}{sp['name']}{flag} {attrs}".rstrip())
+    body = '\n'.join(rows) or 'no spans'
+    if len(body) > 3500:
+        body = body[:3500] + '\n…'
+    return head + '<pre>' + escape(body) + '</pre>'
+
+
+_HTTP_SESSION = None
+_HTTP_SESSION_PID = None
+_HTTP_SESSION_LOCK = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Return the process-wide keep-alive session (rebuilt in forked children)."""
+    global _HTTP_SESSION, _HTTP_SESSION_PID
+    pid = os.getpid()
+    if _HTTP_SESSION is None or _HTTP_SESSION_PID != pid:
+        with _HTTP_SESSION_LOCK:
+            if _HTTP_SESSION is None or _HTTP_SESSION_PID != pid:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['User-Agent'] = DEFAULT_USER_AGENT
+                # Requests are made on behalf of many users; never carry cookies between them
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                _HTTP_SESSION = session
+                _HTTP_SESSION_PID = pid
+    return _HTTP_SESSION
+
+
+def http_get(url, timeout=30, headers=None, **kwargs):
+    """GET through the shared session with per-host headers.
+    timeout: read timeout in seconds (connect timeout is capped at HTTP_CONNECT_TIMEOUT),
+    or an explicit (connect, read) tuple.
+    """
+    host = (urlparse(url).hostname or '').lower()
+    merged = {}
+    for suffix, host_headers in HOST_HEADERS.items():
+        if host == suffix or host.endswith('.' + suffix):
+            merged.update(host_headers)
+    if headers:
+        merged.update(headers)
+    if not isinstance(timeout, tuple):
+        timeout = (min(HTTP_CONNECT_TIMEOUT, timeout), timeout)
+    return get_http_session().get(url, headers=merged or None, timeout=timeout, **kwargs)
+
 
 def check_aria2c_available() -> bool:
     """Check if aria2c is available locally or in PATH (unused for Railway)."""
@@ -103,7 +613,7 @@ def ensure_ffmpeg() -> str | None:
         else:
             # Small static build
             url = 'https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-amd64-static.tar.xz'
-        resp = requests.get(url, timeout=60)
+        resp = http_get(url, timeout=60)
         resp.raise_for_status()
         data = resp.content
         if is_win:
@@ -157,6 +667,129 @@ def ensure_ffmpeg() -> str | None:
     return None
 
 
+def run_ffmpeg(cmd, timeout=MUX_TIMEOUT) -> bool:
+    """Run an ffmpeg command; True if it exited cleanly within timeout."""
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        LOG.warning('ffmpeg timed out after %ss', timeout)
+        return False
+    except Exception:
+        LOG.warning('ffmpeg could not be started', exc_info=True)
+        return False
+    if proc.returncode != 0:
+        LOG.warning('ffmpeg exited with %s: %s', proc.returncode, proc.stderr.decode(errors='replace')[-500:])
+        return False
+    return True
+
+
+def find_ffprobe(ffmpeg_path):
+    """ffprobe next to the ffmpeg binary, else from PATH (None if unavailable)."""
+    sibling = Path(ffmpeg_path).with_name('ffprobe.exe' if os.name == 'nt' else 'ffprobe')
+    if sibling.exists():
+        return str(sibling)
+    return shutil.which('ffprobe')
+
+
+def probe_codec(ffprobe_path, source, stream_type):
+    """Codec name of the first video ('v') or audio ('a') stream in a file or URL, or None."""
+    cmd = [ffprobe_path, '-v', 'error', '-select_streams', f'{stream_type}:0',
+           '-show_entries', 'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', source]
+    try:
+        out = subprocess.run(cmd, capture_output=True, timeout=30).stdout.decode(errors='replace').split()
+    except Exception:
+        LOG.warning('ffprobe failed for %s', source, exc_info=True)
+        return None
+    return out[0].lower() if out else None
+
+
+def codec_from_hint(hint):
+    """Map a yt-dlp codec string ('avc1.64001F', 'mp4a.40.2', 'opus') or an audio
+    extension ('m4a', 'webm') to an ffmpeg codec name; None if unknown."""
+    h = (hint or '').lower()
+    for prefixes, codec in ((('avc', 'h264'), 'h264'), (('hev', 'hvc', 'h265'), 'hevc'), (('av01', 'av1'), 'av1'),
+                            (('vp09', 'vp9'), 'vp9'), (('vp8',), 'vp8'), (('mp4a', 'aac', 'm4a'), 'aac'),
+                            (('opus', 'webm'), 'opus'), (('vorbis', 'ogg'), 'vorbis'), (('mp3',), 'mp3')):
+        if h.startswith(prefixes):
+            return codec
+    return None
+
+
+def plan_mux(video_codec, audio_codec):
+    """ffmpeg codec arguments for an MP4 mux: stream copy whatever MP4 can hold, transcode the rest.
+    An unknown video codec is copied (as it always was); unknown audio is transcoded to AAC."""
+    if video_codec is None or video_codec in MP4_VIDEO_CODECS:
+        args = ['-c:v', 'copy']
+    else:
+        args = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23']
+    if audio_codec in MP4_AUDIO_CODECS:
+        args += ['-c:a', 'copy']
+    else:
+        args += ['-c:a', 'aac', '-b:a', '192k']
+    return args
+
+
+def mux_output_ok(out_path: Path) -> bool:
+    if not out_path.exists() or out_path.stat().st_size == 0:
+        return False
+    if out_path.stat().st_size >= LOCAL_DOWNLOAD_LIMIT:
+        # -fs stopped ffmpeg at the limit, so the file is truncated
+        LOG.warning('Muxed file hit the %s byte limit', LOCAL_DOWNLOAD_LIMIT)
+        return False
+    return True
+
+
+def mux_video_audio(ffmpeg_path, video_url, audio_url, audio_ext, workdir: Path, video_hint=None, audio_hint=None):
+    """Merge a video-only and an audio-only stream into workdir/merged.mp4 (moov atom first).
+    Codecs are probed with ffprobe (or taken from video_hint / audio_hint, e.g. yt-dlp's
+    vcodec/acodec) and stream-copied whenever MP4 can hold them.
+    ffmpeg first reads both URLs itself, so downloading and muxing overlap; if that fails the
+    two streams are downloaded concurrently and muxed from disk. Returns the output path or None.
+    """
+    journal_state('muxing')
+    out_path = workdir / 'merged.mp4'
+    video_codec = codec_from_hint(video_hint)
+    audio_codec = codec_from_hint(audio_hint or audio_ext)
+    ffprobe_path = find_ffprobe(ffmpeg_path)
+    if ffprobe_path:
+        video_probe = PROBE_POOL.submit(probe_codec, ffprobe_path, video_url, 'v')
+        audio_probe = PROBE_POOL.submit(probe_codec, ffprobe_path, audio_url, 'a')
+        video_codec = video_probe.result() or video_codec
+        audio_codec = audio_probe.result() or audio_codec
+    codec_args = plan_mux(video_codec, audio_codec)
+    LOG.info('Mux plan: video=%s audio=%s -> %s', video_codec, audio_codec, ' '.join(codec_args))
+    mux_opts = ['-map', '0:v:0', '-map', '1:a:0', *codec_args, '-shortest',
+                '-movflags', '+faststart', '-fs', str(LOCAL_DOWNLOAD_LIMIT)]
+    http_opts = ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+                 '-user_agent', DEFAULT_USER_AGENT]
+    cmd = [ffmpeg_path, '-y', '-loglevel', 'error', *http_opts, '-i', video_url, *http_opts, '-i', audio_url,
+           *mux_opts, str(out_path)]
+    start = time.monotonic()
+    with span('mux', mode='stream', plan=' '.join(codec_args)):
+        streamed = run_ffmpeg(cmd) and mux_output_ok(out_path)
+    METRICS.observe('mux_seconds', time.monotonic() - start, mode='stream', outcome='ok' if streamed else 'error')
+    if streamed:
+        return out_path
+    LOG.warning('Streaming mux failed; downloading both streams before muxing')
+    vpath = workdir / 'video.mp4'
+    apath = workdir / f'audio.{audio_ext}'
+    fetched = {}
+    video_thread = threading.Thread(
+        target=traced(lambda: fetched.update(video=stream_download(video_url, vpath, LOCAL_DOWNLOAD_LIMIT))), daemon=True)
+    video_thread.start()
+    fetched['audio'] = stream_download(audio_url, apath, LOCAL_DOWNLOAD_LIMIT)
+    video_thread.join()
+    if not (fetched.get('video') and fetched['audio']):
+        return None
+    out_path.unlink(missing_ok=True)
+    cmd = [ffmpeg_path, '-y', '-loglevel', 'error', '-i', str(vpath), '-i', str(apath), *mux_opts, str(out_path)]
+    start = time.monotonic()
+    with span('mux', mode='local', plan=' '.join(codec_args)):
+        muxed = run_ffmpeg(cmd) and mux_output_ok(out_path)
+    METRICS.observe('mux_seconds', time.monotonic() - start, mode='local', outcome='ok' if muxed else 'error')
+    return out_path if muxed else None
+
+
 def forward_to_backup_channel(chat_id, file_id, media_type, caption, username):
     """Forward downloaded media to backup channel for archival (optional feature)."""
     if not BACKUP_CHANNEL_ID:
@@ -178,585 +811,1598 @@ def forward_to_backup_channel(chat_id, file_id, media_type, caption, username):
         LOG.warning('Failed to forward to backup channel: %s', e)
 
 
-def stream_download(url: str, dest_path: Path, max_bytes: int, progress_callback=None) -> bool:
-    """Stream download the file to dest_path enforcing max_bytes; return True on success.
-    progress_callback: optional function(downloaded_bytes, total_bytes) for progress updates
+class FileIdCache:
+    """SQLite map of (source key, variant) -> Telegram file_id and media type.
+    source is normalize_url() of the user's link (it embeds the platform media ID);
+    variant distinguishes qualities of the same media ('' for the default delivery).
+    reply_markup keeps the link buttons of the original message (JSON) for re-sends.
     """
-    try:
-        with requests.get(url, stream=True, timeout=30) as r:
-            r.raise_for_status()
-            total_size = int(r.headers.get('content-length', 0))
-            downloaded = 0
-            
-            with open(dest_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=64 * 1024):
-                    if not chunk:
-                        continue
-                    downloaded += len(chunk)
-                    if downloaded > max_bytes:
-                        LOG.warning('File exceeds max_bytes during download (%s > %s)', downloaded, max_bytes)
-                        return False
-                    f.write(chunk)
-                    
-                    # Call progress callback if provided
-                    if progress_callback and total_size > 0:
-                        try:
-                            progress_callback(downloaded, total_size)
-                        except Exception:
-                            pass  # Don't let callback errors stop download
-        return True
-    except Exception:
-        LOG.exception('Local streaming download failed for %s', url)
-        return False
 
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-def fetch_json(url, params=None, timeout=30):
-    """Fetch JSON with retry logic and better error handling."""
-    max_retries = 2
-    for attempt in range(max_retries):
+    def _connect(self):
+        # Opened lazily so importing bot.py never touches the disk
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS file_ids ('
+                ' source TEXT NOT NULL, variant TEXT NOT NULL, media_type TEXT NOT NULL,'
+                ' file_id TEXT NOT NULL, caption TEXT, created REAL NOT NULL, reply_markup TEXT,'
+                ' PRIMARY KEY (source, variant))'
+            )
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(file_ids)')]
+            if 'reply_markup' not in columns:  # caches written before buttons were kept
+                conn.execute('ALTER TABLE file_ids ADD COLUMN reply_markup TEXT')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, source, variant=''):
+        if not self.path:
+            return None
         try:
-            r = requests.get(url, params=params, timeout=timeout, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            })
-            r.raise_for_status()
-            return r.json()
-        except requests.exceptions.Timeout:
-            LOG.warning(f'Timeout fetching {url} (attempt {attempt+1}/{max_retries})')
-            if attempt < max_retries - 1:
-                time.sleep(2)  # Wait before retry
-            else:
-                return {'error': 'Request timeout', 'timeout': True}
-        except requests.exceptions.HTTPError as e:
-            status_code = e.response.status_code if hasattr(e, 'response') else None
-            LOG.warning('HTTP error %s from %s: %s', status_code, url, str(e))
-            return {'error': str(e), 'status_code': status_code}
-        except requests.exceptions.ConnectionError as e:
-            LOG.warning(f'Connection error fetching {url} (attempt {attempt+1}/{max_retries}): {e}')
-            if attempt < max_retries - 1:
-                time.sleep(2)
-            else:
-                return {'error': 'Connection failed', 'connection_error': True}
-        except Exception as e:
-            LOG.exception('Failed to fetch JSON from %s', url)
-            return {'error': str(e)}
-    return {'error': 'All retry attempts failed'}
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT media_type, file_id, caption, reply_markup FROM file_ids WHERE source = ? AND variant = ?',
+                    (source, variant)
+                ).fetchone()
+                if row:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        except sqlite3.Error as e:
+            LOG.warning('file_id cache lookup failed: %s', e)
+            return None
+        if not row:
+            return None
+        return {'media_type': row[0], 'file_id': row[1], 'caption': row[2], 'reply_markup': row[3]}
 
+    def put(self, source, variant, media_type, file_id, caption=None, reply_markup=None):
+        if not self.path:
+            return
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO file_ids (source, variant, media_type, file_id, caption, created, reply_markup)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (source, variant, media_type, file_id, caption, time.time(), reply_markup)
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            LOG.warning('file_id cache write failed: %s', e)
 
-def find_download_entries(obj):
-    """Recursively find dicts that include a 'url' field in API responses."""
-    results = []
-    if isinstance(obj, dict):
-        if 'url' in obj and isinstance(obj['url'], str):
-            results.append(obj)
-        for v in obj.values():
-            results.extend(find_download_entries(v))
-    elif isinstance(obj, list):
-        for item in obj:
-            results.extend(find_download_entries(item))
-    return results
+    def forget(self, source, variant=''):
+        if not self.path:
+            return
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute('DELETE FROM file_ids WHERE source = ? AND variant = ?', (source, variant))
+                conn.commit()
+        except sqlite3.Error as e:
+            LOG.warning('file_id cache delete failed: %s', e)
 
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': (self.hits / lookups) if lookups else 0.0}
 
-def choose_entry(entries):
-    # Prefer mp4 / video entries if available, otherwise first
-    if not entries:
-        return None
-    for ext in ('mp4', 'mkv', 'webm', 'mp3', 'm4a'):
-        for e in entries:
-            if e.get('extension') and e.get('extension').lower().startswith(ext):
-                return e
-    return entries[0]
 
+FILE_ID_CACHE = FileIdCache(FILE_ID_CACHE_PATH)
 
-def human_size(bytes_val):
-    try:
-        b = int(bytes_val)
-    except Exception:
-        return str(bytes_val)
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if b < 1024:
-            return f"{b:.2f} {unit}"
-        b /= 1024.0
-    return f"{b:.2f} TB"
 
+def sent_file_id(sent_msg, media_type):
+    """Return the reusable file_id of a message we sent ('photo' picks the largest size)."""
+    if media_type == 'photo':
+        return sent_msg.photo[-1].file_id if sent_msg.photo else None
+    media = getattr(sent_msg, media_type, None)
+    return getattr(media, 'file_id', None)
 
-def clean_caption(raw):
-    if not raw:
-        return None
-    if not isinstance(raw, str):
-        return None
-    text = raw.strip()
-    # Remove standalone hashtag lines but keep inline non-hashtag words
-    lines = [l.strip() for l in text.split('\n') if l.strip()]
-    cleaned_parts = []
-    for line in lines:
-        lower_line = line.lower()
-        # Skip filler lines
-        if line in ['.', '..', '...']:
-            continue
-        if 'follow' in lower_line and '@' in lower_line:
-            # treat promotional follow lines as noise
-            continue
-        if all(part.startswith('#') for part in line.split()):
-            continue
-        words = [w for w in line.split() if not w.startswith('#')]
-        # Remove trailing promotional patterns like 'for' 'more'
-        if words and len(words) <= 3 and 'follow' in lower_line:
-            continue
-        if words:
-            cleaned_parts.append(' '.join(words))
-    cleaned = ' '.join(cleaned_parts).strip()
-    if len(cleaned) == 0:
-        return None
-    if len(cleaned) > 1024:
-        cleaned = cleaned[:1024] + '...'
-    return cleaned
 
+class SingleFlight:
+    """Coalesces concurrent jobs for the same (source, variant) key.
+    The first caller leads and does the work; later callers attach a follower callback
+    that is called with the leader's delivery (or None) when the leader finishes.
+    """
 
-def extract_instagram_caption(data):
-    """Attempt deep extraction of Instagram caption text from various response shapes."""
-    candidates = []
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.led = 0
+        self.joined = 0
 
-    def walk(obj):
-        if isinstance(obj, dict):
-            for k, v in obj.items():
-                kl = str(k).lower()
-                if kl in ['caption', 'title', 'description', 'text', 'post_caption']:
-                    if isinstance(v, str):
-                        candidates.append(v)
-                # Edge caption pattern
-                if kl in ['edge_media_to_caption', 'edge_media_to_comment'] and isinstance(v, dict):
-                    edges = v.get('edges', [])
-                    for edge in edges:
-                        if isinstance(edge, dict):
-                            node = edge.get('node', {})
-                            txt = node.get('text')
-                            if isinstance(txt, str):
-                                candidates.append(txt)
-                walk(v)
-        elif isinstance(obj, list):
-            for item in obj:
-                walk(item)
-
-    walk(data)
-    # Prioritize longer non-hashtag lines
-    cleaned = [clean_caption(c) for c in candidates if c]
-    cleaned = [c for c in cleaned if c]
-    if not cleaned:
-        return None
-    # Prefer first meaningful sentence (split by '.')
-    for c in cleaned:
-        # Attempt to get first line before hashtags
-        first_line = c.split('#')[0].strip()
-        # Truncate at promotional follow lines
-        if 'follow' in first_line.lower() and '@' in first_line.lower():
-            # try next
-            continue
-        # Further split by newline
-        first_segment = first_line.split('\n')[0].strip()
-        if len(first_segment) > 3:
-            return first_segment
-    return cleaned[0]
+    def join_or_lead(self, key, follower):
+        """Return True if the caller leads key; otherwise follower is queued on the running flight."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                self._flights[key] = {'followers': [], 'delivery': None}
+                self.led += 1
+                return True
+            flight['followers'].append(follower)
+            self.joined += 1
+            return False
 
-def scrape_instagram_page(post_url):
-    """Attempt lightweight HTML scrape to extract carousel (GraphSidecar) media URLs for /p/ posts.
-    Returns (caption, [urls]). Only works for public posts; silent failure returns empty list."""
-    try:
-        import re, json
-        post_url = post_url.split('?')[0]  # Clean URL
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'}
-        r = requests.get(post_url, headers=headers, timeout=15)
-        if not r.ok:
-            LOG.warning('HTML scrape failed: HTTP %s', r.status_code)
-            return None, []
-        html = r.text
-        LOG.info('Fetched HTML length: %s', len(html))
-        m = re.search(r'<script type="application/json" id="__NEXT_DATA__">(.*?)</script>', html)
-        data_json = None
-        if m:
-            LOG.info('Found __NEXT_DATA__ script')
+    def record(self, key, delivery):
+        """Store what the leader delivered so its followers can re-send it."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight['delivery'] = delivery
+
+    def finish(self, key):
+        """End the flight for key and hand its delivery to every follower."""
+        with self._lock:
+            flight = self._flights.pop(key, None)
+        if not flight:
+            return
+        for follower in flight['followers']:
             try:
-                data_json = json.loads(m.group(1))
-            except Exception as e:
-                LOG.warning('Failed to parse __NEXT_DATA__: %s', e)
-                data_json = None
-        if not data_json:
-            m2 = re.search(r'window\._sharedData\s*=\s*(\{.*?\})\s*;<', html)
-            if m2:
-                LOG.info('Found _sharedData script')
-                try:
-                    data_json = json.loads(m2.group(1))
-                except Exception as e:
-                    LOG.warning('Failed to parse _sharedData: %s', e)
-                    data_json = None
-        if not data_json:
-            LOG.warning('No JSON data found in HTML')
-            return None, []
-        LOG.info('Successfully parsed JSON data')
-        media_urls = []
-        caption_text = None
-        def walk(o):
-            nonlocal caption_text
-            if isinstance(o, dict):
-                # caption extraction
-                emc = o.get('edge_media_to_caption')
-                if isinstance(emc, dict):
-                    edges = emc.get('edges') or []
-                    for edge in edges:
-                        if isinstance(edge, dict):
-                            node = edge.get('node', {})
-                            txt = node.get('text')
-                            if isinstance(txt, str) and not caption_text:
-                                caption_text = txt
-                if o.get('__typename') in ['GraphImage', 'GraphVideo']:
-                    link = o.get('display_url') or o.get('video_url') or o.get('url')
-                    if link and link not in media_urls:
-                        media_urls.append(link)
-                if o.get('__typename') == 'GraphSidecar':
-                    children = o.get('edge_sidecar_to_children', {}).get('edges', [])
-                    LOG.info('Found GraphSidecar with %s children', len(children))
-                    for ch in children:
-                        if isinstance(ch, dict):
-                            node = ch.get('node', {})
-                            link = node.get('display_url') or node.get('video_url') or node.get('url')
-                            if link and link not in media_urls:
-                                media_urls.append(link)
-                for v in o.values():
-                    walk(v)
-            elif isinstance(o, list):
-                for i in o:
-                    walk(i)
-        walk(data_json)
-        LOG.info('Walk completed, found %s media URLs', len(media_urls))
-        return clean_caption(caption_text) if caption_text else None, media_urls
-    except Exception as e:
-        LOG.exception('HTML scrape exception: %s', e)
-        return None, []
+                follower(flight['delivery'])
+            except Exception:
+                LOG.exception('Coalesced request for %s failed', key[0])
 
+    def stats(self):
+        with self._lock:
+            return {'led': self.led, 'joined': self.joined, 'in_flight': len(self._flights)}
 
-def get_instagram_with_ytdlp_fallback(url):
-    """Try Instagram API first, fallback to yt-dlp for better caption/media extraction."""
-    try:
-        import yt_dlp
+
+FLIGHTS = SingleFlight()
+
+
+def remember_delivery(url, variant, media_type, file_id, caption=None, reply_markup=None):
+    """Store a delivered file_id in the cache and hand it to requests waiting on the same media."""
+    source = normalize_url(url)
+    FILE_ID_CACHE.put(source, variant, media_type, file_id, caption, reply_markup)
+    FLIGHTS.record((source, variant), {'media_type': media_type, 'file_id': file_id, 'caption': caption,
+                                       'reply_markup': reply_markup})
+
+
+def link_buttons(sent_msg):
+    """JSON keyboard of the URL buttons (e.g. the direct download link) on a sent message, or None.
+    Callback buttons are left out: they point at state that does not outlive the message."""
+    markup = getattr(sent_msg, 'reply_markup', None)
+    if not markup:
+        return None
+    rows = [[{'text': b.text, 'url': b.url} for b in row if b.url] for row in markup.keyboard]
+    rows = [row for row in rows if row]
+    return json.dumps({'inline_keyboard': rows}) if rows else None
+
+
+def remember_sent(url, variant, sent_msg, media_type, caption=None):
+    """Record the file_id of a successful delivery so repeat requests skip download and upload."""
+    try:
+        file_id = sent_file_id(sent_msg, media_type)
+        if file_id:
+            remember_delivery(url, variant, media_type, file_id, caption, link_buttons(sent_msg))
+    except Exception:
+        LOG.warning('Could not record file_id for %s', url, exc_info=True)
+
+
+def send_file_id(chat_id, media_type, file_id, caption=None, reply_markup=None):
+    """Send media that was uploaded before, by file_id, with the buttons it was first sent with."""
+    if media_type == 'album':
+        # file_id holds [[kind, file_id], ...] for every item of a delivered album
+        entries = json.loads(file_id)
+        for n in range(0, len(entries), MEDIA_GROUP_LIMIT):
+            send_media_entries(chat_id, entries[n:n + MEDIA_GROUP_LIMIT], caption if n == 0 else None)
+    elif media_type == 'video':
+        bot.send_video(chat_id, file_id, caption=caption, supports_streaming=True, reply_markup=reply_markup)
+    elif media_type == 'photo':
+        bot.send_photo(chat_id, file_id, caption=caption, reply_markup=reply_markup)
+    elif media_type == 'audio':
+        bot.send_audio(chat_id, file_id, caption=caption, reply_markup=reply_markup)
+    else:
+        bot.send_document(chat_id, file_id, caption=caption, reply_markup=reply_markup)
+
+
+def deliver_cached(chat_id, url, variant=''):
+    """Re-send previously delivered media by file_id. Returns True if it was sent."""
+    source = normalize_url(url)
+    cached = FILE_ID_CACHE.get(source, variant)
+    if not cached:
+        return False
+    try:
+        send_file_id(chat_id, cached['media_type'], cached['file_id'], cached['caption'], cached['reply_markup'])
+    except Exception as e:
+        # file_ids can be revoked; drop the entry and let the normal pipeline run
+        LOG.warning('Cached file_id rejected for %s (%s); re-fetching', source, e)
+        FILE_ID_CACHE.forget(source, variant)
+        return False
+    FLIGHTS.record((source, variant), cached)
+    LOG.info('Re-sent cached %s for %s', cached['media_type'], source)
+    return True
+
+
+def deliver_coalesced(chat_id, delivery, kind):
+    """Send a leader's delivery to a waiting chat. Returns False if the waiter must run its own job."""
+    if not delivery:
+        # Leader failed or answered with a link / quality picker: nothing to share
+        METRICS.inc('coalesced_requests_total', kind=kind, outcome='rerun')
+        return False
+    try:
+        send_file_id(chat_id, delivery['media_type'], delivery['file_id'], delivery['caption'],
+                     delivery.get('reply_markup'))
+    except Exception as e:
+        LOG.warning('Shared file_id rejected for chat %s (%s); running own job', chat_id, e)
+        METRICS.inc('coalesced_requests_total', kind=kind, outcome='rerun')
+        return False
+    METRICS.inc('coalesced_requests_total', kind=kind, outcome='file_id')
+    return True
+
+
+SEGMENT_POOL = TracedExecutor(max_workers=max(1, DOWNLOAD_SEGMENTS) * JOB_WORKERS, thread_name_prefix='segment')
+
+# Errors after which a download continues from the last written byte
+RESUMABLE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout)
+DOWNLOAD_STATS = {'resumes': 0, 'resumed_bytes': 0, 'restarts': 0}
+_DOWNLOAD_STATS_LOCK = threading.Lock()
+
+
+def count_download(**deltas):
+    with _DOWNLOAD_STATS_LOCK:
+        for key, value in deltas.items():
+            DOWNLOAD_STATS[key] += value
+
+
+def download_stats():
+    """Resume counters: resumes, bytes that did not have to be fetched again, full restarts."""
+    with _DOWNLOAD_STATS_LOCK:
+        return dict(DOWNLOAD_STATS)
+
+
+class RangeNotSupported(Exception):
+    """The server answered a Range request with the whole body."""
+
+
+def response_validator(r):
+    """ETag (preferred) or Last-Modified of a response, for If-Range on resume."""
+    return r.headers.get('etag') or r.headers.get('last-modified')
+
+
+def open_resumed(url, offset, end, validator, total_size):
+    """Request bytes offset..end (end None = to EOF) with If-Range, returning the response
+    only if it really continues the same file; otherwise closes it and returns None."""
+    headers = {'Range': f'bytes={offset}-{"" if end is None else end}'}
+    if validator:
+        headers['If-Range'] = validator
+    r = http_get(url, stream=True, timeout=30, headers=headers)
+    m = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)', r.headers.get('content-range', ''))
+    same_file = (
+        r.status_code == 206 and m and int(m.group(1)) == offset
+        and (m.group(2) == '*' or not total_size or int(m.group(2)) == total_size)
+        and not (validator and response_validator(r) and response_validator(r) != validator)
+    )
+    if not same_file:
+        r.close()
+        return None
+    return r
+
+
+def resume_delay(attempt):
+    """Seconds to wait before reconnect attempt n of a dropped download (0.5s, doubling, at most 8s)."""
+    return min(0.5 * 2 ** (attempt - 1), 8)
+
+
+def resume_state_path(dest_path: Path) -> Path:
+    return dest_path.with_name(dest_path.name + '.resume')
+
+
+def load_resume_state(dest_path: Path):
+    """Progress an earlier run saved for dest_path ({validator, total_size, done, segments}), or None."""
+    try:
+        state = json.loads(resume_state_path(dest_path).read_text())
+    except (OSError, ValueError):
+        return None
+    return state if dest_path.exists() and state.get('validator') else None
+
+
+def save_resume_state(dest_path: Path, **state):
+    """Atomically write download progress next to dest_path."""
+    path = resume_state_path(dest_path)
+    tmp = path.with_name(path.name + '.tmp')
+    try:
+        tmp.write_text(json.dumps(state))
+        os.replace(tmp, path)
+    except OSError as e:
+        LOG.warning('Could not save download progress for %s: %s', dest_path.name, e)
+
+
+def probe_range_support(url):
+    """Ask for the first byte only. Returns (total_size, final_url, validator) if the server
+    honours Range requests and reports a total size, else None."""
+    try:
+        with http_get(url, stream=True, timeout=15, headers={'Range': 'bytes=0-0'}) as r:
+            if r.status_code != 206:
+                return None
+            m = re.match(r'bytes\s+0-0/(\d+)', r.headers.get('content-range', ''))
+            if not m:
+                return None
+            return int(m.group(1)), r.url, response_validator(r)
+    except Exception as e:
+        LOG.info('Range probe failed for %s: %s', url, e)
+        return None
+
+
+def segmented_download(url: str, dest_path: Path, total_size: int, progress_callback=None, validator=None,
+                       saved=None, record=False) -> bool:
+    """Fetch total_size bytes as DOWNLOAD_SEGMENTS parallel ranges into a preallocated file.
+    A segment whose connection drops continues from its last byte (If-Range: validator).
+    saved: resume state of an earlier run; record: keep that state up to date next to the file.
+    Raises RangeNotSupported if any segment comes back without a 206."""
+    seg_len = -(-total_size // DOWNLOAD_SEGMENTS)
+    ranges = [(start, min(start + seg_len, total_size) - 1) for start in range(0, total_size, seg_len)]
+    positions = {start: start for start, _ in ranges}  # bytes before this offset are on disk
+    saved_positions = {start: pos for start, pos in (saved or {}).get('segments') or []}
+    if saved_positions.keys() == positions.keys():
+        positions.update(saved_positions)
+        LOG.info('Resuming %s segments of %s', len(ranges), dest_path.name)
+    else:
+        with open(dest_path, 'wb') as f:
+            f.truncate(total_size)
+    record = record and bool(validator)
+    downloaded = [sum(pos - start for start, pos in positions.items())]
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def fetch(start, end):
+        pos = positions[start]
+        flushed = pos
+        attempts = 0
+        with open(dest_path, 'r+b') as f:
+            while pos <= end:
+                try:
+                    # Reconnecting is inside the try: a failed reconnect uses up an attempt too
+                    if pos == start:
+                        r = http_get(url, stream=True, timeout=30, headers={'Range': f'bytes={start}-{end}'})
+                        if r.status_code != 206:
+                            r.close()
+                            raise RangeNotSupported(f'HTTP {r.status_code} for range {start}-{end}')
+                    else:
+                        r = open_resumed(url, pos, end, validator, total_size)
+                        if r is None:
+                            raise IOError(f'Segment {start}-{end} could not be resumed at {pos}')
+                        count_download(resumes=1, resumed_bytes=pos - start)
+                    with r:
+                        f.seek(pos)
+                        for chunk in r.iter_content(chunk_size=64 * 1024):
+                            if stop.is_set():
+                                return
+                            if not chunk:
+                                continue
+                            if pos + len(chunk) > end + 1:
+                                raise IOError(f'Segment {start}-{end} overran its range')
+                            f.write(chunk)
+                            pos += len(chunk)
+                            with lock:
+                                downloaded[0] += len(chunk)
+                            if record and (pos - flushed >= RESUME_FLUSH_BYTES or pos == end + 1):
+                                # Only flushed bytes may be reported as done: a crash loses the buffer
+                                f.flush()
+                                flushed = positions[start] = pos
+                except RESUMABLE_ERRORS as e:
+                    attempts += 1
+                    if attempts > DOWNLOAD_RESUME_ATTEMPTS:
+                        raise
+                    LOG.warning('Segment %s-%s dropped at %s (%s); resuming', start, end, pos, e)
+                    if stop.wait(resume_delay(attempts)):
+                        return
+                    continue
+                if pos != end + 1:
+                    raise IOError(f'Segment {start}-{end} ended at {pos}')
+
+    def save():
+        # done only once every segment reached its end: the file is preallocated, so a
+        # failed segment would otherwise leave zero-filled holes that look complete
+        save_resume_state(dest_path, validator=validator, total_size=total_size,
+                          done=all(positions[start] == end + 1 for start, end in ranges),
+                          segments=[[start, positions[start]] for start, _ in ranges])
+
+    futures = [SEGMENT_POOL.submit(fetch, start, end) for start, end in ranges]
+    try:
+        while True:
+            done, not_done = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+            # Progress is reported from the calling thread so callbacks need no locking
+            if progress_callback:
+                try:
+                    progress_callback(downloaded[0], total_size)
+                except Exception:
+                    pass  # Don't let callback errors stop download
+            if record:
+                save()
+            for fut in done:
+                fut.result()  # re-raise the first segment failure
+            if not not_done:
+                return True
+            futures = list(not_done)
+    finally:
+        stop.set()
+        for fut in futures:
+            fut.cancel()
+
+
+def stream_download(url: str, dest_path: Path, max_bytes: int, progress_callback=None, resume=None) -> bool:
+    """Stream download the file to dest_path enforcing max_bytes; return True on success.
+    progress_callback: optional function(downloaded_bytes, total_bytes) for progress updates
+    Files of at least SEGMENT_MIN_SIZE on servers that honour Range requests are fetched over
+    DOWNLOAD_SEGMENTS parallel connections; everything else uses a single stream. Dropped
+    connections resume from the last written byte up to DOWNLOAD_RESUME_ATTEMPTS times.
+    resume: continue a partial dest_path left by an earlier run of the bot (default: when
+    dest_path is in a journaled job's spool directory).
+    """
+    if resume is None:
+        resume = JOURNAL.owns(dest_path)
+    journal_state('downloading', dest_path)
+    start = time.monotonic()
+    with span('download', host=urlparse(url).hostname) as sp:
+        ok = dispatch_download(url, dest_path, max_bytes, progress_callback, resume)
+        sp['ok'] = ok
+        if ok and dest_path.exists():
+            sp['bytes'] = dest_path.stat().st_size
+    elapsed = time.monotonic() - start
+    if ok and dest_path.exists():
+        size = dest_path.stat().st_size
+        METRICS.inc('download_bytes_total', size)
+        if elapsed > 0:
+            METRICS.observe('download_bytes_per_second', size / elapsed)
+    return ok
+
+
+def dispatch_download(url, dest_path: Path, max_bytes: int, progress_callback=None, resume=False) -> bool:
+    """Segmented download when the server supports it, otherwise a single stream."""
+    saved = load_resume_state(dest_path) if resume else None
+    probe = probe_range_support(url) if DOWNLOAD_SEGMENTS > 1 or saved else None
+    if saved and not (probe and probe[2] == saved['validator'] and probe[0] == saved.get('total_size')):
+        LOG.info('Partial %s no longer matches its source; starting over', dest_path.name)
+        saved = None
+    if saved and saved.get('done') and dest_path.stat().st_size == saved['total_size']:
+        LOG.info('Reusing %s, downloaded before the restart', dest_path.name)
+        count_download(resumes=1, resumed_bytes=saved['total_size'])
+        return True
+    if DOWNLOAD_SEGMENTS > 1 and probe:
+        total_size, final_url, validator = probe
+        if total_size > max_bytes:
+            LOG.warning('File exceeds max_bytes before download (%s > %s)', total_size, max_bytes)
+            return False
+        if total_size >= SEGMENT_MIN_SIZE:
+            try:
+                return segmented_download(final_url, dest_path, total_size, progress_callback, validator,
+                                          saved, record=resume)
+            except RangeNotSupported as e:
+                LOG.info('Segmented download not possible (%s); using a single stream', e)
+                saved = None
+            except Exception:
+                LOG.exception('Segmented download failed for %s', url)
+                return False
+    if saved and saved.get('segments'):
+        saved = None  # a preallocated segmented file is not a prefix
+    return single_stream_download(url, dest_path, max_bytes, progress_callback, saved, record=resume)
+
+
+def single_stream_download(url: str, dest_path: Path, max_bytes: int, progress_callback=None,
+                           saved=None, record=False) -> bool:
+    """Download over one connection in 64 KB chunks (see stream_download).
+    After a dropped connection the request is reissued with Range: bytes=<written>- and
+    If-Range; if the server cannot continue the same file the download starts over.
+    saved: resume state of an earlier run (the file on disk is a prefix); record: save state."""
+    downloaded = 0
+    total_size = 0
+    validator = None
+    attempts = 0
+    if saved:
+        downloaded, total_size, validator = dest_path.stat().st_size, saved['total_size'], saved['validator']
+    try:
+        with open(dest_path, 'r+b' if saved else 'wb') as f:
+            f.seek(downloaded)
+            while True:
+                try:
+                    # Reconnecting is inside the try: a failed reconnect uses up an attempt too
+                    r = None
+                    if downloaded:
+                        r = open_resumed(url, downloaded, None, validator, total_size)
+                        if r is None:
+                            LOG.warning('Server cannot resume %s at %s; restarting download', url, downloaded)
+                            count_download(restarts=1)
+                            f.seek(0)
+                            f.truncate()
+                            downloaded = 0
+                        else:
+                            LOG.info('Resuming %s at byte %s', url, downloaded)
+                            count_download(resumes=1, resumed_bytes=downloaded)
+                    if r is None:
+                        r = http_get(url, stream=True, timeout=30)
+                        r.raise_for_status()
+                        total_size = int(r.headers.get('content-length', 0))
+                        validator = response_validator(r)
+                        if record and validator and total_size:
+                            save_resume_state(dest_path, validator=validator, total_size=total_size)
+                    with r:
+                        for chunk in r.iter_content(chunk_size=64 * 1024):
+                            if not chunk:
+                                continue
+                            downloaded += len(chunk)
+                            if downloaded > max_bytes:
+                                LOG.warning('File exceeds max_bytes during download (%s > %s)', downloaded, max_bytes)
+                                return False
+                            f.write(chunk)
+                            
+                            # Call progress callback if provided
+                            if progress_callback and total_size > 0:
+                                try:
+                                    progress_callback(downloaded, total_size)
+                                except Exception:
+                                    pass  # Don't let callback errors stop download
+                    if record and validator and total_size:
+                        save_resume_state(dest_path, validator=validator, total_size=total_size, done=downloaded == total_size)
+                    return True
+                except RESUMABLE_ERRORS as e:
+                    attempts += 1
+                    if attempts > DOWNLOAD_RESUME_ATTEMPTS:
+                        raise
+                    LOG.warning('Download of %s dropped at %s bytes (%s); resuming', url, downloaded, e)
+                    time.sleep(resume_delay(attempts))
+    except Exception:
+        LOG.exception('Local streaming download failed for %s', url)
+        return False
+
+
+def endpoint_key(url):
+    """scheme://host/path of a resolver URL, the unit the health registry tracks."""
+    parsed = urlparse(url)
+    return f'{parsed.scheme}://{parsed.netloc}{parsed.path}'
+
+
+class EndpointHealth:
+    """Rolling success rate and latency per resolver endpoint, with a circuit breaker.
+
+    After CIRCUIT_FAILURE_THRESHOLD consecutive failures an endpoint's breaker opens and
+    calls to it are refused until the cooldown passes; then a single half-open probe is
+    let through. A failed probe reopens the breaker with a doubled cooldown.
+    """
+
+    def __init__(self, failure_threshold, open_seconds, max_open_seconds, alpha):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.alpha = alpha
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, name):
+        entry = self._endpoints.get(name)
+        if entry is None:
+            entry = self._endpoints[name] = {
+                'success_rate': 1.0, 'latency': None, 'calls': 0, 'failures': 0,
+                'consecutive_failures': 0, 'state': 'closed', 'open_until': 0.0,
+                'cooldown': self.open_seconds, 'probing': False,
+            }
+        return entry
+
+    def allow(self, name):
+        """True if a call to this endpoint may go ahead (closed, or the half-open probe)."""
+        with self._lock:
+            entry = self._entry(name)
+            if entry['state'] == 'closed':
+                return True
+            if entry['probing'] or time.time() < entry['open_until']:
+                return False
+            entry['state'] = 'half_open'
+            entry['probing'] = True
+            return True
+
+    def record(self, name, ok, latency):
+        METRICS.observe('resolver_endpoint_seconds', latency, endpoint=name, outcome='ok' if ok else 'error')
+        with self._lock:
+            entry = self._entry(name)
+            a = self.alpha
+            entry['calls'] += 1
+            entry['success_rate'] = (1 - a) * entry['success_rate'] + a * (1.0 if ok else 0.0)
+            entry['latency'] = latency if entry['latency'] is None else (1 - a) * entry['latency'] + a * latency
+            entry['probing'] = False
+            if ok:
+                entry['consecutive_failures'] = 0
+                if entry['state'] != 'closed':
+                    LOG.info('Circuit closed for %s', name)
+                entry['state'] = 'closed'
+                entry['cooldown'] = self.open_seconds
+                return
+            entry['failures'] += 1
+            entry['consecutive_failures'] += 1
+            if entry['state'] == 'half_open':
+                entry['cooldown'] = min(entry['cooldown'] * 2, self.max_open_seconds)
+            elif entry['consecutive_failures'] < self.failure_threshold:
+                return
+            entry['state'] = 'open'
+            entry['open_until'] = time.time() + entry['cooldown']
+            LOG.warning('Circuit open for %s for %.0fs after %s consecutive failures',
+                        name, entry['cooldown'], entry['consecutive_failures'])
+
+    def expected_time(self, name):
+        """Estimated seconds until this endpoint yields a success: latency / success rate.
+        Endpoints with no history get 0 so they are tried early and learned about."""
+        entry = self._endpoints.get(name)
+        if entry is None or entry['latency'] is None:
+            return 0.0
+        return entry['latency'] / max(entry['success_rate'], 0.01)
+
+    def order(self, names):
+        """names sorted by expected time-to-success, endpoints with an open breaker last.
+        The sort is stable, so a fresh registry keeps the configured order."""
+        with self._lock:
+            now = time.time()
+            def key(name):
+                entry = self._endpoints.get(name)
+                blocked = bool(entry and entry['state'] != 'closed' and (entry['probing'] or now < entry['open_until']))
+                return (blocked, self.expected_time(name))
+            return sorted(names, key=key)
+
+    def track(self, name, fn, failures=(Exception,), default=None):
+        """Run fn() as a call to pseudo-endpoint name (e.g. yt-dlp), recording its health.
+        Only an exception in failures counts against the endpoint (it is logged and default
+        returned); any answer, even one without media, is a healthy call.
+        Returns default without calling fn while the breaker is open."""
+        if not self.allow(name):
+            return default
+        start = time.monotonic()
+        with span(name) as sp:
+            try:
+                result = fn()
+            except failures as e:
+                LOG.warning('%s failed: %s', name, e)
+                result = default
+                sp['ok'] = False
+            else:
+                sp['ok'] = True
+            finally:
+                self.record(name, sp.get('ok', False), time.monotonic() - start)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {name: {
+                'state': e['state'],
+                'success_rate': round(e['success_rate'], 3),
+                'latency': round(e['latency'], 3) if e['latency'] is not None else None,
+                'calls': e['calls'],
+                'failures': e['failures'],
+            } for name, e in self._endpoints.items()}
+
+
+HEALTH = EndpointHealth(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, CIRCUIT_MAX_OPEN_SECONDS, HEALTH_EWMA_ALPHA)
+
+
+def fetch_json(url, params=None, timeout=30):
+    """Fetch JSON with retry and circuit-breaker handling; the outcome feeds HEALTH.
+    Transport errors, 5xx/429 and non-JSON bodies count against the endpoint.
+    """
+    key = endpoint_key(url)
+    if not HEALTH.allow(key):
+        LOG.info('Skipping %s: circuit open', key)
+        with span('fetch_json', endpoint=key, skipped='circuit open'):
+            pass
+        return {'error': 'Circuit open', 'circuit_open': True}
+    start = time.monotonic()
+    with span('fetch_json', endpoint=key) as sp:
+        result = _fetch_json(url, params=params, timeout=timeout)
+        status_code = result.get('status_code') if isinstance(result, dict) else None
+        failed = isinstance(result, dict) and bool(
+            result.get('timeout') or result.get('connection_error') or result.get('invalid_response')
+            or (status_code and (status_code >= 500 or status_code == 429)))
+        sp['ok'] = not failed
+    HEALTH.record(key, not failed, time.monotonic() - start)
+    return result
+
+
+def _fetch_json(url, params=None, timeout=30):
+    max_retries = 2
+    for attempt in range(max_retries):
+        try:
+            r = http_get(url, params=params, timeout=timeout)
+            r.raise_for_status()
+            return r.json()
+        except requests.exceptions.Timeout:
+            LOG.warning(f'Timeout fetching {url} (attempt {attempt+1}/{max_retries})')
+            if attempt < max_retries - 1 and retry_pause(2):  # Wait before retry
+                continue
+            return {'error': 'Request timeout', 'timeout': True}
+        except requests.exceptions.HTTPError as e:
+            status_code = e.response.status_code if hasattr(e, 'response') else None
+            LOG.warning('HTTP error %s from %s: %s', status_code, url, str(e))
+            return {'error': str(e), 'status_code': status_code}
+        except requests.exceptions.ConnectionError as e:
+            LOG.warning(f'Connection error fetching {url} (attempt {attempt+1}/{max_retries}): {e}')
+            if attempt < max_retries - 1 and retry_pause(2):
+                continue
+            return {'error': 'Connection failed', 'connection_error': True}
+        except Exception as e:
+            LOG.exception('Failed to fetch JSON from %s', url)
+            return {'error': str(e), 'invalid_response': True}
+    return {'error': 'All retry attempts failed'}
+
+
+CAPTION_KEYS = frozenset(('caption', 'title', 'description', 'text', 'post_caption'))
+CAPTION_EDGE_KEYS = frozenset(('edge_media_to_caption', 'edge_media_to_comment'))
+SIZE_KEYS = ('size_bytes', 'size', 'filesize', 'filesize_approx')
+GRAPH_MEDIA_TYPES = frozenset(('GraphImage', 'GraphVideo', 'GraphSidecar'))
+# Media kind implied by the key a URL entry (or the list holding it) sits under
+MEDIA_KEY_HINTS = {'images': 'image', 'image_list': 'image', 'imageurls': 'image', 'image_versions2': 'image',
+                   'display_resources': 'image', 'videos': 'video', 'video_versions': 'video'}
+
+
+class PayloadScan:
+    """What one walk over a resolver response found.
+    entries: dicts with a string 'url', in document order (parents before children)
+    keys: the key each entry, or the list holding it, sits under
+    captions: caption-like strings in document order, including edge_media_to_caption node texts
+    graph_nodes: Instagram GraphImage / GraphVideo / GraphSidecar nodes in document order
+    kinds / sizes: per-entry media hint and (size_bytes, size_text), derived on first use
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.keys = []
+        self.captions = []
+        self.graph_nodes = []
+        self._kinds = None
+        self._sizes = None
+
+    def add(self, entry, key=None):
+        self.entries.append(entry)
+        self.keys.append(key)
+        self._kinds = self._sizes = None
+
+    @property
+    def kinds(self):
+        if self._kinds is None:
+            self._kinds = [entry_media_kind(e, k) for e, k in zip(self.entries, self.keys)]
+        return self._kinds
+
+    @property
+    def sizes(self):
+        if self._sizes is None:
+            self._sizes = [entry_size(e) for e in self.entries]
+        return self._sizes
+
+
+def entry_media_kind(entry, key=None):
+    kind = entry.get('type') or entry.get('__typename') or entry.get('media_type')
+    if isinstance(kind, str):
+        kind = kind.lower()
+        if 'video' in kind:
+            return 'video'
+        if 'image' in kind or 'photo' in kind:
+            return 'image'
+    if entry.get('is_video') is True:
+        return 'video'
+    return MEDIA_KEY_HINTS.get(key.lower()) if isinstance(key, str) else None
+
+
+def entry_size(entry):
+    """(size_bytes, size_text): first integer size field, else the last non-numeric size string."""
+    size_text = None
+    for key in SIZE_KEYS:
+        val = entry.get(key)
+        if val:
+            try:
+                size_bytes = int(val)
+                return size_bytes, human_size(size_bytes)
+            except Exception:
+                if isinstance(val, str):
+                    size_text = val
+    return None, size_text
+
+
+def scan_payload(obj, limit=None):
+    """Walk a resolver response once and collect URL entries, caption candidates, sizes and media hints.
+    Iterative (a stack of iterators), so deeply nested payloads cannot hit the recursion limit.
+    Stops early once `limit` entries have been found.
+    """
+    scan = PayloadScan()
+    entries, keys, captions, graph_nodes = scan.entries, scan.keys, scan.captions, scan.graph_nodes
+    stack = [(iter((obj,)), None, False)]  # (iterator, key holding this container, iterating a dict)
+    while stack:
+        it, holder, in_dict = stack[-1]
+        if in_dict:
+            for key, value in it:
+                if isinstance(value, str):
+                    if (key if isinstance(key, str) else str(key)).lower() in CAPTION_KEYS:
+                        captions.append(value)
+                elif isinstance(value, dict):
+                    if (key if isinstance(key, str) else str(key)).lower() in CAPTION_EDGE_KEYS:
+                        for edge in value.get('edges') or ():
+                            node = edge.get('node') if isinstance(edge, dict) else None
+                            if isinstance(node, dict) and isinstance(node.get('text'), str):
+                                captions.append(node['text'])
+                    if value.get('__typename') in GRAPH_MEDIA_TYPES:
+                        graph_nodes.append(value)
+                    if isinstance(value.get('url'), str):
+                        entries.append(value)
+                        keys.append(key)
+                        if limit and len(entries) >= limit:
+                            return scan
+                    stack.append((iter(value.items()), key, True))
+                    break
+                elif isinstance(value, list):
+                    stack.append((iter(value), key, False))
+                    break
+            else:
+                stack.pop()
+        else:
+            for value in it:
+                if isinstance(value, dict):
+                    if value.get('__typename') in GRAPH_MEDIA_TYPES:
+                        graph_nodes.append(value)
+                    if isinstance(value.get('url'), str):
+                        entries.append(value)
+                        keys.append(holder)
+                        if limit and len(entries) >= limit:
+                            return scan
+                    stack.append((iter(value.items()), holder, True))
+                    break
+                elif isinstance(value, list):
+                    stack.append((iter(value), holder, False))
+                    break
+            else:
+                stack.pop()
+    return scan
+
+
+def find_download_entries(obj):
+    """Find dicts that include a 'url' field in API responses."""
+    return scan_payload(obj).entries
+
+
+RESOLVER_POOL = TracedExecutor(max_workers=RESOLVER_WORKERS, thread_name_prefix='resolver')
+# Work a job blocks on directly stays off RESOLVER_POOL, where race losers may still be running
+PROBE_POOL = TracedExecutor(max_workers=2 * JOB_WORKERS, thread_name_prefix='probe')  # ffprobe, two per mux
+HEDGE_POOL = TracedExecutor(max_workers=JOB_WORKERS, thread_name_prefix='hedge')  # Instagram's yt-dlp side lookup
+_RACE_LOCAL = threading.local()
+
+
+def traced_resolver(name, fn, attempt, cancelled):
+    _RACE_LOCAL.cancelled = cancelled
+    try:
+        with span('resolver', resolver=name, attempt=attempt):
+            return fn()
+    finally:
+        _RACE_LOCAL.cancelled = None
+
+
+def retry_pause(seconds):
+    """Sleep before a retry. False (return at once) if the resolver race this call runs in has
+    already ended, so a loser gives up instead of holding a RESOLVER_POOL thread."""
+    cancelled = getattr(_RACE_LOCAL, 'cancelled', None)
+    if cancelled is None:
+        time.sleep(seconds)
+        return True
+    return not cancelled.wait(seconds)
+
+
+def race_resolvers(resolvers, accept, hedge_delay=0.0, deadline=None, fast_fail_retries=0,
+                   fast_fail_window=5.0, retry_delay=1.0):
+    """Run resolvers concurrently and return (name, result) for the first accepted result.
+    resolvers: list of (name, callable) in preference order. With hedge_delay > 0 each
+    resolver starts hedge_delay seconds after the previous one (or immediately once
+    everything in flight has failed). accept: callable(result) -> bool.
+    A resolver that fails within fast_fail_window seconds is retried up to
+    fast_fail_retries times after retry_delay; slow failures are not retried.
+    Losers that have not started are cancelled; running ones are told the race is over (see
+    retry_pause) so they skip their retries, and their results are ignored.
+    Returns (None, None) if nothing usable arrived before the deadline (seconds).
+    """
+    order = {name: i for i, (name, _) in enumerate(resolvers)}
+    queued = [(name, fn, 1) for name, fn in resolvers]  # (name, fn, attempt)
+    retries = []  # (due, name, fn, attempt)
+    pending = {}  # future -> (name, fn, attempt, launched_at)
+    start = time.monotonic()
+    next_launch = start
+    cancelled = threading.Event()
+    try:
+        while queued or pending or retries:
+            now = time.monotonic()
+            remaining = None if deadline is None else deadline - (now - start)
+            if remaining is not None and remaining <= 0:
+                LOG.warning('Resolver race hit its %.1fs deadline', deadline)
+                break
+            for item in [r for r in retries if r[0] <= now]:
+                retries.remove(item)
+                queued.insert(0, item[1:])
+            while queued and (now >= next_launch or not pending):
+                name, fn, attempt = queued.pop(0)
+                pending[RESOLVER_POOL.submit(traced_resolver, name, fn, attempt, cancelled)] = (name, fn, attempt, now)
+                next_launch = now + hedge_delay
+            # Wake up for the next hedged launch, the next due retry or the deadline
+            wakeups = []
+            if queued:
+                wakeups.append(next_launch - now)
+            if retries:
+                wakeups.append(min(r[0] for r in retries) - now)
+            if remaining is not None:
+                wakeups.append(remaining)
+            timeout = max(0.0, min(wakeups)) if wakeups else None
+            if not pending:
+                time.sleep(timeout or 0)
+                continue
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for fut in sorted(done, key=lambda f: order[pending[f][0]]):
+                name, fn, attempt, launched_at = pending.pop(fut)
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    LOG.warning('Resolver %s raised: %s', name, e)
+                    result = None
+                if result is not None and accept(result):
+                    LOG.info('Resolver race won by %s after %.2fs', name, time.monotonic() - start)
+                    return name, result
+                LOG.info('Resolver %s returned nothing usable (attempt %s)', name, attempt)
+                if attempt <= fast_fail_retries and time.monotonic() - launched_at < fast_fail_window:
+                    retries.append((time.monotonic() + retry_delay, name, fn, attempt + 1))
+        return None, None
+    finally:
+        cancelled.set()
+        for fut in pending:
+            fut.cancel()
+
+
+def choose_entry(entries):
+    # Prefer mp4 / video entries if available, otherwise first
+    if not entries:
+        return None
+    for ext in ('mp4', 'mkv', 'webm', 'mp3', 'm4a'):
+        for e in entries:
+            if e.get('extension') and e.get('extension').lower().startswith(ext):
+                return e
+    return entries[0]
+
+
+def human_size(bytes_val):
+    try:
+        b = int(bytes_val)
+    except Exception:
+        return str(bytes_val)
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if b < 1024:
+            return f"{b:.2f} {unit}"
+        b /= 1024.0
+    return f"{b:.2f} TB"
+
+
+def clean_caption(raw):
+    if not raw:
+        return None
+    if not isinstance(raw, str):
+        return None
+    text = raw.strip()
+    # Remove standalone hashtag lines but keep inline non-hashtag words
+    lines = [l.strip() for l in text.split('\n') if l.strip()]
+    cleaned_parts = []
+    for line in lines:
+        lower_line = line.lower()
+        # Skip filler lines
+        if line in ['.', '..', '...']:
+            continue
+        if 'follow' in lower_line and '@' in lower_line:
+            # treat promotional follow lines as noise
+            continue
+        if all(part.startswith('#') for part in line.split()):
+            continue
+        words = [w for w in line.split() if not w.startswith('#')]
+        # Remove trailing promotional patterns like 'for' 'more'
+        if words and len(words) <= 3 and 'follow' in lower_line:
+            continue
+        if words:
+            cleaned_parts.append(' '.join(words))
+    cleaned = ' '.join(cleaned_parts).strip()
+    if len(cleaned) == 0:
+        return None
+    if len(cleaned) > 1024:
+        cleaned = cleaned[:1024] + '...'
+    return cleaned
+
+
+def extract_instagram_caption(data):
+    """Attempt deep extraction of Instagram caption text from various response shapes."""
+    return pick_caption(scan_payload(data).captions)
+
+
+def pick_caption(candidates):
+    """Best caption among scan_payload caption candidates, or None."""
+    # Prioritize longer non-hashtag lines
+    cleaned = [clean_caption(c) for c in candidates if c]
+    cleaned = [c for c in cleaned if c]
+    if not cleaned:
+        return None
+    # Prefer first meaningful sentence (split by '.')
+    for c in cleaned:
+        # Attempt to get first line before hashtags
+        first_line = c.split('#')[0].strip()
+        # Truncate at promotional follow lines
+        if 'follow' in first_line.lower() and '@' in first_line.lower():
+            # try next
+            continue
+        # Further split by newline
+        first_segment = first_line.split('\n')[0].strip()
+        if len(first_segment) > 3:
+            return first_segment
+    return cleaned[0]
+
+def scrape_instagram_page(post_url):
+    """Attempt lightweight HTML scrape to extract carousel (GraphSidecar) media URLs for /p/ posts.
+    Returns (caption, [urls]). Only works for public posts; silent failure returns empty list.
+    The page is streamed and the connection dropped as soon as the embedded JSON has been read."""
+    try:
+        post_url = post_url.split('?')[0]  # Clean URL
+        with http_get(post_url, timeout=15, stream=True) as r:
+            if not r.ok:
+                LOG.warning('HTML scrape failed: HTTP %s', r.status_code)
+                return None, []
+            return parse_instagram_chunks(r.iter_content(chunk_size=16384))
+    except Exception as e:
+        LOG.exception('HTML scrape exception: %s', e)
+        return None, []
+
+
+def parse_instagram_html(html):
+    """Caption and media URLs from a post page's __NEXT_DATA__ / _sharedData JSON: (caption, [urls])."""
+    return parse_instagram_chunks(html[i:i + 16384].encode('utf-8') for i in range(0, len(html), 16384))
+
+
+INSTA_NEXT_DATA_MARK = b'<script type="application/json" id="__NEXT_DATA__">'
+INSTA_SHARED_DATA_MARK = b'window._sharedData'
+INSTA_SHARED_DATA_ASSIGN_RE = re.compile(rb'\s*=\s*(?=\{)')
+INSTA_SHARED_DATA_END_RE = re.compile(rb'\}\s*;<')
+INSTA_MEDIA_KEY_RE = re.compile(r'"(?:xdt_)?shortcode_media"\s*:\s*')
+JSON_DECODER = json.JSONDecoder()
+
+
+def iter_instagram_json_blocks(chunks, max_page=None, max_json=None):
+    """Yield (kind, text) for each __NEXT_DATA__ / _sharedData JSON block in a stream of HTML byte chunks.
+    Only the block being captured is buffered; the caller can stop iterating (and reading) at any time.
+    Gives up once max_page bytes were read or a block grows beyond max_json bytes.
+    """
+    max_page = max_page or INSTA_SCRAPE_MAX_PAGE_BYTES
+    max_json = max_json or INSTA_SCRAPE_MAX_JSON_BYTES
+    buf = bytearray()
+    kind = None  # block being captured
+    scanned = 0  # bytes of buf already searched for the end marker
+    read = 0
+    for chunk in chunks:
+        read += len(chunk)
+        buf += chunk
+        while True:
+            if kind is None:
+                # Plain finds: much cheaper than one alternation regex over the whole page
+                nxt = buf.find(INSTA_NEXT_DATA_MARK)
+                shr = buf.find(INSTA_SHARED_DATA_MARK)
+                if shr >= 0 and (nxt < 0 or shr < nxt):
+                    m = INSTA_SHARED_DATA_ASSIGN_RE.match(buf, shr + len(INSTA_SHARED_DATA_MARK))
+                    if not m:
+                        if len(buf) - shr < 64:  # the '= {' may still be on its way
+                            del buf[:shr]
+                            break
+                        del buf[:shr + len(INSTA_SHARED_DATA_MARK)]
+                        continue
+                    kind, start = '_sharedData', m.end()
+                elif nxt >= 0:
+                    kind, start = '__NEXT_DATA__', nxt + len(INSTA_NEXT_DATA_MARK)
+                else:
+                    del buf[:-64]  # keep enough to match a marker split across chunks
+                    break
+                del buf[:start]
+                scanned = 0
+            if kind == '__NEXT_DATA__':
+                end = buf.find(b'</script>', max(0, scanned - 16))
+                stop = end + len(b'</script>')
+            else:
+                m = INSTA_SHARED_DATA_END_RE.search(buf, max(0, scanned - 16))
+                end, stop = (m.start() + 1, m.end()) if m else (-1, -1)
+            if end < 0:
+                scanned = len(buf)
+                if scanned > max_json:
+                    LOG.warning('Instagram %s block exceeds %s bytes; giving up', kind, max_json)
+                    return
+                break
+            LOG.info('Found %s script (%s bytes after reading %s)', kind, end, read)
+            yield kind, buf[:end].decode('utf-8', 'replace')
+            del buf[:stop]
+            kind = None
+        if read > max_page:
+            LOG.warning('Instagram page exceeds %s bytes without usable JSON; giving up', max_page)
+            return
+
+
+def instagram_json_subtree(text):
+    """Decode just the post's shortcode_media object when present, else the whole document."""
+    m = INSTA_MEDIA_KEY_RE.search(text)
+    if m:
+        try:
+            media = JSON_DECODER.raw_decode(text, m.end())[0]
+            if media:
+                return media
+        except ValueError:
+            pass
+    return json.loads(text)
+
+
+def parse_instagram_chunks(chunks):
+    """parse_instagram_html over a stream of byte chunks; stops at the first block that decodes."""
+    data_json = None
+    blocks = iter_instagram_json_blocks(chunks)
+    try:
+        for kind, text in blocks:
+            try:
+                data_json = instagram_json_subtree(text)
+            except Exception as e:
+                LOG.warning('Failed to parse %s: %s', kind, e)
+                continue
+            if data_json:
+                break
+    finally:
+        blocks.close()
+    if not data_json:
+        LOG.warning('No JSON data found in HTML')
+        return None, []
+    LOG.info('Successfully parsed JSON data')
+    return instagram_media_from_json(data_json)
+
+
+def instagram_media_from_json(data_json):
+    """Caption and GraphImage / GraphVideo / GraphSidecar media of a post's JSON: (caption, [urls]).
+    One scan_payload pass; the caption is the first edge_media_to_caption text on a media node."""
+    media_urls = []
+    caption_text = None
+    for node in scan_payload(data_json).graph_nodes:
+        if not caption_text:
+            for edge in (node.get('edge_media_to_caption') or {}).get('edges') or ():
+                txt = edge.get('node', {}).get('text') if isinstance(edge, dict) else None
+                if isinstance(txt, str):
+                    caption_text = txt
+                    break
+        if node['__typename'] == 'GraphSidecar':
+            children = node.get('edge_sidecar_to_children', {}).get('edges', [])
+            LOG.info('Found GraphSidecar with %s children', len(children))
+            links = [ch.get('node', {}) for ch in children if isinstance(ch, dict)]
+        else:
+            links = [node]
+        for media in links:
+            link = media.get('display_url') or media.get('video_url') or media.get('url')
+            if link and link not in media_urls:
+                media_urls.append(link)
+    LOG.info('Scan completed, found %s media URLs', len(media_urls))
+    return clean_caption(caption_text) if caption_text else None, media_urls
+
+
+YTDL_BASE_OPTS = {'quiet': True, 'no_warnings': True}
+# Option profiles; download profiles write '%(title)s.%(ext)s' under the per-call paths={'home': dir}
+YTDL_PROFILES = {
+    'instagram': {'extract_flat': False, 'socket_timeout': 30, 'retries': 2},
+    'terabox': {'extract_flat': False, 'format': 'best', 'socket_timeout': 30, 'retries': 3, 'fragment_retries': 3,
+                'skip_unavailable_fragments': True, 'http_headers': {'User-Agent': DEFAULT_USER_AGENT}},
+    'youtube': {'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'},
+    'audio_m4a': {'format': 'bestaudio[ext=m4a]/bestaudio/best', 'outtmpl': '%(title)s.%(ext)s'},
+    'audio_mp3': {'format': 'bestaudio/best', 'outtmpl': '%(title)s.%(ext)s', 'postprocessors': [
+        {'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}]},
+    'audio_any': {'format': 'bestaudio/best', 'outtmpl': '%(title)s.%(ext)s'},
+    'audio_raw': {'format': 'bestaudio', 'outtmpl': '%(title)s.%(ext)s'},
+}
+
+
+class YtdlPool:
+    """Idle YoutubeDL instances per option profile, checked out by one thread at a time.
+    Building one processes the options and sets up extractors, cookies and the cache. A pooled
+    instance skips that and keeps its extractor instances (and their in-memory player caches).
+    Only plain extractions reuse instances, and only public state (the cookie jar) is cleared
+    between them. A call with its own params (e.g. a download directory) differs from the
+    profile, so it gets a fresh instance built with those options and closed afterwards.
+    """
+
+    def __init__(self, profiles, size):
+        self.profiles = profiles
+        self.size = size
+        self._idle = {name: [] for name in profiles}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _build(self, profile, **params):
+        import yt_dlp
+        opts = dict(YTDL_BASE_OPTS, **self.profiles[profile])
+        if YTDLP_CACHE_DIR:
+            opts['cachedir'] = YTDLP_CACHE_DIR
+        opts.update(params)
+        return yt_dlp.YoutubeDL(opts)
+
+    @contextmanager
+    def checkout(self, profile, **params):
+        ydl = None
+        if not params:
+            with self._lock:
+                idle = self._idle[profile]
+                ydl = idle.pop() if idle else None
+                if ydl is not None:
+                    self.reused += 1
+        if ydl is None:
+            with self._lock:
+                self.created += 1
+            ydl = self._build(profile, **params)
+        try:
+            yield ydl
+        finally:
+            self._checkin(profile, ydl, pooled=not params)
+
+    def _checkin(self, profile, ydl, pooled):
+        if pooled:
+            try:
+                ydl.cookiejar.clear()
+                with self._lock:
+                    if len(self._idle[profile]) < self.size:
+                        self._idle[profile].append(ydl)
+                        return
+            except Exception as e:
+                LOG.warning('Discarding yt-dlp instance (%s): %s', profile, e)
+        try:
+            ydl.close()
+        except Exception:
+            pass
+
+    def prewarm(self, profiles):
+        """Build one idle instance per profile ahead of the first request."""
+        for profile in profiles:
+            if profile not in self.profiles:
+                LOG.warning('Unknown yt-dlp profile to prewarm: %s', profile)
+                continue
+            try:
+                with self.checkout(profile):
+                    pass
+            except ImportError:
+                return
+            except Exception as e:
+                LOG.warning('yt-dlp prewarm failed for %s: %s', profile, e)
+
+    def stats(self):
+        with self._lock:
+            return {'created': self.created, 'reused': self.reused,
+                    'idle': sum(len(v) for v in self._idle.values())}
+
+
+YTDL_POOL = YtdlPool(YTDL_PROFILES, YTDLP_POOL_SIZE)
+
+
+class YtdlError(Exception):
+    """A yt-dlp call failed or timed out; carries only the message so it crosses process boundaries."""
+
+
+class YtdlUnavailable(YtdlError):
+    """yt-dlp could not do its job at all: a timeout, a dead worker or a network/server error.
+    Only these count against the yt-dlp endpoints' health; private or deleted links do not."""
+
+
+def ytdl_outage(exc):
+    """True if a yt-dlp exception (or one it wraps) is a network or server failure, not a content error."""
+    from yt_dlp.networking.exceptions import HTTPError, TransportError
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, HTTPError):
+            return exc.status >= 500 or exc.status == 429
+        if isinstance(exc, (TransportError, ConnectionError, TimeoutError)):
+            return True
+        exc_info = getattr(exc, 'exc_info', None)
+        exc = (getattr(exc, 'cause', None) or (exc_info[1] if exc_info else None)
+               or exc.__cause__ or exc.__context__)
+    return False
+
+
+def ytdl_extract(profile, url, download=False, **params):
+    """extract_info through this process's YTDL_POOL, returned as a plain (picklable) dict or None."""
+    try:
+        with YTDL_POOL.checkout(profile, **params) as ydl:
+            info = ydl.extract_info(url, download=download)
+            return ydl.sanitize_info(info) if info else None
+    except Exception as e:
+        # yt-dlp exceptions hold tracebacks and do not pickle
+        raise (YtdlUnavailable if ytdl_outage(e) else YtdlError)(str(e)) from None
+
+
+class YtdlProcessPool:
+    """Bounded spawn-based process pool for yt-dlp calls.
+    Keeps yt-dlp's pure-Python parsing and JS interpretation off the bot's GIL. Each worker is
+    replaced after max_tasks calls to shed leaked memory: natively on Python 3.11+, otherwise by
+    swapping in a fresh executor once workers * max_tasks calls went through the current one.
+    Callers block on the result with a timeout. A timed-out call is abandoned, not killed; yt-dlp's
+    own socket timeouts end it and recycling replaces its worker.
+    """
+
+    def __init__(self, workers, max_tasks):
+        self.workers = workers
+        self.max_tasks = max_tasks
+        self._native_recycle = sys.version_info >= (3, 11)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._submitted = 0
+        self.calls = 0
+        self.timeouts = 0
+        self.deaths = 0
+        self.starts = 0
+
+    def _create(self):
+        self.starts += 1
+        ctx = YtdlSpawnContext()
+        if self._native_recycle:
+            return ProcessPoolExecutor(self.workers, mp_context=ctx, max_tasks_per_child=self.max_tasks)
+        return ProcessPoolExecutor(self.workers, mp_context=ctx)
+
+    def _current(self, broken=None):
+        with self._lock:
+            old = self._executor
+            stale = not self._native_recycle and self._submitted >= self.workers * self.max_tasks
+            if old is None or old is broken or stale:
+                self._executor = self._create()
+                self._submitted = 0
+                if old is not None:
+                    old.shutdown(wait=False)  # running calls finish in the old workers
+            self._submitted += 1
+            return self._executor
+
+    def run(self, fn, *args, timeout=None, **kwargs):
+        self.calls += 1
+        executor = self._current()
+        try:
+            fut = executor.submit(fn, *args, **kwargs)
+        except (BrokenProcessPool, RuntimeError):
+            executor = self._current(broken=executor)
+            fut = executor.submit(fn, *args, **kwargs)
+        try:
+            return fut.result(timeout=timeout)
+        except FuturesTimeout:
+            fut.cancel()
+            self.timeouts += 1
+            raise YtdlUnavailable(f'yt-dlp timed out after {timeout:.0f}s') from None
+        except BrokenProcessPool:
+            self.deaths += 1
+            self._current(broken=executor)
+            raise YtdlUnavailable('yt-dlp worker process died') from None
+
+    def prewarm(self, profiles):
+        """Start the workers and build their pooled instances ahead of the first request."""
+        for _ in range(self.workers):
+            self._current().submit(prewarm_ytdl, profiles)
+
+    def stats(self):
+        return {'workers': self.workers, 'calls': self.calls, 'timeouts': self.timeouts,
+                'deaths': self.deaths, 'starts': self.starts}
+
+
+class YtdlSpawnContext(multiprocessing.context.SpawnContext):
+    """Spawn context naming its processes ytdl-N, so bot.py knows it is being re-imported in one."""
+
+    class Process(multiprocessing.context.SpawnProcess):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.name = 'ytdl-' + self.name.rsplit('-', 1)[-1]
+
+
+def prewarm_ytdl(profiles):
+    """YTDL_POOL.prewarm as a module-level function, so it can be sent to a worker process."""
+    YTDL_POOL.prewarm(profiles)
+
+
+YTDL_PROCS = YtdlProcessPool(YTDLP_PROCESSES, YTDLP_TASKS_PER_CHILD) if YTDLP_PROCESSES > 0 else None
+
+
+def run_ytdl(profile, url, download=False, timeout=None, **params):
+    """ytdl_extract in the yt-dlp process pool (in this thread when YTDLP_PROCESSES=0).
+    Returns the info dict or None; raises YtdlError on failure (YtdlUnavailable on timeouts,
+    dead workers and network errors).
+    """
+    timeout = timeout or (YTDLP_DOWNLOAD_TIMEOUT if download else YTDLP_TIMEOUT)
+    with span('yt-dlp', profile=profile, download=download):
+        if YTDL_PROCS is None:
+            return ytdl_extract(profile, url, download, **params)
+        return YTDL_PROCS.run(ytdl_extract, profile, url, download, timeout=timeout, **params)
+
+
+def get_instagram_with_ytdlp_fallback(url):
+    """Try Instagram API first, fallback to yt-dlp for better caption/media extraction."""
+    try:
         url = url.split('?')[0]  # Clean URL
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'socket_timeout': 30,
-            'retries': 2
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            if info:
-                caption = (info.get('description') or 
-                          info.get('title') or 
-                          info.get('alt_title') or "")
-                
-                media_urls = []
-                # Check if it's a multi-image/video post
-                if 'entries' in info and info['entries']:
-                    for entry in info['entries']:
-                        if entry and entry.get('url'):
-                            media_urls.append(entry['url'])
-                elif info.get('url'):
-                    media_urls.append(info['url'])
-                
-                return caption.strip(), media_urls
+        info = run_ytdl('instagram', url)
+        if info:
+            caption = (info.get('description') or 
+                      info.get('title') or 
+                      info.get('alt_title') or "")
+            
+            media_urls = []
+            # Check if it's a multi-image/video post
+            if 'entries' in info and info['entries']:
+                for entry in info['entries']:
+                    if entry and entry.get('url'):
+                        media_urls.append(entry['url'])
+            elif info.get('url'):
+                media_urls.append(info['url'])
+            
+            return caption.strip(), media_urls
+    except YtdlUnavailable:
+        raise  # an outage, counted by instagram_via_ytdlp
     except Exception as e:
         LOG.warning('yt-dlp Instagram fallback failed: %s', e)
     return None, []
 
 
+def instagram_via_ytdlp(url):
+    """get_instagram_with_ytdlp_fallback tracked as the 'yt-dlp:instagram' endpoint."""
+    return HEALTH.track('yt-dlp:instagram', lambda: get_instagram_with_ytdlp_fallback(url),
+                        failures=YtdlUnavailable, default=(None, []))
+
+
+def instagram_response_usable(resp):
+    """True if an Instagram resolver response contains media we can deliver."""
+    if not isinstance(resp, dict) or resp.get('error'):
+        return False
+    return bool(scan_payload(resp, limit=1).entries) or bool(resp.get('images') or resp.get('videos'))
+
+
+def resolve_instagram_apis(url):
+    """Query the Instagram resolver APIs and return the first usable response, or None.
+    INSTA_RESOLVE_MODE='race' runs them concurrently (staggered by INSTA_HEDGE_DELAY);
+    'sequential' tries them one by one in order.
+    """
+    # Healthiest first; endpoints with an open breaker go last and answer instantly
+    api_urls = HEALTH.order([INSTA_API_NODE, INSTA_API, INSTA_API_ALT, SOCIAL_DL_API])
+    if INSTA_RESOLVE_MODE == 'race':
+        resolvers = [(api_url, lambda api_url=api_url: fetch_json(api_url, params={'url': url})) for api_url in api_urls]
+        winner, data = race_resolvers(resolvers, instagram_response_usable, hedge_delay=INSTA_HEDGE_DELAY,
+                                      deadline=INSTA_DEADLINE)
+        if winner:
+            LOG.info('Instagram resolved via %s', winner)
+        return data
+    for api_url in api_urls:
+        try:
+            resp = fetch_json(api_url, params={'url': url})
+        except Exception as e:
+            LOG.warning('Instagram API exception at %s: %s', api_url, e)
+            resp = {'error': str(e)}
+        # Consider response usable if it has no error and contains any URL entries or images/videos arrays
+        if instagram_response_usable(resp):
+            LOG.info('Instagram resolved via %s', api_url)
+            return resp
+        LOG.warning('Instagram API returned nothing usable from %s: %s', api_url, (resp or {}).get('error'))
+    return None
+
+
 def get_terabox_with_ytdlp_fallback(url):
     """Try Terabox with yt-dlp as fallback - with aggressive retry and timeout config."""
     try:
-        import yt_dlp
         url_clean = url.split('?')[0]  # Clean URL
-        
-        # Configure yt-dlp with retry and timeout settings + best format selection
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'format': 'best',  # Select best available quality
-            'socket_timeout': 30,
-            'retries': 3,
-            'fragment_retries': 3,
-            'skip_unavailable_fragments': True,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url_clean, download=False)
-            if info:
-                dl_url = info.get('url')
-                if dl_url:
-                    file_name = info.get('title') or os.path.basename((dl_url or '').split('?')[0]) or 'terabox_file'
-                    size_bytes = info.get('filesize') or info.get('filesize_approx')
-                    caption = clean_caption(info.get('description') or info.get('title'))
-                    LOG.info('✅ yt-dlp Terabox fallback succeeded')
-                    return {
-                        'url': dl_url,
-                        'size_bytes': int(size_bytes) if size_bytes else None,
-                        'file_name': file_name,
-                        'caption': caption,
-                        'button_url': dl_url,
-                        'raw_data': {'source': 'yt-dlp', 'url_clean': url_clean}
-                    }
+        # Retry and timeout settings + best format selection live in the 'terabox' profile
+        info = run_ytdl('terabox', url_clean)
+        if info:
+            dl_url = info.get('url')
+            if dl_url:
+                file_name = info.get('title') or os.path.basename((dl_url or '').split('?')[0]) or 'terabox_file'
+                size_bytes = info.get('filesize') or info.get('filesize_approx')
+                caption = clean_caption(info.get('description') or info.get('title'))
+                LOG.info('✅ yt-dlp Terabox fallback succeeded')
+                return {
+                    'url': dl_url,
+                    'size_bytes': int(size_bytes) if size_bytes else None,
+                    'file_name': file_name,
+                    'caption': caption,
+                    'button_url': dl_url,
+                    'raw_data': {'source': 'yt-dlp', 'url_clean': url_clean}
+                }
+    except YtdlUnavailable:
+        raise  # an outage, counted against the 'yt-dlp:terabox' endpoint
     except Exception as e:
         LOG.warning('yt-dlp Terabox fallback failed: %s', e)
     return None
 
 
-def process_youtube(url):
-    """Use legacy YouTube API (always works) with inline upload buttons."""
-    # Use legacy API (yt-vid.hazex) which has structured video_with_audio/video_only/audio arrays
-    # Note: HQ API (yt-download.hazex) has 500 errors, so using legacy as primary
-    LOG.info('YouTube: Using legacy API')
-    legacy = fetch_json(YOUTUBE_LEGACY_API, params={'url': url})
-    if legacy and not legacy.get('error'):
-        # Parse legacy API response with video_with_audio, video_only, audio structure
-        normalized = []
-        title = legacy.get('title', 'YouTube Video')
-        thumbnail = legacy.get('thumbnail') or legacy.get('thumb') or legacy.get('image')  # Extract thumbnail URL
-        
-        # Process video_with_audio (combined video + audio) - highest priority
-        video_with_audio = legacy.get('video_with_audio', [])
-        if isinstance(video_with_audio, list):
-            for item in video_with_audio:
-                if not isinstance(item, dict) or not item.get('url'):
-                    continue
-                res = item.get('label', '')  # e.g., "mp4 (360p)"
-                height = item.get('height')
-                width = item.get('width')
-                ext = item.get('extension', 'mp4').lower()
-                size_bytes = item.get('size_bytes')
-                
-                # Parse size from clen if available
-                if size_bytes is None and 'clen=' in item.get('url', ''):
-                    try:
-                        clen_match = re.search(r'clen=(\d+)', item['url'])
-                        if clen_match:
-                            size_bytes = int(clen_match.group(1))
-                    except Exception:
-                        pass
-                
-                # Build label: resolution + size
-                label_parts = [res] if res else [f"{height}p" if height else "Video"]
-                if size_bytes:
-                    label_parts.append(human_size(size_bytes))
-                label = ' '.join(label_parts)
-                
-                normalized.append({
-                    'url': item['url'],
-                    'extension': ext,
-                    'resolution': f"{height}p" if height else res,
-                    'size_bytes': size_bytes,
-                    'label': label,
-                    'type': 'video_with_audio',
-                    'has_audio': True,
-                    'height': height or 0,
-                    'raw': item
-                })
-        
-        # Process video_only (video stream without audio) - secondary
-        video_only = legacy.get('video_only', [])
-        if isinstance(video_only, list):
-            for item in video_only:
-                if not isinstance(item, dict) or not item.get('url'):
-                    continue
-                res = item.get('label', '')
-                height = item.get('height')
-                ext = item.get('extension', 'mp4').lower()
-                size_bytes = item.get('size_bytes')
-                
-                if size_bytes is None and 'clen=' in item.get('url', ''):
-                    try:
-                        clen_match = re.search(r'clen=(\d+)', item['url'])
-                        if clen_match:
-                            size_bytes = int(clen_match.group(1))
-                    except Exception:
-                        pass
-                
-                label_parts = [res] if res else [f"{height}p" if height else "Video (no audio)"]
-                if size_bytes:
-                    label_parts.append(human_size(size_bytes))
-                label = ' '.join(label_parts)
-                
-                normalized.append({
-                    'url': item['url'],
-                    'extension': ext,
-                    'resolution': f"{height}p" if height else res,
-                    'size_bytes': size_bytes,
-                    'label': label,
-                    'type': 'video_only',
-                    'has_audio': False,
-                    'height': height or 0,
-                    'raw': item
-                })
-        
-        # Process audio-only options
-        audio = legacy.get('audio', [])
-        if isinstance(audio, list):
-            for item in audio:
-                if not isinstance(item, dict) or not item.get('url'):
-                    continue
-                res = item.get('label', '')
-                bitrate = item.get('bitrate')
-                ext = item.get('extension', 'm4a').lower()
-                size_bytes = item.get('size_bytes')
-                
-                if size_bytes is None and 'clen=' in item.get('url', ''):
-                    try:
-                        clen_match = re.search(r'clen=(\d+)', item['url'])
-                        if clen_match:
-                            size_bytes = int(clen_match.group(1))
-                    except Exception:
-                        pass
-                
-                label_parts = [res or f"Audio {ext.upper()}"] 
-                if size_bytes:
-                    label_parts.append(human_size(size_bytes))
-                label = ' '.join(label_parts)
-                
-                normalized.append({
-                    'url': item['url'],
-                    'extension': ext,
-                    'resolution': 'Audio',
-                    'size_bytes': size_bytes,
-                    'label': label,
-                    'type': 'audio',
-                    'has_audio': True,
-                    'height': 0,
-                    'raw': item
-                })
-        
-        if normalized:
-            # Choose best: video_with_audio (prefer highest resolution), then video_only
-            # Sort by: type priority (video_with_audio first), then by height descending
-            def sort_key(item):
-                type_priority = {'video_with_audio': 0, 'video_only': 1, 'audio': 2}
-                return (type_priority.get(item['type'], 3), -(item['height']))
-            
-            normalized.sort(key=sort_key)
-            best_entry = normalized[0]
-            best_index = normalized.index(best_entry)
-            
-            safe_title = (title or 'youtube_video').replace(' ', '_')[:80]
-            inferred_file = f"{safe_title}_{best_entry.get('resolution') or 'video'}.mp4"
-            caption = clean_caption(legacy.get('title')) or clean_caption(legacy.get('description'))
-            
-            LOG.info('YouTube: parsed %d qualities from legacy API', len(normalized))
-            return {
-                'url': best_entry['url'],
-                'size_bytes': best_entry['size_bytes'],
-                'file_name': inferred_file,
-                'caption': caption,
-                'qualities': normalized,
-                'best_index': best_index,
-                'thumbnail': thumbnail,  # Add thumbnail URL
-                'raw_entry': best_entry['raw'],
-                'raw_data': legacy
-            }
-    
-    # Fallback to multi-step API (get_task -> create_task -> check_task)
-    base = YOUTUBE_MULTI_API
-    get_resp = fetch_json(base, params={'function': 'get_task', 'url': url})
-    if get_resp.get('error'):
-        # Try yt-dlp fallback as last resort
-        LOG.warning('YouTube APIs failed, using yt-dlp fallback')
-        try:
-            import yt_dlp
-            ydl_opts = {
-                'quiet': True,
-                'no_warnings': True,
-                'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',  # Prefer best quality with audio
-            }
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                if info:
-                    formats = info.get('formats', [])
-                    normalized = []
-                    for f in formats:
-                        if not f.get('url'):
-                            continue
-                        vcodec = f.get('vcodec')
-                        acodec = f.get('acodec')
-                        if vcodec == 'none' and acodec == 'none':
-                            continue
-                        if vcodec != 'none' and (acodec and acodec != 'none'):
-                            ftype = 'video_with_audio'
-                            has_audio = True
-                        elif vcodec != 'none' and (not acodec or acodec == 'none'):
-                            ftype = 'video_only'
-                            has_audio = False
-                        elif acodec and acodec != 'none' and (not vcodec or vcodec == 'none'):
-                            ftype = 'audio'
-                            has_audio = True
-                        else:
-                            ftype = 'unknown'
-                            has_audio = False
-                        normalized.append({
-                            'url': f['url'],
-                            'extension': f.get('ext', 'mp4'),
-                            'resolution': f"{f.get('height', '?')}p" if f.get('height') else f.get('format_note', ''),
-                            'size_bytes': f.get('filesize') or f.get('filesize_approx'),
-                            'label': f"{f.get('height', '?')}p ({human_size(f.get('filesize') or f.get('filesize_approx') or 0)})",
-                            'type': ftype,
-                            'has_audio': has_audio,
-                            'height': f.get('height') or 0,
-                            'raw': f
-                        })
-                    if normalized:
-                        best = max(normalized, key=lambda x: x['raw'].get('height', 0) if x['raw'].get('height') else 0)
-                        return {
-                            'url': best['url'],
-                            'size_bytes': best['size_bytes'],
-                            'file_name': f"{info.get('title', 'video')[:80]}.mp4",
-                            'caption': clean_caption(info.get('title')),
-                            'qualities': normalized,
-                            'best_index': normalized.index(best),
-                            'raw_entry': best['raw'],
-                            'raw_data': info
-                        }
-        except Exception as e:
-            LOG.warning('yt-dlp fallback also failed: %s', e)
-        return {'error': get_resp.get('error')}
-    
-    hash_val = get_resp.get('hash') or get_resp.get('video_hash') or get_resp.get('data', {}).get('hash')
-    title = get_resp.get('title') or get_resp.get('video_title') or get_resp.get('data', {}).get('title')
-    if not hash_val:
-        return {'error': 'No hash returned from get_task'}
+def parse_terabox_response(data):
+    """Normalize a Noor / SOCIAL_DL Terabox response into the result dict, or None if unusable."""
+    if not isinstance(data, dict) or data.get('error') or data.get('status_code'):
+        return None
+    LOG.info('Terabox response keys: %s', list(data.keys()))
+    # Try multiple possible response keys
+    dl = data.get('proxy_url') or data.get('download_link') or data.get('url') or data.get('directUrl')
+    if not dl:
+        return None
+    file_name = data.get('file_name') or data.get('filename') or data.get('title') or os.path.basename((dl or '').split('?')[0]) or 'terabox_file'
+    size_bytes = None
+    try:
+        if data.get('size_bytes') is not None:
+            size_bytes = int(data.get('size_bytes'))
+        elif data.get('size') is not None:
+            size_bytes = int(data.get('size'))
+    except Exception:
+        size_bytes = None
+    caption = clean_caption(data.get('title') or data.get('file_name') or data.get('filename'))
+    return {
+        'url': dl,
+        'size_bytes': size_bytes,
+        'file_name': file_name,
+        'caption': caption,
+        'button_url': dl,
+        'raw_entry': {'download_link': data.get('download_link'), 'proxy_url': data.get('proxy_url')},
+        'raw_data': data
+    }
 
-    # Step 2: create_task
-    create_resp = fetch_json(base, params={'function': 'create_task', 'hash': hash_val})
-    if create_resp.get('error'):
-        return {'error': create_resp.get('error')}
-    task_id = create_resp.get('task_id') or create_resp.get('id') or create_resp.get('data', {}).get('task_id')
-    if not task_id:
-        return {'error': 'No task_id returned from create_task'}
 
-    # Step 3: poll check_task
-    start = time.time()
-    final_resp = None
-    while time.time() - start < 90:
-        chk = fetch_json(base, params={'function': 'check_task', 'task_id': task_id})
-        if chk.get('error'):
-            return {'error': chk.get('error')}
-        status = chk.get('status') or chk.get('state') or chk.get('data', {}).get('status')
-        if status and str(status).lower() in ['finished', 'success', 'completed', 'done']:
-            final_resp = chk
-            break
-        entries_probe = find_download_entries(chk)
-        if entries_probe:
-            final_resp = chk
-            break
-        time.sleep(2)
-    if final_resp is None:
-        return {'error': 'Timeout waiting for YouTube task to finish'}
+def resolve_terabox(url):
+    """Race Noor API, SOCIAL_DL and yt-dlp for a Terabox link within TERABOX_DEADLINE.
+    Every resolver starts immediately; only ones that fail fast get a second attempt.
+    """
+    chain = {
+        endpoint_key(TERA_API): ('Noor API', lambda: parse_terabox_response(fetch_json(TERA_API + quote_plus(url), timeout=30))),
+        endpoint_key(SOCIAL_DL_API): ('SOCIAL_DL API', lambda: parse_terabox_response(fetch_json(SOCIAL_DL_API, params={'url': url}, timeout=30))),
+        'yt-dlp:terabox': ('yt-dlp', lambda: HEALTH.track('yt-dlp:terabox', lambda: get_terabox_with_ytdlp_fallback(url), failures=YtdlUnavailable)),
+    }
+    resolvers = [chain[name] for name in HEALTH.order(list(chain))]
+    winner, result = race_resolvers(resolvers, lambda r: bool(r.get('url')),
+                                    deadline=TERABOX_DEADLINE, fast_fail_retries=1)
+    if result:
+        LOG.info('✅ Terabox: %s succeeded', winner)
+        return result
+    return {'error': 'Terabox: All APIs failed. The link may be invalid, expired, or service temporarily unavailable. Try again shortly.'}
+
+
+def normalize_ytdlp_formats(info):
+    """yt-dlp info dict -> result dict listing every playable format, or None."""
+    formats = info.get('formats', [])
+    normalized = []
+    for f in formats:
+        if not f.get('url'):
+            continue
+        vcodec = f.get('vcodec')
+        acodec = f.get('acodec')
+        if vcodec == 'none' and acodec == 'none':
+            continue
+        if vcodec != 'none' and (acodec and acodec != 'none'):
+            ftype = 'video_with_audio'
+            has_audio = True
+        elif vcodec != 'none' and (not acodec or acodec == 'none'):
+            ftype = 'video_only'
+            has_audio = False
+        elif acodec and acodec != 'none' and (not vcodec or vcodec == 'none'):
+            ftype = 'audio'
+            has_audio = True
+        else:
+            ftype = 'unknown'
+            has_audio = False
+        normalized.append({
+            'url': f['url'],
+            'extension': f.get('ext', 'mp4'),
+            'resolution': f"{f.get('height', '?')}p" if f.get('height') else f.get('format_note', ''),
+            'size_bytes': f.get('filesize') or f.get('filesize_approx'),
+            'label': f"{f.get('height', '?')}p ({human_size(f.get('filesize') or f.get('filesize_approx') or 0)})",
+            'type': ftype,
+            'has_audio': has_audio,
+            'height': f.get('height') or 0,
+            'raw': f
+        })
+    if normalized:
+        best = max(normalized, key=lambda x: x['raw'].get('height', 0) if x['raw'].get('height') else 0)
+        return {
+            'url': best['url'],
+            'size_bytes': best['size_bytes'],
+            'file_name': f"{info.get('title', 'video')[:80]}.mp4",
+            'caption': clean_caption(info.get('title')),
+            'qualities': normalized,
+            'best_index': normalized.index(best),
+            'raw_entry': best['raw'],
+            'raw_data': info
+        }
+    return None
+
 
+def normalize_youtube_task(final_resp, title, get_resp):
+    """Finished check_task response -> result dict, or an error dict if it lists no formats."""
     entries = find_download_entries(final_resp)
     if not entries and isinstance(final_resp, dict):
         for key in ['formats', 'qualities', 'videos', 'data']:
@@ -839,11 +2485,483 @@ def process_youtube(url):
         'raw_entry': best_entry['raw'],
         'raw_data': final_resp
     }
-# Session store for YouTube format selections
-FORMAT_SESSIONS = {}
-SESSION_COUNTER = itertools.count(1)
 
 
+def process_youtube(url):
+    """Resolve a YouTube link through the legacy and multi-step APIs, healthiest first."""
+    # The HQ API (yt-download.hazex) returns 500s, so it is not part of the chain
+    chain = {endpoint_key(YOUTUBE_LEGACY_API): youtube_from_legacy, endpoint_key(YOUTUBE_MULTI_API): youtube_from_multi}
+    result = {'error': 'No YouTube API available'}
+    for name in HEALTH.order(list(chain)):
+        result = chain[name](url)
+        if not result.get('error'):
+            return result
+        LOG.warning('YouTube API %s failed: %s', name, result.get('error'))
+    return result
+
+
+def youtube_from_legacy(url):
+    """Legacy YouTube API (yt-vid.hazex) with structured video_with_audio/video_only/audio arrays."""
+    LOG.info('YouTube: Using legacy API')
+    legacy = fetch_json(YOUTUBE_LEGACY_API, params={'url': url})
+    if legacy and not legacy.get('error'):
+        result = normalize_legacy_youtube(legacy)
+        if result:
+            return result
+    return {'error': (legacy or {}).get('error') or 'No YouTube formats from legacy API'}
+
+
+def normalize_legacy_youtube(legacy):
+    """Legacy API response -> result dict listing every quality, or None if it has none."""
+    # Parse legacy API response with video_with_audio, video_only, audio structure
+    normalized = []
+    title = legacy.get('title', 'YouTube Video')
+    thumbnail = legacy.get('thumbnail') or legacy.get('thumb') or legacy.get('image')  # Extract thumbnail URL
+    
+    # Process video_with_audio (combined video + audio) - highest priority
+    video_with_audio = legacy.get('video_with_audio', [])
+    if isinstance(video_with_audio, list):
+        for item in video_with_audio:
+            if not isinstance(item, dict) or not item.get('url'):
+                continue
+            res = item.get('label', '')  # e.g., "mp4 (360p)"
+            height = item.get('height')
+            width = item.get('width')
+            ext = item.get('extension', 'mp4').lower()
+            size_bytes = item.get('size_bytes')
+            
+            # Parse size from clen if available
+            if size_bytes is None and 'clen=' in item.get('url', ''):
+                try:
+                    clen_match = re.search(r'clen=(\d+)', item['url'])
+                    if clen_match:
+                        size_bytes = int(clen_match.group(1))
+                except Exception:
+                    pass
+            
+            # Build label: resolution + size
+            label_parts = [res] if res else [f"{height}p" if height else "Video"]
+            if size_bytes:
+                label_parts.append(human_size(size_bytes))
+            label = ' '.join(label_parts)
+            
+            normalized.append({
+                'url': item['url'],
+                'extension': ext,
+                'resolution': f"{height}p" if height else res,
+                'size_bytes': size_bytes,
+                'label': label,
+                'type': 'video_with_audio',
+                'has_audio': True,
+                'height': height or 0,
+                'raw': item
+            })
+    
+    # Process video_only (video stream without audio) - secondary
+    video_only = legacy.get('video_only', [])
+    if isinstance(video_only, list):
+        for item in video_only:
+            if not isinstance(item, dict) or not item.get('url'):
+                continue
+            res = item.get('label', '')
+            height = item.get('height')
+            ext = item.get('extension', 'mp4').lower()
+            size_bytes = item.get('size_bytes')
+            
+            if size_bytes is None and 'clen=' in item.get('url', ''):
+                try:
+                    clen_match = re.search(r'clen=(\d+)', item['url'])
+                    if clen_match:
+                        size_bytes = int(clen_match.group(1))
+                except Exception:
+                    pass
+            
+            label_parts = [res] if res else [f"{height}p" if height else "Video (no audio)"]
+            if size_bytes:
+                label_parts.append(human_size(size_bytes))
+            label = ' '.join(label_parts)
+            
+            normalized.append({
+                'url': item['url'],
+                'extension': ext,
+                'resolution': f"{height}p" if height else res,
+                'size_bytes': size_bytes,
+                'label': label,
+                'type': 'video_only',
+                'has_audio': False,
+                'height': height or 0,
+                'raw': item
+            })
+    
+    # Process audio-only options
+    audio = legacy.get('audio', [])
+    if isinstance(audio, list):
+        for item in audio:
+            if not isinstance(item, dict) or not item.get('url'):
+                continue
+            res = item.get('label', '')
+            bitrate = item.get('bitrate')
+            ext = item.get('extension', 'm4a').lower()
+            size_bytes = item.get('size_bytes')
+            
+            if size_bytes is None and 'clen=' in item.get('url', ''):
+                try:
+                    clen_match = re.search(r'clen=(\d+)', item['url'])
+                    if clen_match:
+                        size_bytes = int(clen_match.group(1))
+                except Exception:
+                    pass
+            
+            label_parts = [res or f"Audio {ext.upper()}"] 
+            if size_bytes:
+                label_parts.append(human_size(size_bytes))
+            label = ' '.join(label_parts)
+            
+            normalized.append({
+                'url': item['url'],
+                'extension': ext,
+                'resolution': 'Audio',
+                'size_bytes': size_bytes,
+                'label': label,
+                'type': 'audio',
+                'has_audio': True,
+                'height': 0,
+                'raw': item
+            })
+    
+    if normalized:
+        # Choose best: video_with_audio (prefer highest resolution), then video_only
+        # Sort by: type priority (video_with_audio first), then by height descending
+        def sort_key(item):
+            type_priority = {'video_with_audio': 0, 'video_only': 1, 'audio': 2}
+            return (type_priority.get(item['type'], 3), -(item['height']))
+        
+        normalized.sort(key=sort_key)
+        best_entry = normalized[0]
+        best_index = normalized.index(best_entry)
+        
+        safe_title = (title or 'youtube_video').replace(' ', '_')[:80]
+        inferred_file = f"{safe_title}_{best_entry.get('resolution') or 'video'}.mp4"
+        caption = clean_caption(legacy.get('title')) or clean_caption(legacy.get('description'))
+        
+        LOG.info('YouTube: parsed %d qualities from legacy API', len(normalized))
+        return {
+            'url': best_entry['url'],
+            'size_bytes': best_entry['size_bytes'],
+            'file_name': inferred_file,
+            'caption': caption,
+            'qualities': normalized,
+            'best_index': best_index,
+            'thumbnail': thumbnail,  # Add thumbnail URL
+            'raw_entry': best_entry['raw'],
+            'raw_data': legacy
+        }
+    return None
+
+
+def youtube_from_multi(url):
+    """Multi-step YouTube API (get_task -> create_task -> check_task)."""
+    base = YOUTUBE_MULTI_API
+    get_resp = fetch_json(base, params={'function': 'get_task', 'url': url})
+    if get_resp.get('error'):
+        # Try yt-dlp fallback as last resort
+        LOG.warning('YouTube APIs failed, using yt-dlp fallback')
+        try:
+            info = run_ytdl('youtube', url)  # prefers best quality with audio
+            result = normalize_ytdlp_formats(info) if info else None
+            if result:
+                return result
+        except Exception as e:
+            LOG.warning('yt-dlp fallback also failed: %s', e)
+        return {'error': get_resp.get('error')}
+    
+    hash_val = get_resp.get('hash') or get_resp.get('video_hash') or get_resp.get('data', {}).get('hash')
+    title = get_resp.get('title') or get_resp.get('video_title') or get_resp.get('data', {}).get('title')
+    if not hash_val:
+        return {'error': 'No hash returned from get_task'}
+
+    # Step 2: create_task
+    create_resp = fetch_json(base, params={'function': 'create_task', 'hash': hash_val})
+    if create_resp.get('error'):
+        return {'error': create_resp.get('error')}
+    task_id = create_resp.get('task_id') or create_resp.get('id') or create_resp.get('data', {}).get('task_id')
+    if not task_id:
+        return {'error': 'No task_id returned from create_task'}
+
+    # Step 3: poll check_task
+    start = time.time()
+    final_resp = None
+    while time.time() - start < 90:
+        chk = fetch_json(base, params={'function': 'check_task', 'task_id': task_id})
+        if chk.get('error'):
+            return {'error': chk.get('error')}
+        status = chk.get('status') or chk.get('state') or chk.get('data', {}).get('status')
+        if status and str(status).lower() in ['finished', 'success', 'completed', 'done']:
+            final_resp = chk
+            break
+        entries_probe = find_download_entries(chk)
+        if entries_probe:
+            final_resp = chk
+            break
+        time.sleep(2)
+    if final_resp is None:
+        return {'error': 'Timeout waiting for YouTube task to finish'}
+
+    return normalize_youtube_task(final_resp, title, get_resp)
+
+
+# Session store for YouTube format selections (the ytupload:/ytaudio: buttons)
+FORMAT_SESSIONS_MAX = int(os.getenv('FORMAT_SESSIONS_MAX', '2000'))  # least recently used sessions go first
+FORMAT_SESSION_TTL = int(os.getenv('FORMAT_SESSION_TTL', '21600'))  # seconds; YouTube stream URLs expire after ~6h
+FORMAT_SESSIONS_DB = os.getenv('FORMAT_SESSIONS_DB', '')  # SQLite path so buttons survive restarts; empty = memory only
+
+
+class FormatChoice:
+    """One downloadable format of a session: only what the upload/audio buttons need."""
+    __slots__ = ('url', 'type', 'resolution', 'extension', 'size_bytes', 'vcodec', 'acodec')
+
+    def __init__(self, url, type, resolution, extension, size_bytes=None, vcodec=None, acodec=None):
+        self.url = url
+        self.type = type
+        self.resolution = resolution
+        self.extension = extension
+        self.size_bytes = size_bytes
+        self.vcodec = vcodec
+        self.acodec = acodec
+
+    @classmethod
+    def from_quality(cls, q):
+        raw = q.get('raw') or {}
+        return cls(q.get('url'), q.get('type'), q.get('resolution'), q.get('extension'),
+                   q.get('size_bytes'), raw.get('vcodec'), raw.get('acodec'))
+
+    def as_row(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+
+class FormatSession:
+    __slots__ = ('source', 'qualities', 'created')
+
+    def __init__(self, source, qualities, created):
+        self.source = source
+        self.qualities = qualities
+        self.created = created
+
+
+class FormatSessionStore:
+    """Format pickers waiting for a button press, keyed by a random 48-bit id.
+    Bounded (LRU) and expiring; with a path, sessions are also kept in SQLite so
+    buttons sent before a restart still work.
+    """
+
+    def __init__(self, max_entries, ttl, path=''):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.evicted = 0
+
+    def _connect(self):
+        # Opened lazily so importing bot.py never touches the disk
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS format_sessions ('
+                ' id INTEGER PRIMARY KEY, source TEXT NOT NULL, qualities TEXT NOT NULL, created REAL NOT NULL)'
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def add(self, source, qualities):
+        """Store the qualities offered for source; returns the session id for callback_data."""
+        now = time.time()
+        session = FormatSession(source, tuple(FormatChoice.from_quality(q) for q in qualities), now)
+        with self._lock:
+            session_id = int.from_bytes(os.urandom(6), 'big')
+            while session_id in self._sessions:
+                session_id = int.from_bytes(os.urandom(6), 'big')
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+            if self.path:
+                try:
+                    conn = self._connect()
+                    conn.execute('DELETE FROM format_sessions WHERE created < ?', (now - self.ttl,))
+                    conn.execute('INSERT OR REPLACE INTO format_sessions (id, source, qualities, created) VALUES (?, ?, ?, ?)',
+                                 (session_id, source, json.dumps([c.as_row() for c in session.qualities]), now))
+                    conn.commit()
+                except sqlite3.Error as e:
+                    LOG.warning('format session write failed: %s', e)
+        return session_id
+
+    def get(self, session_id):
+        """The live session for session_id, or None if it expired or never existed."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None and self.path:
+                session = self._load(session_id)
+            if session is None:
+                return None
+            if time.time() - session.created > self.ttl:
+                self._sessions.pop(session_id, None)
+                return None
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+            return session
+
+    def _load(self, session_id):
+        try:
+            row = self._connect().execute(
+                'SELECT source, qualities, created FROM format_sessions WHERE id = ?', (session_id,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            LOG.warning('format session lookup failed: %s', e)
+            return None
+        if not row:
+            return None
+        return FormatSession(row[0], tuple(FormatChoice(*fields) for fields in json.loads(row[1])), row[2])
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._sessions), 'evicted': self.evicted}
+
+
+FORMAT_SESSIONS = FormatSessionStore(FORMAT_SESSIONS_MAX, FORMAT_SESSION_TTL, FORMAT_SESSIONS_DB)
+
+
+def normalize_url(url):
+    """Fold equivalent links into one cache key.
+    Tracking params are dropped, youtu.be / shorts / embed / watch forms collapse to
+    'youtube:<id>' and Instagram posts collapse to 'instagram:<kind>:<shortcode>'.
+    """
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    for prefix in ('www.', 'm.', 'mobile.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parsed.path.rstrip('/') or '/'
+    dropped = set(TRACKING_PARAMS)
+    for suffix, params in HOST_TRACKING_PARAMS.items():
+        if host == suffix or host.endswith('.' + suffix):
+            dropped |= params
+    query = [(k, v) for k, v in parse_qsl(parsed.query)
+             if not k.lower().startswith('utm_') and k.lower() not in dropped]
+    if host in ('youtube.com', 'music.youtube.com', 'youtu.be', 'youtube-nocookie.com'):
+        if host == 'youtu.be':
+            video_id = path.strip('/').split('/')[0]
+        else:
+            m = re.match(r'/(?:shorts|embed|live|v)/([\w-]+)', path)
+            video_id = m.group(1) if m else dict(query).get('v')
+        if video_id:
+            return f'youtube:{video_id}'
+    if host == 'instagram.com' or host.endswith('.instagram.com'):
+        m = re.match(r'/(?:[\w.]+/)?(p|reels?|tv)/([\w-]+)', path)
+        if m:
+            kind = 'reel' if m.group(1).startswith('reel') else m.group(1)
+            return f'instagram:{kind}:{m.group(2)}'
+    key = host + path
+    if query:
+        key += '?' + urlencode(sorted(query))
+    return key
+
+
+def media_url_expiry(url):
+    """Return the unix time at which a signed media URL stops working, or None if unsigned."""
+    if not isinstance(url, str):
+        return None
+    q = {k.lower(): v for k, v in parse_qsl(urlparse(url).query)}
+    candidates = []
+    for key in ('expire', 'expires', 'x-expires'):  # googlevideo, CloudFront-style, TikTok CDN
+        if q.get(key, '').isdigit():
+            candidates.append(int(q[key]))
+    if q.get('oe'):  # Instagram / Facebook CDN: hex unix timestamp
+        try:
+            candidates.append(int(q['oe'], 16))
+        except ValueError:
+            pass
+    if q.get('x-amz-date') and q.get('x-amz-expires', '').isdigit():
+        try:
+            signed_at = datetime.strptime(q['x-amz-date'], '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+            candidates.append(int(signed_at.timestamp()) + int(q['x-amz-expires']))
+        except ValueError:
+            pass
+    return min(candidates) if candidates else None
+
+
+def result_cache_ttl(result):
+    """Seconds a resolver result may be reused: RESOLVE_CACHE_TTL, shortened by the
+    earliest expiry of any signed media URL it contains."""
+    urls = [result.get('url'), result.get('button_url')]
+    urls += [it.get('url') for it in result.get('items') or [] if isinstance(it, dict)]
+    urls += [q.get('url') for q in result.get('qualities') or [] if isinstance(q, dict)]
+    expiries = [e for e in (media_url_expiry(u) for u in urls) if e]
+    ttl = RESOLVE_CACHE_TTL
+    if expiries:
+        ttl = min(ttl, min(expiries) - time.time() - RESOLVE_CACHE_EXPIRY_MARGIN)
+    return ttl
+
+
+class ResolutionCache:
+    """Thread-safe LRU cache of resolver results with a per-entry expiry time."""
+
+    def __init__(self, max_entries, default_ttl):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # key -> (expires_at, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            if item[0] <= time.time():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(item[1])
+
+    def put(self, key, result, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+RESOLVE_CACHE = ResolutionCache(RESOLVE_CACHE_SIZE, RESOLVE_CACHE_TTL)
+
 
 def handle_api_for_url(url):
     """Pick which API to call and return a dict with file info or error."""
@@ -853,7 +2971,7 @@ def handle_api_for_url(url):
     if 'youtube.com' in lower or 'youtu.be' in lower:
         yt_result = process_youtube(url)
         if yt_result.get('error'):
-            LOG.warning('Multi-step YouTube API failed: %s; trying legacy', yt_result.get('error'))
+            LOG.warning('YouTube APIs failed: %s; trying raw legacy entries', yt_result.get('error'))
             legacy = fetch_json(YOUTUBE_LEGACY_API, params={'url': url})
             if legacy and not legacy.get('error'):
                 data = legacy
@@ -892,9 +3010,27 @@ def handle_api_for_url(url):
     elif 'instagram.com' in lower:
         is_reel = '/reel/' in url.lower()
         is_post = '/p/' in url.lower()
-        # First try yt-dlp for albums/carousels (best multi-item support)
-        LOG.info('Trying yt-dlp first for Instagram (best for albums/carousels)')
-        ytdlp_caption, ytdlp_media = get_instagram_with_ytdlp_fallback(url)
+        api_data = None
+        apis_tried = False
+        if INSTA_RESOLVE_MODE == 'race':
+            # yt-dlp runs alongside the API race; its result keeps priority for reels/carousels
+            LOG.info('Racing yt-dlp and Instagram APIs')
+            ytdlp_future = HEDGE_POOL.submit(instagram_via_ytdlp, url)
+            api_data = resolve_instagram_apis(url)
+            apis_tried = True
+            # With a usable API answer yt-dlp only gets INSTA_YTDLP_GRACE to add a carousel or
+            # caption; otherwise it is the last resort and is waited for in full
+            try:
+                grace = INSTA_YTDLP_GRACE if api_data is not None else None  # only usable answers are returned
+                ytdlp_caption, ytdlp_media = ytdlp_future.result(timeout=grace)
+            except FuturesTimeout:
+                ytdlp_future.cancel()  # still queued behind other lookups: never start it
+                LOG.info('yt-dlp slower than the Instagram APIs; using the API result')
+                ytdlp_caption, ytdlp_media = None, []
+        else:
+            # First try yt-dlp for albums/carousels (best multi-item support)
+            LOG.info('Trying yt-dlp first for Instagram (best for albums/carousels)')
+            ytdlp_caption, ytdlp_media = instagram_via_ytdlp(url)
         # Reels: force single video behavior
         if is_reel:
             chosen = None
@@ -930,27 +3066,7 @@ def handle_api_for_url(url):
             }
         
         # Try multiple Instagram API resolvers for single items
-        data = None
-        for api_url in [INSTA_API_NODE, INSTA_API, INSTA_API_ALT, SOCIAL_DL_API]:
-            try:
-                resp = fetch_json(api_url, params={'url': url})
-            except Exception as e:
-                LOG.warning('Instagram API exception at %s: %s', api_url, e)
-                resp = {'error': str(e)}
-            # Consider response usable if it has no error and contains any URL entries
-            if resp and not resp.get('error'):
-                probe = find_download_entries(resp)
-                if probe:
-                    data = resp
-                    LOG.info('Instagram resolved via %s', api_url)
-                    break
-                # Some APIs return images/videos arrays
-                if isinstance(resp, dict) and (resp.get('images') or resp.get('videos')):
-                    data = resp
-                    LOG.info('Instagram resolved (images/videos) via %s', api_url)
-                    break
-            else:
-                LOG.warning('Instagram API returned error from %s: %s', api_url, (resp or {}).get('error'))
+        data = api_data if apis_tried else resolve_instagram_apis(url)
         
         # If APIs failed but yt-dlp got something, use it
         if not data or data.get('error'):
@@ -983,7 +3099,7 @@ def handle_api_for_url(url):
                     shortcode = match.group(2)
                     # Simple public caption scraper
                     caption_url = f'https://www.instagram.com/p/{shortcode}/?__a=1&__d=dis'
-                    caption_resp = requests.get(caption_url, timeout=10, headers={'User-Agent': 'Mozilla/5.0'})
+                    caption_resp = http_get(caption_url, timeout=10)
                     if caption_resp.ok:
                         caption_json = caption_resp.json()
                         # Navigate through Instagram's JSON structure
@@ -1079,71 +3195,7 @@ def handle_api_for_url(url):
             if isinstance(data['result'], dict):
                 data['result']['__explicit_items'] = explicit_items
     elif '1024tera' in lower or 'terabox' in lower or '1024' in lower:
-        # Try multiple Terabox APIs with aggressive fallback chain and retries
-        apis_to_try = [
-            ('Noor API', TERA_API + quote_plus(url), {'timeout': 30}),
-            ('SOCIAL_DL API', SOCIAL_DL_API, {'timeout': 30, 'params': {'url': url}}),
-        ]
-        
-        for api_name, api_url_or_base, kwargs in apis_to_try:
-            for attempt in range(2):  # 2 attempts per API
-                try:
-                    LOG.info(f'Terabox: Attempt {attempt+1} with {api_name}...')
-                    
-                    if 'params' in kwargs:
-                        data = fetch_json(api_url_or_base, **kwargs)
-                    else:
-                        data = fetch_json(api_url_or_base, **kwargs)
-                    
-                    if data:
-                        LOG.info(f'{api_name} response keys: {list(data.keys()) if isinstance(data, dict) else type(data)}')
-                    
-                    # Process successful API response (skip if error or status_code present)
-                    if isinstance(data, dict) and not data.get('error') and not data.get('status_code'):
-                        # Try multiple possible response keys
-                        dl = data.get('proxy_url') or data.get('download_link') or data.get('url') or data.get('directUrl')
-                        if dl:
-                            file_name = data.get('file_name') or data.get('filename') or data.get('title') or os.path.basename((dl or '').split('?')[0]) or 'terabox_file'
-                            size_bytes = None
-                            try:
-                                if data.get('size_bytes') is not None:
-                                    size_bytes = int(data.get('size_bytes'))
-                                elif data.get('size') is not None:
-                                    size_bytes = int(data.get('size'))
-                            except Exception:
-                                size_bytes = None
-                            caption = clean_caption(data.get('title') or data.get('file_name') or data.get('filename'))
-                            LOG.info(f'✅ Terabox: {api_name} succeeded on attempt {attempt+1}')
-                            return {
-                                'url': dl,
-                                'size_bytes': size_bytes,
-                                'file_name': file_name,
-                                'caption': caption,
-                                'button_url': dl,
-                                'raw_entry': {'download_link': data.get('download_link'), 'proxy_url': data.get('proxy_url')},
-                                'raw_data': data
-                            }
-                except Exception as e:
-                    LOG.warning(f'Terabox {api_name} attempt {attempt+1} failed: {e}')
-                    if attempt == 0:
-                        time.sleep(1)  # Wait before retry
-                    continue
-        
-        # Try yt-dlp as final fallback (3rd attempt)
-        LOG.info('Terabox: Trying yt-dlp as final fallback...')
-        for yt_attempt in range(2):
-            try:
-                ytdlp_result = get_terabox_with_ytdlp_fallback(url)
-                if ytdlp_result:
-                    LOG.info(f'✅ Terabox: yt-dlp fallback succeeded on attempt {yt_attempt+1}')
-                    if ytdlp_result:
-                        return ytdlp_result
-            except Exception as e:
-                LOG.warning(f'Terabox yt-dlp attempt {yt_attempt+1} failed: {e}')
-                if yt_attempt == 0:
-                    time.sleep(1)
-        
-        return {'error': 'Terabox: All APIs failed. The link may be invalid, expired, or service temporarily unavailable. Try again shortly.'}
+        return resolve_terabox(url)
     else:
         # Primary generic multi-platform fallback
         data = fetch_json(SOCIAL_DL_API, params={'url': url})
@@ -1153,10 +3205,11 @@ def handle_api_for_url(url):
     if isinstance(data, dict) and data.get('error'):
         return {'error': data.get('error')}
 
-    # Collect download entries
-    entries = find_download_entries(data)
+    # One pass over the response: download entries, caption candidates, sizes and media hints
+    scan = scan_payload(data)
+    entries = scan.entries
     if not entries and isinstance(data, dict) and 'download_link' in data:
-        entries = [{'url': data.get('download_link'), 'file_name': data.get('file_name'), 'size_bytes': data.get('size_bytes')}]
+        scan.add({'url': data.get('download_link'), 'file_name': data.get('file_name'), 'size_bytes': data.get('size_bytes')})
 
     entry = choose_entry(entries)
     if not entry:
@@ -1177,7 +3230,7 @@ def handle_api_for_url(url):
     # Caption extraction
     caption = None
     if 'instagram.com' in lower:
-        caption = extract_instagram_caption(data)
+        caption = pick_caption(scan.captions)
         # Also check result.caption directly
         if not caption and isinstance(data, dict):
             result_obj = data.get('result', {})
@@ -1185,11 +3238,7 @@ def handle_api_for_url(url):
                 caption = result_obj.get('caption')
         if not caption:
             caption = data.get('caption') if isinstance(data, dict) else None
-        # Try result block if main extraction failed
-        if not caption and isinstance(data, dict):
-            result_block = data.get('result')
-            if result_block:
-                caption = extract_instagram_caption(result_block)
+        # (The result block's candidates are a subset of scan.captions, so no separate pass over it)
         # Debug logging for Instagram
         if not caption:
             LOG.warning('Instagram caption not found. Checking data structure...')
@@ -1234,28 +3283,19 @@ def handle_api_for_url(url):
         if explicit_items:
             items.extend(explicit_items)
         else:
-            for e in entries:
+            for e, (size_e, size_text), kind in zip(entries, scan.sizes, scan.kinds):
                 media_url = e.get('url') or e.get('download_link')
                 if not media_url:
                     continue
                 fname_e = e.get('file_name') or e.get('fileName') or e.get('filename') or os.path.basename(media_url.split('?')[0])
-                size_e = None
-                size_text = None
-                for sf in ['size_bytes', 'size', 'filesize', 'filesize_approx']:
-                    val = e.get(sf)
-                    if val:
-                        try:
-                            size_e = int(val)
-                            size_text = human_size(size_e)
-                            break
-                        except Exception:
-                            # keep raw string as size_text
-                            if isinstance(val, str):
-                                size_text = val
                 ext_lower = fname_e.lower()
                 url_lower = media_url.lower()
                 is_video = any(ext in url_lower or ext_lower.endswith(ext) for ext in ['.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv', '.m4v'])
-                is_image = any(ext in url_lower or ext_lower.endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.webp', '.gif']) or not is_video
+                has_image_ext = any(ext in url_lower or ext_lower.endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.webp', '.gif'])
+                # Extensionless CDN URLs: fall back to the type the response itself gave
+                if not is_video and not has_image_ext and kind == 'video':
+                    is_video = True
+                is_image = has_image_ext or not is_video
                 items.append({
                     'url': media_url,
                     'file_name': fname_e,
@@ -1325,7 +3365,312 @@ def handle_api_for_url(url):
                 # Annotate album for downstream captioning (first item gets album header)
                 result_obj['album_count'] = len(items)
 
-    return result_obj
+    return result_obj
+
+
+def url_platform(url):
+    """Metrics label for the platform a link belongs to (mirrors handle_api_for_url's routing)."""
+    lower = url.lower()
+    if 'youtube.com' in lower or 'youtu.be' in lower:
+        return 'youtube'
+    if 'tiktok.com' in lower:
+        return 'tiktok'
+    if 'instagram.com' in lower:
+        return 'instagram'
+    if '1024tera' in lower or 'terabox' in lower or '1024' in lower:
+        return 'terabox'
+    return 'other'
+
+
+def resolve_url(url):
+    """handle_api_for_url behind RESOLVE_CACHE. Errors are never cached."""
+    key = normalize_url(url)
+    start = time.monotonic()
+    cached = RESOLVE_CACHE.get(key)
+    if cached is not None:
+        LOG.info('Resolution cache hit for %s', key)
+        METRICS.observe('resolve_seconds', time.monotonic() - start, platform=url_platform(url), cache='hit', outcome='ok')
+        with span('resolve', platform=url_platform(url), cache='hit'):
+            pass
+        return cached
+    with span('resolve', platform=url_platform(url), cache='miss') as sp:
+        result = handle_api_for_url(url)
+        sp['failed'] = result.get('error') if isinstance(result, dict) else None
+    ok = isinstance(result, dict) and not result.get('error')
+    METRICS.observe('resolve_seconds', time.monotonic() - start, platform=url_platform(url), cache='miss',
+                    outcome='ok' if ok else 'error')
+    if ok:
+        RESOLVE_CACHE.put(key, result, result_cache_ttl(result))
+    return result
+
+
+class JobQueue:
+    """Bounded queue of slow jobs served by its own worker threads (started on first use)."""
+
+    def __init__(self, workers, max_queued):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._threads = []
+        self.active = 0
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f'job-{i + 1}', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _run(self):
+        while True:
+            fn, args, kwargs, queued_at, trace = self._queue.get()
+            name = getattr(fn, '__name__', str(fn))
+            started = time.monotonic()
+            METRICS.observe('job_wait_seconds', started - queued_at, job=name)
+            if trace:
+                trace.add_span('queue_wait', trace.offset() - (started - queued_at), started - queued_at)
+            with self._lock:
+                self.active += 1
+            try:
+                with bind_trace(trace), span(name):
+                    fn(*args, **kwargs)
+            except Exception:
+                LOG.exception('Job %s failed', name)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                METRICS.observe('job_run_seconds', time.monotonic() - started, job=name)
+                if trace:
+                    trace.release()
+                self._queue.task_done()
+
+    def next_position(self):
+        """Place in line a job submitted now would get (0 = a worker is free)."""
+        waiting = self._queue.qsize()
+        if self.active + waiting < self.workers:
+            return 0
+        return waiting + 1
+
+    def is_full(self):
+        return self._queue.full()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs). Raises queue.Full when JOB_QUEUE_SIZE jobs are already waiting."""
+        self._start()
+        trace = current_trace()
+        if trace:
+            trace.acquire()  # the job keeps the caller's trace open until it finishes
+        try:
+            self._queue.put_nowait((fn, args, kwargs, time.monotonic(), trace))
+        except queue.Full:
+            if trace:
+                trace.release()
+            raise
+
+    def stats(self):
+        return {'workers': self.workers, 'active': self.active, 'queued': self._queue.qsize(),
+                'capacity': self._queue.maxsize}
+
+
+JOBS = JobQueue(JOB_WORKERS, JOB_QUEUE_SIZE)
+METRICS.gauge('job_queue_depth', 'Jobs waiting for a free worker.', lambda: JOBS.stats()['queued'])
+METRICS.gauge('job_workers_active', 'Job workers currently running a job.', lambda: JOBS.stats()['active'])
+METRICS.gauge('job_workers', 'Size of the job worker pool.', lambda: JOBS.workers)
+
+# Durable record of accepted jobs, so work cut short by a crash or restart is queued again
+JOB_JOURNAL_PATH = os.getenv('JOB_JOURNAL_PATH', str(Path(__file__).parent / 'jobs.db'))  # empty disables
+JOB_SPOOL_DIR = Path(os.getenv('JOB_SPOOL_DIR', str(Path(__file__).parent / 'spool')))  # per-job scratch files
+JOB_MAX_RECOVERIES = int(os.getenv('JOB_MAX_RECOVERIES', '3'))  # restarts a job may survive before it is dropped
+_JOB_LOCAL = threading.local()
+
+
+class JobJournal:
+    """SQLite (WAL) table of accepted jobs: kind, replay payload, status message, and how far
+    each got (resolving, downloading, muxing, uploading). Rows are deleted when a job finishes;
+    rows still present at startup are jobs a crash or restart interrupted.
+    Journaled jobs keep their scratch files in JOB_SPOOL_DIR/<id> so downloads can resume.
+    """
+
+    def __init__(self, path, spool_dir):
+        self.path = path
+        self.spool_dir = spool_dir
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Opened lazily so importing bot.py never touches the disk
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, chat_id INTEGER NOT NULL,'
+                ' status_msg_id INTEGER, state TEXT NOT NULL, partial TEXT, recoveries INTEGER NOT NULL DEFAULT 0,'
+                ' created REAL NOT NULL, updated REAL NOT NULL)'
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        if not self.path:
+            return []
+        try:
+            with self._lock:
+                conn = self._connect()
+                rows = conn.execute(sql, params).fetchall()
+                conn.commit()
+                return rows
+        except sqlite3.Error as e:
+            LOG.warning('job journal update failed: %s', e)
+            return []
+
+    def add(self, kind, payload, chat_id, status_msg_id):
+        """Record an accepted job; returns its id (None when the journal is disabled)."""
+        if not self.path:
+            return None
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute('INSERT INTO jobs (id, kind, payload, chat_id, status_msg_id, state, created, updated)'
+                      ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                      (job_id, kind, json.dumps(payload), chat_id, status_msg_id, 'queued', now, now))
+        return job_id
+
+    def set_state(self, job_id, state, partial=None):
+        self._execute('UPDATE jobs SET state = ?, partial = COALESCE(?, partial), updated = ? WHERE id = ?',
+                      (state, partial, time.time(), job_id))
+
+    def finish(self, job_id):
+        """Forget a job that ran to the end (delivered or failed) and delete its spool directory."""
+        if not job_id:
+            return
+        self._execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        shutil.rmtree(self.spool_dir / job_id, ignore_errors=True)
+
+    def unfinished(self, shard=None, shards=1):
+        """Jobs a previous run accepted but never finished (only chats owned by shard, if given)."""
+        rows = self._execute('SELECT id, kind, payload, chat_id, status_msg_id, state, recoveries FROM jobs ORDER BY created')
+        jobs = [{'id': r[0], 'kind': r[1], 'payload': json.loads(r[2]), 'chat_id': r[3], 'status_msg_id': r[4],
+                 'state': r[5], 'recoveries': r[6]} for r in rows]
+        if shard is not None:
+            jobs = [job for job in jobs if job['chat_id'] % shards == shard]
+        for job in jobs:
+            self._execute('UPDATE jobs SET recoveries = recoveries + 1 WHERE id = ?', (job['id'],))
+        return jobs
+
+    def spool(self, job_id):
+        path = self.spool_dir / job_id
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def owns(self, path):
+        """True if path lies in a job's spool directory (files there may be resumed)."""
+        return bool(self.path) and Path(path).resolve().is_relative_to(self.spool_dir.resolve())
+
+
+JOURNAL = JobJournal(JOB_JOURNAL_PATH, JOB_SPOOL_DIR)
+
+
+def current_job_id():
+    return getattr(_JOB_LOCAL, 'job_id', None)
+
+
+def journal_state(state, partial=None):
+    """Record how far the journaled job on this thread got (no-op outside one)."""
+    job_id = current_job_id()
+    if not job_id or getattr(_JOB_LOCAL, 'state', None) == (state, partial):
+        return
+    _JOB_LOCAL.state = (state, partial)
+    JOURNAL.set_state(job_id, state, str(partial) if partial else None)
+
+
+def journaled(job_id, job):
+    """Wrap job so it runs as journal entry job_id, which is removed once job returns or raises."""
+    if not job_id:
+        return job
+
+    def run(*args, **kwargs):
+        _JOB_LOCAL.job_id, _JOB_LOCAL.state = job_id, None
+        try:
+            return job(*args, **kwargs)
+        finally:
+            if current_job_id() == job_id:  # unless the job handed its entry to a waiting request
+                JOURNAL.finish(job_id)
+            _JOB_LOCAL.job_id = None
+    run.__name__ = job.__name__  # JobQueue names spans and metrics after the job
+    return run
+
+
+@contextmanager
+def job_workdir(name=''):
+    """Scratch directory for the current job: its spool directory (or subdirectory name) when
+    journaled, kept until the job finishes so a restarted job finds its partial downloads;
+    otherwise a temporary one."""
+    job_id = current_job_id()
+    if job_id:
+        path = JOURNAL.spool(job_id) / name
+        path.mkdir(exist_ok=True)
+        yield str(path)
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yield tmpdir
+
+
+PROCESSING_TEXT = "<b>⏳ Processing your request...</b>\n\n🔍 Analyzing URL\n⚙️ Fetching data\n📥 Preparing download\n\n<i>Please wait...</i>"
+BUSY_TEXT = "<b>🚦 Bot is busy right now</b>\n\nToo many downloads are waiting. Please try again in a minute."
+
+
+def queued_text(position):
+    return f"<b>🕒 Queued — position {position}</b>\n\n<i>All download slots are busy. Your request will start automatically.</i>"
+
+
+def enqueue_callback(call, job):
+    """Run a slow button-press job on the job pool, telling the user if it has to wait."""
+    trace = begin_trace(job.__name__, chat=call.message.chat.id, data=call.data)
+    try:
+        position = JOBS.next_position()
+        if JOBS.is_full():
+            bot.answer_callback_query(call.id, "🚦 Bot is busy, please try again in a minute.", show_alert=True)
+            return
+        if position:
+            try:
+                bot.edit_message_text(queued_text(position), call.message.chat.id, call.message.message_id)
+            except Exception:
+                pass
+        try:
+            submit_callback_job(job, call)
+        except queue.Full:
+            bot.answer_callback_query(call.id, "🚦 Bot is busy, please try again in a minute.", show_alert=True)
+            return
+        if position:
+            answer_callback(call)  # stop the button spinner now; the queued text says the rest
+    finally:
+        end_trace(trace)
+
+
+def submit_callback_job(job, call, job_id=None):
+    """Journal and queue a button-press job; raises queue.Full like JOBS.submit.
+    The raw callback query is journaled so the press can be replayed after a restart."""
+    raw = json.loads(call.json) if isinstance(call.json, str) else call.json
+    job_id = job_id or JOURNAL.add('callback', {'job': job.__name__, 'call': raw},
+                                   call.message.chat.id, call.message.message_id)
+    try:
+        JOBS.submit(journaled(job_id, job), call)
+    except queue.Full:
+        JOURNAL.finish(job_id)
+        raise
+
+
+def answer_callback(call, text=None, show_alert=None):
+    """Answer a button press from a job. Telegram rejects answers that come too late (a long
+    queue, or a press replayed after a restart); that must not abort the job."""
+    try:
+        bot.answer_callback_query(call.id, text, show_alert=show_alert)
+    except Exception as e:
+        LOG.info('Could not answer callback query: %s', e)
 
 
 @bot.message_handler(commands=['start'])
@@ -1500,24 +3845,185 @@ def cmd_supported(msg):
     bot.reply_to(msg, platforms_text)
 
 
+def is_admin(msg):
+    return bool(msg.from_user) and msg.from_user.id in ADMIN_IDS
+
+
+@bot.message_handler(commands=['trace'], func=is_admin)
+def cmd_trace(msg):
+    """Admin: /trace lists the slowest recent requests, /trace <id> shows one timeline."""
+    parts = (msg.text or '').split()
+    if len(parts) > 1:
+        trace = find_trace(parts[1])
+        bot.reply_to(msg, format_trace(trace) if trace else f"<b>No trace {escape(parts[1])}</b> (only the last {TRACE_BUFFER_SIZE} are kept)")
+        return
+    traces = sorted(recent_traces(), key=lambda t: t.duration, reverse=True)[:10]
+    if not traces:
+        bot.reply_to(msg, "<b>No finished requests yet.</b>")
+        return
+    lines = [f"<b>🐢 Slowest of the last {len(recent_traces())} requests</b>", ""]
+    for t in traces:
+        target = t.attrs.get('url') or t.attrs.get('data') or ''
+        lines.append(f"<code>{t.id}</code> {t.duration:.1f}s {escape(t.label)} {escape(str(target))[:60]}")
+    lines.append("\n<i>/trace &lt;id&gt; for the timeline</i>")
+    bot.reply_to(msg, '\n'.join(lines))
+
+
+def ytdl_stats_line():
+    """yt-dlp line of /stats: the worker processes when yt-dlp runs in them, else the in-process pool."""
+    if YTDL_PROCS is not None:
+        procs = YTDL_PROCS.stats()
+        return (f"<b>yt-dlp processes:</b> {procs['workers']} workers, {procs['calls']} calls, "
+                f"{procs['timeouts']} timed out, {procs['deaths']} worker deaths, {procs['starts']} pool starts")
+    ytdl = YTDL_POOL.stats()
+    return f"<b>yt-dlp pool:</b> {ytdl['created']} built, {ytdl['reused']} reused, {ytdl['idle']} idle"
+
+
+@bot.message_handler(commands=['stats'], func=is_admin)
+def cmd_stats(msg):
+    """Admin: live job, cache, download and resolver health numbers."""
+    jobs = JOBS.stats()
+    resolve = RESOLVE_CACHE.stats()
+    file_ids = FILE_ID_CACHE.stats()
+    downloads = download_stats()
+    flights = FLIGHTS.stats()
+    sessions = FORMAT_SESSIONS.stats()
+    lines = [
+        "<b>📊 Live stats</b>",
+        f"<b>Jobs:</b> {jobs['active']}/{jobs['workers']} active, {jobs['queued']}/{jobs['capacity']} queued",
+        f"<b>Resolve cache:</b> {resolve['size']} entries, {resolve['hit_rate']:.0%} hits ({resolve['hits']}/{resolve['hits'] + resolve['misses']})",
+        f"<b>file_id cache:</b> {file_ids['hit_rate']:.0%} hits ({file_ids['hits']}/{file_ids['hits'] + file_ids['misses']})",
+        f"<b>Downloads:</b> {downloads['resumes']} resumes ({human_size(downloads['resumed_bytes'])} saved), {downloads['restarts']} restarts",
+        ytdl_stats_line(),
+        f"<b>Format sessions:</b> {sessions['size']} live, {sessions['evicted']} evicted",
+        f"<b>Coalesced:</b> {flights['joined']} duplicate requests shared {flights['led']} jobs, {flights['in_flight']} in flight",
+        "<b>Resolvers:</b>",
+    ]
+    for name, h in sorted(HEALTH.stats().items()):
+        latency = f"{h['latency']:.2f}s" if h['latency'] is not None else '-'
+        lines.append(f"• {escape(name)}: {h['state']}, {h['success_rate']:.0%} ok, {latency}, {h['calls']} calls")
+    bot.reply_to(msg, '\n'.join(lines))
+
+
+COALESCED_TEXT = "<b>⏳ Someone just requested this too</b>\n\n<i>It is being prepared now and will arrive here shortly.</i>"
+SESSION_EXPIRED_TEXT = "<b>❌ Session expired</b>\n\n<i>These buttons no longer work. Please send the URL again.</i>"
+
+
+def callback_session(call):
+    """Format session a ytupload:/ytaudio: button press refers to, or None if it is gone."""
+    try:
+        return FORMAT_SESSIONS.get(int(call.data.split(':')[1]))
+    except (IndexError, ValueError):
+        return None
+
+
+def session_expired(call):
+    """Tell the presser their format session is gone; the message edit also reaches them
+    when the callback query is too old to be answered (a recovered or long-queued press)."""
+    answer_callback(call, "❌ Session expired. Please send the URL again.", show_alert=True)
+    try:
+        bot.edit_message_text(SESSION_EXPIRED_TEXT, call.message.chat.id, call.message.message_id)
+    except Exception:
+        pass
+
+
+def quality_variant(quality):
+    """file_id cache variant of one entry of a YouTube format session."""
+    return f"{quality.type}:{quality.resolution or quality.extension}"
+
+
+def format_flight_key(call):
+    """(source, variant) shared by every press of the same quality or audio button, or None."""
+    parts = call.data.split(':')
+    try:
+        session = FORMAT_SESSIONS.get(int(parts[1]))
+        if not session:
+            return None
+        qualities = session.qualities
+        if parts[0] == 'ytaudio':
+            source = session.source or (qualities[0].url if qualities else None)
+            return (normalize_url(source), 'audio') if source else None
+        return (normalize_url(session.source), quality_variant(qualities[int(parts[2])]))
+    except (IndexError, ValueError):
+        return None
+
+
+def coalesce_callback(call, job, body):
+    """Run body(call) unless the same media is already in flight; then wait for that job instead."""
+    key = format_flight_key(call)
+    if key is None:
+        # Expired or malformed session: body reports it to the user
+        body(call)
+        return
+    job_id = current_job_id()
+    if not FLIGHTS.join_or_lead(key, lambda delivery: serve_coalesced_callback(delivery, call, job, job_id)):
+        LOG.info('Coalesced %s (%s) onto the in-flight job', key[0], key[1])
+        _JOB_LOCAL.job_id = None  # the journal entry now belongs to the waiting press, not this run
+        try:
+            bot.edit_message_text(COALESCED_TEXT, call.message.chat.id, call.message.message_id)
+            answer_callback(call)
+        except Exception:
+            pass
+        return
+    try:
+        body(call)
+    finally:
+        FLIGHTS.finish(key)
+
+
+def serve_coalesced_callback(delivery, call, job, job_id=None):
+    """Finish a button press that waited on another chat's job: re-send its upload or run job."""
+    chat_id = call.message.chat.id
+    if deliver_coalesced(chat_id, delivery, 'callback'):
+        JOURNAL.finish(job_id)
+        try:
+            bot.delete_message(chat_id, call.message.message_id)
+        except Exception:
+            pass
+        return
+    try:
+        submit_callback_job(job, call, job_id)
+    except queue.Full:
+        bot.edit_message_text(BUSY_TEXT, chat_id, call.message.message_id)
+
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith('ytupload:'))
 def handle_yt_upload_callback(call):
-    """Handle YouTube upload button callback."""
+    """Queue a YouTube upload button press on the job pool."""
+    enqueue_callback(call, yt_upload_job)
+
+
+def yt_upload_job(call):
+    """Handle YouTube upload button callback (identical presses share one upload)."""
+    coalesce_callback(call, yt_upload_job, upload_youtube_quality)
+
+
+def upload_youtube_quality(call):
+    """Download and upload the quality picked on the YouTube format message."""
     try:
         parts = call.data.split(':')
         session_id = int(parts[1])
         best_index = int(parts[2])
         
-        if session_id not in FORMAT_SESSIONS:
-            bot.answer_callback_query(call.id, "❌ Session expired. Please send the URL again.", show_alert=True)
+        session = FORMAT_SESSIONS.get(session_id)
+        if session is None:
+            session_expired(call)
             return
         
-        qualities = FORMAT_SESSIONS[session_id]
+        source_url = session.source
+        qualities = session.qualities
         best = qualities[best_index]
+        variant = quality_variant(best)
         
         chat_id = call.message.chat.id
         username = call.from_user.username or call.from_user.first_name or 'User'
         
+        # Already delivered this quality before: re-send by file_id
+        if deliver_cached(chat_id, source_url, variant):
+            bot.delete_message(chat_id, call.message.message_id)
+            answer_callback(call)
+            return
+        
         # Update message to show upload in progress (no manual download button)
         bot.edit_message_text(
             f"<b>📤 Uploading best quality...</b>",
@@ -1525,20 +4031,20 @@ def handle_yt_upload_callback(call):
             call.message.message_id
         )
         
-        dl_url = best['url']
-        fname = f"video_{best.get('resolution', 'best')}.mp4"
-        size_bytes = best.get('size_bytes')
-        base_caption = f"<b>✅ YouTube Video</b>\n<b>Quality:</b> {best.get('resolution') or best.get('extension')}"
+        dl_url = best.url
+        fname = f"video_{best.resolution or 'best'}.mp4"
+        size_bytes = best.size_bytes
+        base_caption = f"<b>✅ YouTube Video</b>\n<b>Quality:</b> {best.resolution or best.extension}"
         caption = base_caption + "\n\n<b>💜 <a href=\"https://t.me/TeraInstaShortsDownloaderbot\">Pocket Downloader Bot</a></b>"
 
         # If selected format is video_only, attempt mux with best available audio
-        if best.get('type') == 'video_only':
-            audio_candidates = [q for q in qualities if q.get('type') == 'audio']
+        if best.type == 'video_only':
+            audio_candidates = [q for q in qualities if q.type == 'audio']
             if audio_candidates:
                 # Choose highest bitrate/size audio
-                audio_best = sorted(audio_candidates, key=lambda a: a.get('size_bytes') or 0, reverse=True)[0]
+                audio_best = sorted(audio_candidates, key=lambda a: a.size_bytes or 0, reverse=True)[0]
                 bot.edit_message_text(
-                    f"<b>🔄 Merging video + audio...</b>\n\n<code>{best.get('resolution')}</code> + <code>{audio_best.get('extension')}</code>",
+                    f"<b>🔄 Merging video + audio...</b>\n\n<code>{best.resolution}</code> + <code>{audio_best.extension}</code>",
                     chat_id,
                     call.message.message_id
                 )
@@ -1548,26 +4054,18 @@ def handle_yt_upload_callback(call):
                     caption += "\n<b>⚠️ Audio merge unavailable (FFmpeg missing)</b>"
                 else:
                     try:
-                        with tempfile.TemporaryDirectory() as tmpdir:
-                            tmpdirp = Path(tmpdir)
-                            vpath = tmpdirp / 'video.mp4'
-                            apath = tmpdirp / f"audio.{audio_best.get('extension','m4a')}"
-                            okv = stream_download(dl_url, vpath, LOCAL_DOWNLOAD_LIMIT)
-                            oka = stream_download(audio_best['url'], apath, LOCAL_DOWNLOAD_LIMIT)
-                            if okv and oka and vpath.exists() and apath.exists():
-                                out_path = tmpdirp / 'merged.mp4'
-                                cmd = [ffmpeg_path, '-y', '-i', str(vpath), '-i', str(apath), '-c:v', 'copy', '-c:a', 'aac', '-shortest', str(out_path)]
-                                try:
-                                    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=90)
-                                except Exception:
-                                    pass
-                                if out_path.exists():
-                                    caption = base_caption + f"\n<b>Audio merged:</b> {audio_best.get('extension').upper()}" + "\n\n<b>💜 <a href=\"https://t.me/TeraInstaShortsDownloaderbot\">Pocket Downloader Bot</a></b>"
-                                    with open(out_path, 'rb') as f:
-                                        bot.send_video(chat_id, f, caption=caption, supports_streaming=True)
-                                    bot.delete_message(chat_id, call.message.message_id)
-                                    bot.answer_callback_query(call.id)
-                                    return
+                        with job_workdir() as tmpdir:
+                            out_path = mux_video_audio(ffmpeg_path, dl_url, audio_best.url,
+                                                       audio_best.extension or 'm4a', Path(tmpdir),
+                                                       video_hint=best.vcodec, audio_hint=audio_best.acodec)
+                            if out_path:
+                                caption = base_caption + f"\n<b>Audio merged:</b> {(audio_best.extension or 'm4a').upper()}" + "\n\n<b>💜 <a href=\"https://t.me/TeraInstaShortsDownloaderbot\">Pocket Downloader Bot</a></b>"
+                                with open(out_path, 'rb') as f:
+                                    sent_msg = bot.send_video(chat_id, f, caption=caption, supports_streaming=True)
+                                remember_sent(source_url, variant, sent_msg, 'video', caption)
+                                bot.delete_message(chat_id, call.message.message_id)
+                                answer_callback(call)
+                                return
                             # If merge failed, append warning and fall through to normal handling
                             caption += "\n<b>⚠️ Merge failed; sending original (silent) stream.</b>"
                     except Exception:
@@ -1578,9 +4076,10 @@ def handle_yt_upload_callback(call):
 
         try:
             # Try remote upload first for small files
-            if size_bytes and size_bytes <= MAX_UPLOAD and best.get('type') != 'video_only':
+            if size_bytes and size_bytes <= MAX_UPLOAD and best.type != 'video_only':
                 try:
                     sent_msg = bot.send_video(chat_id, dl_url, caption=caption, supports_streaming=True)
+                    remember_sent(source_url, variant, sent_msg, 'video', caption)
                     # Forward to backup channel
                     try:
                         forward_to_backup_channel(chat_id, sent_msg.video.file_id, 'video', caption, username)
@@ -1588,12 +4087,13 @@ def handle_yt_upload_callback(call):
                         pass
                     bot.delete_message(chat_id, call.message.message_id)
                 except Exception:
-                    with tempfile.TemporaryDirectory() as tmpdir:
+                    with job_workdir() as tmpdir:
                         temp_path = Path(tmpdir) / fname
                         ok = stream_download(dl_url, temp_path, LOCAL_DOWNLOAD_LIMIT)
                         if ok and temp_path.exists():
                             with open(temp_path, 'rb') as f:
                                 sent_msg = bot.send_video(chat_id, f, caption=caption, supports_streaming=True)
+                                remember_sent(source_url, variant, sent_msg, 'video', caption)
                                 # Forward to backup channel
                                 try:
                                     forward_to_backup_channel(chat_id, sent_msg.video.file_id, 'video', caption, username)
@@ -1601,6 +4101,7 @@ def handle_yt_upload_callback(call):
                                     pass
                             bot.delete_message(chat_id, call.message.message_id)
                         else:
+                            METRICS.inc('link_fallbacks_total', reason='fetch_failed')
                             bot.edit_message_text(
                                 caption + "\n\n<b>⚠️ Could not upload directly. Use the quality link buttons above.</b>",
                                 chat_id,
@@ -1608,14 +4109,16 @@ def handle_yt_upload_callback(call):
                             )
             else:
                 # For video_only or large files, perform local download attempt (silent if no merge)
-                with tempfile.TemporaryDirectory() as tmpdir:
+                with job_workdir() as tmpdir:
                     temp_path = Path(tmpdir) / fname
                     ok = stream_download(dl_url, temp_path, LOCAL_DOWNLOAD_LIMIT)
-                    if ok and temp_path.exists() and (best.get('type') != 'video_only'):
+                    if ok and temp_path.exists() and best.type != 'video_only':
                         with open(temp_path, 'rb') as f:
-                            bot.send_video(chat_id, f, caption=caption, supports_streaming=True)
+                            sent_msg = bot.send_video(chat_id, f, caption=caption, supports_streaming=True)
+                        remember_sent(source_url, variant, sent_msg, 'video', caption)
                         bot.delete_message(chat_id, call.message.message_id)
                     else:
+                        METRICS.inc('link_fallbacks_total', reason='too_large')
                         bot.edit_message_text(
                             caption + "\n\n<b>⚠️ File too large or silent; use the quality link buttons above.</b>",
                             chat_id,
@@ -1623,40 +4126,57 @@ def handle_yt_upload_callback(call):
                         )
         except Exception:
             LOG.exception('Upload failed in callback')
+            METRICS.inc('link_fallbacks_total', reason='upload_failed')
             bot.edit_message_text(
                 caption + "\n\n<b>⚠️ Upload failed. Use the quality link buttons above.</b>",
                 chat_id,
                 call.message.message_id
             )
         
-        bot.answer_callback_query(call.id)
+        answer_callback(call)
     except Exception:
         LOG.exception('Error in callback handler')
-        bot.answer_callback_query(call.id, "❌ Error processing request", show_alert=True)
+        answer_callback(call, "❌ Error processing request", show_alert=True)
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('ytaudio:'))
 def handle_yt_audio_callback(call):
-    """Handle YouTube audio extraction callback."""
+    """Queue a YouTube audio extraction button press on the job pool."""
+    enqueue_callback(call, yt_audio_job)
+
+
+def yt_audio_job(call):
+    """Handle YouTube audio extraction callback (identical presses share one extraction)."""
+    coalesce_callback(call, yt_audio_job, extract_youtube_audio)
+
+
+def extract_youtube_audio(call):
+    """Extract and upload the audio track of the video on the YouTube format message."""
     try:
         parts = call.data.split(':')
         session_id = int(parts[1])
         
-        if session_id not in FORMAT_SESSIONS:
-            bot.answer_callback_query(call.id, "❌ Session expired. Please send the URL again.", show_alert=True)
+        session = FORMAT_SESSIONS.get(session_id)
+        if session is None:
+            session_expired(call)
             return
         
-        qualities = FORMAT_SESSIONS[session_id]
-        # Get the original URL from the first quality entry
-        original_url = qualities[0].get('raw', {}).get('url') if qualities else None
+        qualities = session.qualities
+        # Prefer the page URL the user sent; fall back to the first quality entry
+        original_url = session.source or (qualities[0].url if qualities else None)
         
         if not original_url:
-            bot.answer_callback_query(call.id, "❌ Could not retrieve original URL", show_alert=True)
+            answer_callback(call, "❌ Could not retrieve original URL", show_alert=True)
             return
         
         chat_id = call.message.chat.id
         username = call.from_user.username or call.from_user.first_name or 'User'
         
+        if deliver_cached(chat_id, original_url, 'audio'):
+            bot.delete_message(chat_id, call.message.message_id)
+            answer_callback(call, "✅ Audio extracted successfully!")
+            return
+        
         # Update message to show audio extraction in progress
         bot.edit_message_text(
             f"<b>🎵 Extracting audio...</b>\n\n<i>This may take a moment...</i>",
@@ -1665,92 +4185,70 @@ def handle_yt_audio_callback(call):
         )
         
         try:
-            import yt_dlp
             # Attempt ffmpeg availability early (for postprocessors)
             ffmpeg_path = ensure_ffmpeg()
             
             # Create temp directory for download
-            with tempfile.TemporaryDirectory() as tmpdir:
-                output_template = os.path.join(tmpdir, '%(title)s.%(ext)s')
-                
+            with job_workdir() as tmpdir:
                 # Try to get audio without FFmpeg conversion first
-                ydl_opts = {
-                    'format': 'bestaudio[ext=m4a]/bestaudio/best',
-                    'outtmpl': output_template,
-                    'quiet': True,
-                    'no_warnings': True,
-                }
-                
                 try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        info = ydl.extract_info(original_url, download=True)
-                        title = info.get('title', 'audio')
+                    info = run_ytdl('audio_m4a', original_url, download=True, paths={'home': tmpdir})
+                    title = info.get('title', 'audio')
+                    
+                    # Find the downloaded audio file
+                    audio_files = list(Path(tmpdir).glob('*.*'))
+                    if audio_files:
+                        audio_path = audio_files[0]
+                        caption = f"<b>🎵 YouTube Audio</b>\n<b>Title:</b> {title}\n\n<b>💜 <a href=\"https://t.me/TeraInstaShortsDownloaderbot\">Pocket Downloader Bot</a></b>"
                         
-                        # Find the downloaded audio file
-                        audio_files = list(Path(tmpdir).glob('*.*'))
-                        if audio_files:
-                            audio_path = audio_files[0]
-                            caption = f"<b>🎵 YouTube Audio</b>\n<b>Title:</b> {title}\n\n<b>💜 <a href=\"https://t.me/TeraInstaShortsDownloaderbot\">Pocket Downloader Bot</a></b>"
-                            
-                            # Send as audio
-                            with open(audio_path, 'rb') as f:
-                                bot.send_audio(
-                                    chat_id,
-                                    f,
-                                    caption=caption,
-                                    title=title,
-                                    performer="YouTube"
-                                )
-                            
-                            bot.delete_message(chat_id, call.message.message_id)
-                            bot.answer_callback_query(call.id, "✅ Audio extracted successfully!")
-                        else:
-                            raise Exception("No audio file downloaded")
+                        # Send as audio
+                        with open(audio_path, 'rb') as f:
+                            sent_msg = bot.send_audio(
+                                chat_id,
+                                f,
+                                caption=caption,
+                                title=title,
+                                performer="YouTube"
+                            )
+                        remember_sent(original_url, 'audio', sent_msg, 'audio', caption)
+                        
+                        bot.delete_message(chat_id, call.message.message_id)
+                        answer_callback(call, "✅ Audio extracted successfully!")
+                    else:
+                        raise Exception("No audio file downloaded")
                 
                 except Exception as e:
                     # If direct audio download failed, try with FFmpeg conversion
                     LOG.warning(f"Direct audio download failed: {e}, trying with FFmpeg conversion")
-                    ydl_opts = {
-                        'format': 'bestaudio/best',
-                        'postprocessors': ([{
-                            'key': 'FFmpegExtractAudio',
-                            'preferredcodec': 'mp3',
-                            'preferredquality': '192',
-                        }] if ffmpeg_path else []),
-                        'outtmpl': output_template,
-                        'quiet': True,
-                        'no_warnings': True,
-                    }
+                    info = run_ytdl('audio_mp3' if ffmpeg_path else 'audio_any', original_url, download=True, paths={'home': tmpdir})
+                    title = info.get('title', 'audio')
                     
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        info = ydl.extract_info(original_url, download=True)
-                        title = info.get('title', 'audio')
+                    # Find the downloaded MP3 file
+                    mp3_files = list(Path(tmpdir).glob('*.mp3'))
+                    if mp3_files:
+                        mp3_path = mp3_files[0]
+                        caption = f"<b>🎵 YouTube Audio (MP3)</b>\n<b>Title:</b> {title}\n\n<b>💜 <a href=\"https://t.me/TeraInstaShortsDownloaderbot\">Pocket Downloader Bot</a></b>"
                         
-                        # Find the downloaded MP3 file
-                        mp3_files = list(Path(tmpdir).glob('*.mp3'))
-                        if mp3_files:
-                            mp3_path = mp3_files[0]
-                            caption = f"<b>🎵 YouTube Audio (MP3)</b>\n<b>Title:</b> {title}\n\n<b>💜 <a href=\"https://t.me/TeraInstaShortsDownloaderbot\">Pocket Downloader Bot</a></b>"
-                            
-                            # Send as audio
-                            with open(mp3_path, 'rb') as f:
-                                bot.send_audio(
-                                    chat_id,
-                                    f,
-                                    caption=caption,
-                                    title=title,
-                                    performer="YouTube"
-                                )
-                            
-                            bot.delete_message(chat_id, call.message.message_id)
-                            bot.answer_callback_query(call.id, "✅ Audio extracted successfully!")
-                        else:
-                            bot.edit_message_text(
-                                f"<b>❌ Audio extraction failed</b>\n\nNo audio file was generated.",
+                        # Send as audio
+                        with open(mp3_path, 'rb') as f:
+                            sent_msg = bot.send_audio(
                                 chat_id,
-                                call.message.message_id
+                                f,
+                                caption=caption,
+                                title=title,
+                                performer="YouTube"
                             )
-                            bot.answer_callback_query(call.id, "❌ Extraction failed", show_alert=True)
+                        remember_sent(original_url, 'audio', sent_msg, 'audio', caption)
+                        
+                        bot.delete_message(chat_id, call.message.message_id)
+                        answer_callback(call, "✅ Audio extracted successfully!")
+                    else:
+                        bot.edit_message_text(
+                            f"<b>❌ Audio extraction failed</b>\n\nNo audio file was generated.",
+                            chat_id,
+                            call.message.message_id
+                        )
+                        answer_callback(call, "❌ Extraction failed", show_alert=True)
         
         except Exception as e:
             LOG.exception('Audio extraction failed')
@@ -1763,7 +4261,7 @@ def handle_yt_audio_callback(call):
                     chat_id,
                     call.message.message_id
                 )
-                bot.answer_callback_query(call.id, "❌ Video has no audio", show_alert=True)
+                answer_callback(call, "❌ Video has no audio", show_alert=True)
             elif 'ffmpeg' in error_msg.lower() or 'ffprobe' in error_msg.lower():
                 bot.edit_message_text(
                     f"<b>❌ Audio extraction failed</b>\n\n<i>FFmpeg is not installed. Attempting to download in original format...</i>",
@@ -1772,37 +4270,29 @@ def handle_yt_audio_callback(call):
                 )
                 # Try one more time without postprocessor
                 try:
-                    with tempfile.TemporaryDirectory() as tmpdir:
-                        output_template = os.path.join(tmpdir, '%(title)s.%(ext)s')
-                        ydl_opts = {
-                            'format': 'bestaudio',
-                            'outtmpl': output_template,
-                            'quiet': True,
-                            'no_warnings': True,
-                        }
+                    with job_workdir('raw') as tmpdir:
+                        info = run_ytdl('audio_raw', original_url, download=True, paths={'home': tmpdir})
+                        title = info.get('title', 'audio')
                         
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            info = ydl.extract_info(original_url, download=True)
-                            title = info.get('title', 'audio')
+                        audio_files = list(Path(tmpdir).glob('*.*'))
+                        if audio_files:
+                            audio_path = audio_files[0]
+                            caption = f"<b>🎵 YouTube Audio</b>\n<b>Title:</b> {title}\n\n<b>💜 <a href=\"https://t.me/TeraInstaShortsDownloaderbot\">Pocket Downloader Bot</a></b>"
                             
-                            audio_files = list(Path(tmpdir).glob('*.*'))
-                            if audio_files:
-                                audio_path = audio_files[0]
-                                caption = f"<b>🎵 YouTube Audio</b>\n<b>Title:</b> {title}\n\n<b>💜 <a href=\"https://t.me/TeraInstaShortsDownloaderbot\">Pocket Downloader Bot</a></b>"
-                                
-                                with open(audio_path, 'rb') as f:
-                                    bot.send_audio(
-                                        chat_id,
-                                        f,
-                                        caption=caption,
-                                        title=title,
-                                        performer="YouTube"
-                                    )
-                                
-                                bot.delete_message(chat_id, call.message.message_id)
-                                bot.answer_callback_query(call.id, "✅ Audio downloaded!")
-                            else:
-                                raise Exception("No audio file")
+                            with open(audio_path, 'rb') as f:
+                                sent_msg = bot.send_audio(
+                                    chat_id,
+                                    f,
+                                    caption=caption,
+                                    title=title,
+                                    performer="YouTube"
+                                )
+                            remember_sent(original_url, 'audio', sent_msg, 'audio', caption)
+                            
+                            bot.delete_message(chat_id, call.message.message_id)
+                            answer_callback(call, "✅ Audio downloaded!")
+                        else:
+                            raise Exception("No audio file")
                 except Exception as final_e:
                     LOG.exception('Final audio attempt failed')
                     bot.edit_message_text(
@@ -1810,32 +4300,175 @@ def handle_yt_audio_callback(call):
                         chat_id,
                         call.message.message_id
                     )
-                    bot.answer_callback_query(call.id, "❌ Download failed", show_alert=True)
+                    answer_callback(call, "❌ Download failed", show_alert=True)
             elif 'timed out' in error_msg.lower() or 'timeout' in error_msg.lower():
                 bot.edit_message_text(
                     f"<b>❌ Network timeout during audio extraction</b>\n\n<i>Please try again; connection was interrupted.</i>",
                     chat_id,
                     call.message.message_id
                 )
-                bot.answer_callback_query(call.id, "❌ Network timeout", show_alert=True)
+                answer_callback(call, "❌ Network timeout", show_alert=True)
             elif '403' in error_msg or '410' in error_msg or 'copyright' in error_msg.lower():
                 bot.edit_message_text(
                     f"<b>❌ Audio unavailable</b>\n\n<i>Restricted or copyright-protected stream prevented extraction.</i>",
                     chat_id,
                     call.message.message_id
                 )
-                bot.answer_callback_query(call.id, "❌ Restricted", show_alert=True)
+                answer_callback(call, "❌ Restricted", show_alert=True)
             else:
                 bot.edit_message_text(
                     f"<b>❌ Audio extraction failed</b>\n\n<i>Error: {error_msg[:100]}</i>",
                     chat_id,
                     call.message.message_id
                 )
-                bot.answer_callback_query(call.id, "❌ Extraction failed", show_alert=True)
+                answer_callback(call, "❌ Extraction failed", show_alert=True)
     
     except Exception:
         LOG.exception('Error in audio callback handler')
-        bot.answer_callback_query(call.id, "❌ Error processing request", show_alert=True)
+        answer_callback(call, "❌ Error processing request", show_alert=True)
+
+
+def album_item_kind(it):
+    """'photo', 'video' or None (send as a link) for an album item, from its flags or URL/file name."""
+    u = it.get('url') or ''
+    fname = it.get('file_name') or 'file'
+    is_video = it.get('is_video')
+    is_image = it.get('is_image')
+    if is_video is None and is_image is None:
+        url_lower = u.lower(); fname_lower = fname.lower()
+        if any(ext in url_lower or fname_lower.endswith(ext) for ext in ['.mp4','.mov','.avi','.mkv','.webm','.flv','.m4v']):
+            is_video, is_image = True, False
+        elif any(ext in url_lower or fname_lower.endswith(ext) for ext in ['.jpg','.jpeg','.png','.webp','.gif']):
+            is_video, is_image = False, True
+        else:
+            is_video = 'video' in url_lower; is_image = not is_video
+    if is_image:
+        return 'photo'
+    if is_video:
+        return 'video'
+    return None
+
+
+def send_media_entries(chat_id, entries, caption=None):
+    """Send [(kind, media)] as one media group, or a plain message if there is only one.
+    media is a URL, a file_id or an open file. Returns the sent messages."""
+    if len(entries) == 1:
+        kind, media = entries[0]
+        if kind == 'photo':
+            return [bot.send_photo(chat_id, media, caption=caption)]
+        return [bot.send_video(chat_id, media, caption=caption, supports_streaming=True)]
+    group = []
+    for i, (kind, media) in enumerate(entries):
+        item_caption = caption if i == 0 else None
+        parse_mode = 'HTML' if item_caption else None
+        if kind == 'photo':
+            group.append(InputMediaPhoto(media, caption=item_caption, parse_mode=parse_mode))
+        else:
+            group.append(InputMediaVideo(media, caption=item_caption, parse_mode=parse_mode, supports_streaming=True))
+    return bot.send_media_group(chat_id, group)
+
+
+def send_link_button(chat_id, url, text, reason):
+    METRICS.inc('link_fallbacks_total', reason=reason)
+    kb = InlineKeyboardMarkup(); kb.add(InlineKeyboardButton('⬇️ Download', url=url))
+    try:
+        bot.send_message(chat_id, text, reply_markup=kb)
+    except Exception:
+        LOG.exception('Failed to send download button')
+
+
+def download_album_item(it, idx, tmpdir: Path):
+    """Download one album item for local upload; returns its path or None."""
+    path = tmpdir / f"{idx}_{os.path.basename(it.get('file_name') or 'file')}"
+    ok = stream_download(it['url'], path, LOCAL_DOWNLOAD_LIMIT)
+    return path if ok and path.exists() else None
+
+
+def deliver_album(chat_id, source_url, items, caption, username):
+    """Send album items as media groups of up to MEDIA_GROUP_LIMIT, caption on the first item.
+    Once Telegram refuses to fetch the remote URLs, each chunk is downloaded with a bounded
+    pool (the next chunk prefetching while the current one uploads) and uploaded as a group.
+    Items that cannot be sent as media get a link button instead.
+    """
+    media_items = []  # (idx, kind, item)
+    complete = True
+    for idx, it in enumerate(items, start=1):
+        u = it.get('url')
+        if not u:
+            LOG.warning('Album item %s has no URL, skipping', idx)
+            complete = False
+            continue
+        kind = album_item_kind(it)
+        size_bytes = it.get('size_bytes')
+        if kind is None or (kind == 'video' and size_bytes and size_bytes > MAX_UPLOAD):
+            extra = ""
+            if kind and it.get('size_text'):
+                extra = f"\n<b>📊 Size:</b> {it['size_text']}\n<b>⚠️ Too large for auto-upload.</b>"
+            send_link_button(chat_id, u, f"<b>📎 Item {idx}</b>" + extra, 'too_large' if kind else 'unsupported')
+            complete = False
+            continue
+        media_items.append((idx, kind, it))
+    if media_items and media_items[0][2].get('size_text'):
+        caption += f"\n<b>📊 Size:</b> {media_items[0][2]['size_text']}"
+
+    chunks = [media_items[n:n + MEDIA_GROUP_LIMIT] for n in range(0, len(media_items), MEDIA_GROUP_LIMIT)]
+    delivered = []  # [kind, file_id] per sent item, for the file_id cache
+    local_mode = False
+    with job_workdir() as tmpdir, \
+            TracedExecutor(max_workers=ALBUM_PREFETCH_WORKERS, thread_name_prefix='album') as pool:
+        def prefetch(chunk):
+            return [pool.submit(download_album_item, it, idx, Path(tmpdir)) for idx, _, it in chunk]
+
+        prefetched = None
+        for n, chunk in enumerate(chunks):
+            chunk_caption = caption if n == 0 else None
+            sent = None
+            if not local_mode:
+                try:
+                    sent = send_media_entries(chat_id, [(kind, it['url']) for _, kind, it in chunk], chunk_caption)
+                except Exception as e:
+                    LOG.warning('Remote album send failed for chunk %s (%s); uploading locally', n + 1, e)
+                    local_mode = True
+            if sent is None:
+                futures = prefetched or prefetch(chunk)
+                # Start downloading the next chunk while this one uploads
+                prefetched = prefetch(chunks[n + 1]) if n + 1 < len(chunks) else None
+                paths = [f.result() for f in futures]
+                ready = [(idx, kind, it, path) for (idx, kind, it), path in zip(chunk, paths) if path]
+                for (idx, kind, it), path in zip(chunk, paths):
+                    if not path:
+                        send_link_button(chat_id, it['url'], f"<b>📎 Item {idx}</b>", 'fetch_failed')
+                        complete = False
+                sent = []
+                if ready:
+                    handles = [open(path, 'rb') for _, _, _, path in ready]
+                    try:
+                        sent = send_media_entries(chat_id, [(kind, h) for (_, kind, _, _), h in zip(ready, handles)], chunk_caption)
+                    except Exception:
+                        LOG.exception('Local album upload failed for chunk %s', n + 1)
+                        for idx, _, it, _ in ready:
+                            send_link_button(chat_id, it['url'], f"<b>📎 Item {idx}</b>", 'upload_failed')
+                        complete = False
+                    finally:
+                        for h in handles:
+                            h.close()
+            for sent_msg in sent:
+                kind = 'photo' if sent_msg.photo else 'video'
+                file_id = sent_file_id(sent_msg, kind)
+                if not file_id:
+                    continue
+                delivered.append([kind, file_id])
+                try:
+                    forward_to_backup_channel(chat_id, file_id, kind, chunk_caption or 'Instagram Album', username)
+                except Exception:
+                    pass
+    if complete and delivered:
+        remember_delivery(source_url, '', 'album', json.dumps(delivered), caption)
+
+
+def observe_first_response(msg):
+    """Record the time from the user's message (Telegram's timestamp) to our first reply."""
+    METRICS.observe('first_response_seconds', max(0.0, time.time() - msg.date))
 
 
 @bot.message_handler(func=lambda m: True)
@@ -1862,22 +4495,100 @@ def handle_message(msg):
     user = msg.from_user
     username = user.username or user.first_name or 'User'
     
-    LOG.info('Processing URL from @%s: %s', username, url)
+    trace = begin_trace('message', url=url, chat=chat_id, user=username)
+    LOG.info('Processing URL from @%s: %s (trace %s)', username, url, trace.id)
+    try:
+        dispatch_url(msg, chat_id, username, url)
+    finally:
+        end_trace(trace)
+
+
+def dispatch_url(msg, chat_id, username, url):
+    """Answer from the file_id cache, or queue process_url_job (shared by identical in-flight links)."""
+    # Media already delivered once: re-send by file_id without resolving or uploading
+    if deliver_cached(chat_id, url):
+        observe_first_response(msg)
+        return
     
-    # Send processing message with animation
-    processing_msg = bot.send_message(
-        chat_id, 
-        f"<b>⏳ Processing your request...</b>\n\n🔍 Analyzing URL\n⚙️ Fetching data\n📥 Preparing download\n\n<i>Please wait...</i>"
-    )
+    # Resolution, download and upload run on the job pool so commands stay responsive
+    position = JOBS.next_position()
+    if JOBS.is_full():
+        bot.reply_to(msg, BUSY_TEXT)
+        observe_first_response(msg)
+        return
+    # Send processing message with animation (or the queue position when all workers are busy)
+    processing_msg = bot.send_message(chat_id, queued_text(position) if position else PROCESSING_TEXT)
+    observe_first_response(msg)
+    # The same link already being fetched for another chat: wait for that job and reuse its upload
+    key = (normalize_url(url), '')
+    status_msg_id = processing_msg.message_id
+    job_id = JOURNAL.add('url', {'username': username, 'url': url}, chat_id, status_msg_id)
+    follower = lambda delivery: serve_coalesced_url(delivery, chat_id, username, url, status_msg_id, job_id)
+    if not FLIGHTS.join_or_lead(key, follower):
+        LOG.info('Coalesced %s onto the in-flight job', key[0])
+        return
+    try:
+        submit_url_job(chat_id, username, url, status_msg_id, queued=bool(position), flight=key, job_id=job_id)
+    except queue.Full:
+        FLIGHTS.finish(key)
+        bot.edit_message_text(BUSY_TEXT, chat_id, status_msg_id)
+
+
+def submit_url_job(chat_id, username, url, status_msg_id, queued=False, flight=None, job_id=None):
+    """Journal and queue process_url_job; flight is the single-flight key it leads, if any.
+    Raises queue.Full like JOBS.submit."""
+    job_id = job_id or JOURNAL.add('url', {'username': username, 'url': url}, chat_id, status_msg_id)
+    job = in_flight(flight, process_url_job) if flight else process_url_job
+    try:
+        JOBS.submit(journaled(job_id, job), chat_id, username, url, status_msg_id, queued=queued)
+    except queue.Full:
+        JOURNAL.finish(job_id)
+        raise
+
+
+def in_flight(key, job):
+    """Wrap job so the flight for key ends, serving its followers, when job returns."""
+    def run(*args, **kwargs):
+        try:
+            return job(*args, **kwargs)
+        finally:
+            FLIGHTS.finish(key)
+    run.__name__ = job.__name__  # JobQueue names spans and metrics after the job
+    return run
+
+
+def serve_coalesced_url(delivery, chat_id, username, url, status_msg_id, job_id=None):
+    """Finish a link that waited on another chat's job: re-send its upload or run our own job."""
+    if deliver_coalesced(chat_id, delivery, 'url'):
+        JOURNAL.finish(job_id)
+        try:
+            bot.delete_message(chat_id, status_msg_id)
+        except Exception:
+            pass
+        return
+    try:
+        submit_url_job(chat_id, username, url, status_msg_id, job_id=job_id)
+    except queue.Full:
+        bot.edit_message_text(BUSY_TEXT, chat_id, status_msg_id)
+
+
+def process_url_job(chat_id, username, url, status_msg_id, queued=False):
+    """Resolve a link and deliver the media (runs on the job pool)."""
+    journal_state('resolving')
+    if queued:
+        try:
+            bot.edit_message_text(PROCESSING_TEXT, chat_id, status_msg_id)
+        except Exception:
+            pass
 
     # Resolve URL with robust error handling to avoid crashing the bot
     try:
-        result = handle_api_for_url(url)
+        result = resolve_url(url)
     except Exception as e:
         LOG.exception('Fatal error while resolving URL: %s', e)
         # Best-effort Instagram fallback using yt-dlp
         if 'instagram.com' in url.lower():
-            cap_fb, media_fb = get_instagram_with_ytdlp_fallback(url)
+            cap_fb, media_fb = instagram_via_ytdlp(url)
             if media_fb:
                 items = [{
                     'url': mu,
@@ -1896,8 +4607,7 @@ def handle_message(msg):
         qualities = result['qualities']
         best_index = result.get('best_index', 0)
         title_caption = result.get('caption') or 'YouTube Video'
-        session_id = next(SESSION_COUNTER)
-        FORMAT_SESSIONS[session_id] = qualities
+        session_id = FORMAT_SESSIONS.add(url, qualities)
 
         kb = InlineKeyboardMarkup()
         # Download best quality button (renamed from Upload Best Video) - at top
@@ -1916,7 +4626,7 @@ def handle_message(msg):
         bot.edit_message_text(
             f"<b>✅ Formats Ready</b>\n<b>📝 Title:</b> {title_caption}\n\n<b>🎬 Download Options:</b>\nClick <b>Download Now</b> for best quality or choose a specific quality below. ⭐ marks best quality.\n\n<b>💡 Tip:</b> Use <b>Extract Audio</b> to get MP3.",
             chat_id,
-            processing_msg.message_id,
+            status_msg_id,
             reply_markup=kb
         )
         return
@@ -1932,7 +4642,7 @@ def handle_message(msg):
             f"• Use /supported to see available platforms\n\n"
             f"<i>If the issue persists, the platform may be temporarily unavailable.</i>"
         )
-        bot.edit_message_text(error_msg, chat_id, processing_msg.message_id)
+        bot.edit_message_text(error_msg, chat_id, status_msg_id)
         return
 
     # If Instagram album or multi-item result
@@ -1947,92 +4657,12 @@ def handle_message(msg):
             main_caption = f"<b>📸 Album ({len(items)} items)</b>\n<b>💜 <a href=\"https://t.me/TeraInstaShortsDownloaderbot\">Pocket Downloader Bot</a></b>"
 
         try:
-            bot.delete_message(chat_id, processing_msg.message_id)
+            bot.delete_message(chat_id, status_msg_id)
         except Exception:
             pass
 
-        # Multi-item branch
-        if result.get('items'):
-            multi_items = result['items']
-            for idx, it in enumerate(multi_items, start=1):
-                u = it.get('url')
-                if not u:
-                    LOG.warning('Album item %s has no URL, skipping', idx)
-                    continue
-                fname = it.get('file_name') or 'file'
-                size_bytes = it.get('size_bytes')
-                size_text = it.get('size_text')
-                is_video = it.get('is_video')
-                is_image = it.get('is_image')
-                if is_video is None and is_image is None:
-                    url_lower = u.lower(); fname_lower = fname.lower()
-                    if any(ext in url_lower or fname_lower.endswith(ext) for ext in ['.mp4','.mov','.avi','.mkv','.webm','.flv','.m4v']):
-                        is_video, is_image = True, False
-                    elif any(ext in url_lower or fname_lower.endswith(ext) for ext in ['.jpg','.jpeg','.png','.webp','.gif']):
-                        is_video, is_image = False, True
-                    else:
-                        is_video = 'video' in url_lower; is_image = not is_video
-                per_caption = main_caption if idx == 1 and main_caption else None
-                if per_caption and size_text and idx == 1:
-                    per_caption += f"\n<b>📊 Size:</b> {size_text}"
-                try:
-                    if is_image:
-                        LOG.info('Sending Instagram image %s/%s as photo', idx, len(multi_items))
-                        sent_msg = bot.send_photo(chat_id, u, caption=per_caption)
-                        try:
-                            forward_to_backup_channel(chat_id, sent_msg.photo[-1].file_id, 'photo', per_caption or 'Instagram Album', username)
-                        except Exception:
-                            pass
-                    elif is_video:
-                        over_limit_known = bool(size_bytes and size_bytes > MAX_UPLOAD)
-                        if over_limit_known:
-                            kb = InlineKeyboardMarkup()
-                            kb.add(InlineKeyboardButton('⬇️ Download', url=u))
-                            extra = ""
-                            if size_text:
-                                extra = f"\n<b>📊 Size:</b> {size_text}\n<b>⚠️ Too large for auto-upload.</b>"
-                            bot.send_message(chat_id, (per_caption or '') + extra, reply_markup=kb)
-                            continue
-                        
-                        sent_successfully = False
-                        try:
-                            sent_msg = bot.send_video(chat_id, u, caption=per_caption, supports_streaming=True)
-                            sent_successfully = True
-                            try:
-                                forward_to_backup_channel(chat_id, sent_msg.video.file_id, 'video', per_caption or 'Instagram Album', username)
-                            except Exception:
-                                pass
-                        except Exception:
-                            LOG.warning('Remote send failed for album video item %s; attempting local upload', idx)
-                        
-                        if not sent_successfully:
-                            with tempfile.TemporaryDirectory() as tmpdir:
-                                temp_path = Path(tmpdir) / fname
-                                ok = stream_download(u, temp_path, LOCAL_DOWNLOAD_LIMIT)
-                                if ok and temp_path.exists():
-                                    try:
-                                        with open(temp_path, 'rb') as f:
-                                            sent_msg = bot.send_video(chat_id, f, caption=per_caption, supports_streaming=True)
-                                            sent_successfully = True
-                                            try:
-                                                forward_to_backup_channel(chat_id, sent_msg.video.file_id, 'video', per_caption or 'Instagram Album', username)
-                                            except Exception:
-                                                pass
-                                    except Exception:
-                                        LOG.exception('Local upload failed for album video item %s', idx)
-                                        sent_successfully = False
-                                if not sent_successfully:
-                                    kb = InlineKeyboardMarkup(); kb.add(InlineKeyboardButton('⬇️ Download', url=u))
-                                    bot.send_message(chat_id, per_caption or '', reply_markup=kb)
-                    else:
-                        kb = InlineKeyboardMarkup(); kb.add(InlineKeyboardButton('⬇️ Download', url=u))
-                        bot.send_message(chat_id, per_caption or '', reply_markup=kb)
-                except Exception:
-                    LOG.exception('Failed to send album item %s', idx)
-                    kb = InlineKeyboardMarkup(); kb.add(InlineKeyboardButton('⬇️ Download', url=u))
-                    try: bot.send_message(chat_id, per_caption or '', reply_markup=kb)
-                    except Exception: pass
-            return
+        deliver_album(chat_id, url, items, main_caption, username)
+        return
 
     # Single-item flow
     dl_url = result.get('url')
@@ -2077,7 +4707,7 @@ def handle_message(msg):
         is_image = fname.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.gif'))
 
     try:
-        bot.delete_message(chat_id, processing_msg.message_id)
+        bot.delete_message(chat_id, status_msg_id)
     except Exception:
         pass
 
@@ -2101,6 +4731,7 @@ def handle_message(msg):
             # First attempt: remote URL send
             if is_image:
                 sent_msg = bot.send_photo(chat_id, dl_url, caption=caption, reply_markup=kb_opt)
+                remember_sent(url, '', sent_msg, 'photo', caption)
                 # Forward to backup channel
                 try:
                     forward_to_backup_channel(chat_id, sent_msg.photo[-1].file_id, 'photo', caption, username)
@@ -2108,6 +4739,7 @@ def handle_message(msg):
                     pass
             elif is_video:
                 sent_msg = bot.send_video(chat_id, dl_url, caption=caption, supports_streaming=True, reply_markup=kb_opt)
+                remember_sent(url, '', sent_msg, 'video', caption)
                 # Forward to backup channel
                 try:
                     forward_to_backup_channel(chat_id, sent_msg.video.file_id, 'video', caption, username)
@@ -2115,6 +4747,7 @@ def handle_message(msg):
                     pass
             else:
                 sent_msg = bot.send_document(chat_id, dl_url, caption=caption, reply_markup=kb_opt)
+                remember_sent(url, '', sent_msg, 'document', caption)
                 # Forward to backup channel
                 try:
                     forward_to_backup_channel(chat_id, sent_msg.document.file_id, 'document', caption, username)
@@ -2150,7 +4783,7 @@ def handle_message(msg):
                 except Exception:
                     pass  # Ignore edit errors
             
-            with tempfile.TemporaryDirectory() as tmpdir:
+            with job_workdir() as tmpdir:
                 temp_path = Path(tmpdir) / fname
                 ok = stream_download(dl_url, temp_path, LOCAL_DOWNLOAD_LIMIT, progress_callback=progress_update)
                 if ok and temp_path.exists():
@@ -2158,6 +4791,7 @@ def handle_message(msg):
                         with open(temp_path, 'rb') as f:
                             if is_image:
                                 sent_msg = bot.send_photo(chat_id, f, caption=caption, reply_markup=kb_opt)
+                                remember_sent(url, '', sent_msg, 'photo', caption)
                                 # Forward to backup channel
                                 try:
                                     forward_to_backup_channel(chat_id, sent_msg.photo[-1].file_id, 'photo', caption, username)
@@ -2165,6 +4799,7 @@ def handle_message(msg):
                                     pass
                             elif is_video:
                                 sent_msg = bot.send_video(chat_id, f, caption=caption, supports_streaming=True, reply_markup=kb_opt)
+                                remember_sent(url, '', sent_msg, 'video', caption)
                                 # Forward to backup channel
                                 try:
                                     forward_to_backup_channel(chat_id, sent_msg.video.file_id, 'video', caption, username)
@@ -2172,6 +4807,7 @@ def handle_message(msg):
                                     pass
                             else:
                                 sent_msg = bot.send_document(chat_id, f, caption=caption, reply_markup=kb_opt)
+                                remember_sent(url, '', sent_msg, 'document', caption)
                                 # Forward to backup channel
                                 try:
                                     forward_to_backup_channel(chat_id, sent_msg.document.file_id, 'document', caption, username)
@@ -2180,17 +4816,20 @@ def handle_message(msg):
                         bot.delete_message(chat_id, upload_msg.message_id)
                     except Exception:
                         LOG.exception('Local re-upload failed; falling back to link button')
+                        METRICS.inc('link_fallbacks_total', reason='upload_failed')
                         bot.delete_message(chat_id, upload_msg.message_id)
                         kb = InlineKeyboardMarkup()
                         kb.add(InlineKeyboardButton("⬇️ Download", url=button_url or dl_url))
                         bot.send_message(chat_id, caption + "\n\n<b>⚠️ Could not upload file directly</b>", reply_markup=kb)
                 else:
+                    METRICS.inc('link_fallbacks_total', reason='fetch_failed')
                     bot.delete_message(chat_id, upload_msg.message_id)
                     kb = InlineKeyboardMarkup()
                     kb.add(InlineKeyboardButton("⬇️ Download", url=button_url or dl_url))
                     bot.send_message(chat_id, caption + "\n\n<b>⚠️ Could not fetch file for upload</b>", reply_markup=kb)
     else:
         # Large file or unknown size: send button only
+        METRICS.inc('link_fallbacks_total', reason='too_large')
         kb = InlineKeyboardMarkup()
         label_size = size_display or ('Download' if not size_known else human_size(size_bytes))
         kb.add(InlineKeyboardButton(f"⬇️ {label_size}", url=(button_url or dl_url)))
@@ -2198,11 +4837,192 @@ def handle_message(msg):
         bot.send_message(chat_id, caption + extra, reply_markup=kb)
 
 
+RECOVERED_TEXT = "<b>♻️ Picking up your request again</b>\n\n<i>The bot restarted while working on it. No need to resend the link.</i>"
+ABANDONED_TEXT = "<b>❌ This request could not be finished</b>\n\n<i>The bot restarted several times while working on it. Please send the link again.</i>"
+
+
+def recover_jobs(shard=None):
+    """Queue the jobs a crash or restart interrupted again, editing each status message.
+    Partial downloads in their spool directories are resumed; a job is dropped after
+    JOB_MAX_RECOVERIES restarts so one that crashes the bot cannot loop forever."""
+    callback_jobs = {'yt_upload_job': yt_upload_job, 'yt_audio_job': yt_audio_job}
+    for job in JOURNAL.unfinished(shard, SHARD_WORKERS or 1):
+        job_id, chat_id, status_msg_id, payload = job['id'], job['chat_id'], job['status_msg_id'], job['payload']
+        if job['recoveries'] >= JOB_MAX_RECOVERIES:
+            LOG.warning('Dropping %s job %s after %s restarts', job['kind'], job_id, job['recoveries'])
+            JOURNAL.finish(job_id)
+            try:
+                bot.edit_message_text(ABANDONED_TEXT, chat_id, status_msg_id)
+            except Exception:
+                pass
+            continue
+        call = CallbackQuery.de_json(payload['call']) if job['kind'] == 'callback' else None
+        if call and callback_session(call) is None:
+            LOG.info('Dropping callback job %s: its format session did not survive the restart', job_id)
+            JOURNAL.finish(job_id)
+            try:
+                bot.edit_message_text(SESSION_EXPIRED_TEXT, chat_id, status_msg_id)
+            except Exception:
+                pass
+            continue
+        LOG.info('Recovering %s job %s for chat %s (was %s)', job['kind'], job_id, chat_id, job['state'])
+        try:
+            bot.edit_message_text(RECOVERED_TEXT, chat_id, status_msg_id)
+        except Exception:
+            pass
+        try:
+            if job['kind'] == 'url':
+                submit_url_job(chat_id, payload['username'], payload['url'], status_msg_id, job_id=job_id)
+            else:
+                submit_callback_job(callback_jobs[payload['job']], call, job_id)
+        except queue.Full:
+            try:
+                bot.edit_message_text(BUSY_TEXT, chat_id, status_msg_id)
+            except Exception:
+                pass
+        except Exception:
+            LOG.exception('Could not recover job %s', job_id)
+            JOURNAL.finish(job_id)
+
+
+def update_chat_id(raw):
+    """Chat an update belongs to (button presses: the chat of the pressed message)."""
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if kind in raw:
+            return raw[kind]['chat']['id']
+    call = raw.get('callback_query')
+    if call:
+        return call['message']['chat']['id'] if call.get('message') else call['from']['id']
+    return 0
+
+
+def shard_worker(index, inbox):
+    """Shard process: run the bot's handlers for the updates the coordinator routes here."""
+    LOG.info('Shard %s started (pid %s)', index, os.getpid())
+    start_services(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    recover_jobs(index)
+    while True:
+        raw = inbox.get()
+        if raw is None:
+            break
+        try:
+            bot.process_new_updates([Update.de_json(raw)])
+        except Exception:
+            LOG.exception('Shard %s could not handle update %s', index, raw.get('update_id'))
+    LOG.info('Shard %s stopped', index)
+
+
+class ShardPool:
+    """Worker processes that each own the chats with chat_id % n == their index.
+    A chat always lands on the same process, so its format sessions and jobs stay there.
+    """
+
+    def __init__(self, workers):
+        self._ctx = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self.inboxes = [self._ctx.Queue() for _ in range(workers)]
+        self.procs = [self._start(i) for i in range(workers)]
+
+    def _start(self, index):
+        # Not daemonic: shards start their own yt-dlp worker processes
+        proc = self._ctx.Process(target=shard_worker, args=(index, self.inboxes[index]), name=f'shard-{index}')
+        proc.start()
+        return proc
+
+    def route(self, raw):
+        index = update_chat_id(raw) % len(self.procs)
+        with self._lock:
+            proc = self.procs[index]
+            if not proc.is_alive():
+                # A process killed inside get() can leave its queue locked, so the replacement gets a new one
+                LOG.warning('Shard %s exited (code %s); restarting', index, proc.exitcode)
+                self.inboxes[index] = self._ctx.Queue()
+                self.procs[index] = self._start(index)
+            inbox = self.inboxes[index]
+        inbox.put(raw)
+
+    def stop(self, timeout=30):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for proc in self.procs:
+            proc.join(timeout)
+            if proc.is_alive():
+                proc.terminate()
+
+
+SHARDS = None  # ShardPool in the coordinator process when SHARD_WORKERS > 0
+
+
+def dispatch_raw_update(raw):
+    """Handle one update dict from getUpdates or the webhook, here or on the shard owning its chat."""
+    if SHARDS is not None:
+        SHARDS.route(raw)
+        return
+    # Handlers run on telebot's worker threads; slow work goes on to JOBS
+    bot.process_new_updates([Update.de_json(raw)])
+
+
+POLL_OFFSET = None  # next update_id to fetch; survives poll_raw_updates restarts so no batch is routed twice
+
+
+def poll_raw_updates():
+    """Long-poll getUpdates and pass every update to dispatch_raw_update (shard coordinator).
+    Failed polls are retried here with backoff, like infinity_polling does, rather than
+    escaping to the startup loop (which would drop or replay pending updates)."""
+    global POLL_OFFSET
+    backoff = 1
+    while True:
+        try:
+            updates = apihelper.get_updates(TOKEN, POLL_OFFSET, 100, 20, ALLOWED_UPDATES, 20)
+        except Exception as e:
+            LOG.warning('getUpdates failed (%s); retrying in %ss', e, backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+            continue
+        backoff = 1
+        for raw in updates:
+            POLL_OFFSET = raw['update_id'] + 1
+            try:
+                dispatch_raw_update(raw)
+            except Exception:
+                LOG.exception('Could not route update %s', raw.get('update_id'))
+
+
+def start_services(metrics_port=METRICS_PORT, prewarm=True):
+    """Per-process startup: Bot API metrics, the /metrics endpoint and yt-dlp prewarm."""
+    instrument_telegram_api()
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    if not prewarm or not YTDLP_PREWARM:
+        return
+    if YTDL_PROCS is not None:
+        YTDL_PROCS.prewarm(YTDLP_PREWARM)
+    else:
+        threading.Thread(target=YTDL_POOL.prewarm, args=(YTDLP_PREWARM,), name='ytdl-prewarm', daemon=True).start()
+
+
 if __name__ == '__main__':
     print("🚀 Process started! Initializing imports...", flush=True)
     LOG.info('Starting bot...')
     print("🤖 Bot is starting...", flush=True)
 
+    # With shards this process only routes updates; downloads run in the shard processes
+    start_services(prewarm=not SHARD_WORKERS)
+    if SHARD_WORKERS:
+        SHARDS = ShardPool(SHARD_WORKERS)
+        atexit.register(SHARDS.stop)
+        print(f"🧩 Routing updates to {SHARD_WORKERS} shard processes", flush=True)
+    else:
+        recover_jobs()  # shard workers recover the jobs of their own chats
+
+    webhook = None
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            print("❌ Error: BOT_MODE=webhook needs WEBHOOK_URL!", flush=True)
+            sys.exit(1)
+        # Bound now so updates Telegram sends right after registration wait in the listen backlog
+        webhook = webhook_server()
+
     # SUPERVISOR LOOP: Keeps the bot running despite network crashes
     while True:
         try:
@@ -2216,12 +5036,16 @@ if __name__ == '__main__':
             max_retries = 15
             for attempt in range(max_retries):
                 try:
-                    # Remove any existing webhook and drop pending updates to start fresh
-                    # Only do this on the first loop or if restarting after a long time
-                    print(f"🧹 Clearing pending updates (Attempt {attempt+1}/{max_retries})...", flush=True)
-                    bot.delete_webhook(drop_pending_updates=True)
-                    time.sleep(1)
-                    print("✅ Webhook removed & updates dropped.", flush=True)
+                    if webhook:
+                        print(f"🔗 Registering webhook (Attempt {attempt+1}/{max_retries})...", flush=True)
+                        register_webhook()
+                        print(f"✅ Webhook set to {WEBHOOK_URL}", flush=True)
+                    else:
+                        # Remove any existing webhook (and, unless DROP_PENDING_UPDATES=0, queued updates)
+                        print(f"🧹 Removing webhook (Attempt {attempt+1}/{max_retries})...", flush=True)
+                        bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+                        time.sleep(1)
+                        print("✅ Webhook removed" + (" & updates dropped." if DROP_PENDING_UPDATES else "."), flush=True)
 
                     # Identity check
                     me = bot.get_me()
@@ -2238,10 +5062,20 @@ if __name__ == '__main__':
                         print("❌ Network failed after multiple attempts. Restarting supervisor loop...", flush=True)
                         raise e
 
+            if webhook:
+                print("🔄 Serving webhook...", flush=True)
+                webhook.serve_forever()
+                continue
+
+            if SHARDS is not None:
+                print("🔄 Entering polling loop (shard coordinator)...", flush=True)
+                poll_raw_updates()
+                continue
+
             print("🔄 Entering polling loop...", flush=True)
             
             # Reduced arguments to avoid timeouts/conflicts
-            bot.infinity_polling(timeout=20, long_polling_timeout=20, logger_level=logging.INFO, allowed_updates=['message', 'callback_query'])
+            bot.infinity_polling(timeout=20, long_polling_timeout=20, logger_level=logging.INFO, allowed_updates=ALLOWED_UPDATES)
         
         except Exception as e:
             # Graceful exit for duplicate instances